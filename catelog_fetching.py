@@ -1,19 +1,32 @@
 from urllib.error import URLError
-import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+import hashlib
 import re
-import random
 import time
 import requests
 from pyquery import PyQuery as pq
+import http_client
+import failures
+from user_agents import GetHeader
+from db_writer import ConnectDb, BatchWriter
+import lxml_parsing
+import shard_planner
+import metrics
+import cities
 
-HOST = 'https://gz.lianjia.com'
-CATELOG_URL = 'https://gz.lianjia.com/zufang/'
 CITY = 'guangzhou'
+HOST = cities.GetCity(CITY).host
+CATELOG_URL = cities.CatelogUrl(CITY)
+PARSER = 'lxml'  # 'lxml' | 'pyquery'，两者产出的记录完全一致
+INCREMENTAL = True  # 增量模式下只有新增或变化的房源进入详情页抓取队列
+WORKERS = 4  # 同时在途的列表页请求数，总请求速率由throttle中的令牌桶控制
 
-def DbInitialize(city=CITY):
-
-    init_sql = '''
-                DROP TABLE IF EXISTS `{city}`;
+def DbInitialize(city=CITY, incremental=INCREMENTAL):
+    '''
+    增量模式保留已有的summary数据，以link去重并记录历史版本；全量模式沿用原先先删表再重建的做法
+    '''
+    create_sql = '''
                 CREATE TABLE IF NOT EXISTS `{city}` (
                 `id` INTEGER PRIMARY KEY AUTOINCREMENT,
                 `title` VARCHAR(40),
@@ -24,14 +37,52 @@ def DbInitialize(city=CITY):
                 `price` INT NOT NULL,
                 `unit` CHAR(16) NOT NULL,
                 `status` TINYINT DEFAULT 0 NOT NULL,
-                `houseid` BIGINT DEFAULT NULL)
+                `houseid` BIGINT DEFAULT NULL,
+                `hash` CHAR(40),
+                `first_seen` DATE,
+                `last_seen` DATE)
+               '''.format(city=city)
+
+    # 新增及内容变化的房源写入历史表
+    history_sql = '''
+                CREATE UNIQUE INDEX IF NOT EXISTS `{city}-link` ON `{city}` (`link`);
+                CREATE TABLE IF NOT EXISTS `{city}-history` (
+                `link` VARCHAR(255) NOT NULL,
+                `seen` DATE NOT NULL,
+                `title` VARCHAR(40),
+                `area` NUMERIC NOT NULL,
+                `price` INT NOT NULL,
+                `unit` CHAR(16) NOT NULL,
+                `hash` CHAR(40),
+                PRIMARY KEY (`link`, `seen`));
+                CREATE TRIGGER IF NOT EXISTS `{city}-history-insert` AFTER INSERT ON `{city}`
+                BEGIN
+                    INSERT INTO `{city}-history`
+                    VALUES (new.link, new.last_seen, new.title, new.area, new.price, new.unit, new.hash)
+                    ON CONFLICT(link, seen) DO UPDATE SET
+                        title = excluded.title, area = excluded.area, price = excluded.price,
+                        unit = excluded.unit, hash = excluded.hash;
+                END;
+                CREATE TRIGGER IF NOT EXISTS `{city}-history-update` AFTER UPDATE OF `hash` ON `{city}`
+                WHEN old.hash IS NOT new.hash
+                BEGIN
+                    INSERT INTO `{city}-history`
+                    VALUES (new.link, new.last_seen, new.title, new.area, new.price, new.unit, new.hash)
+                    ON CONFLICT(link, seen) DO UPDATE SET
+                        title = excluded.title, area = excluded.area, price = excluded.price,
+                        unit = excluded.unit, hash = excluded.hash;
+                END;
                '''.format(city=city)
 
-    conn = sqlite3.connect('lianjia.db')
+    conn = ConnectDb(cities.ShardPath(city))
     cur = conn.cursor()
 
     try:
-        cur.executescript(init_sql)
+        if not incremental:
+            cur.execute('DROP TABLE IF EXISTS `{city}`'.format(city=city))
+        cur.execute(create_sql)
+        SummaryMigrate(cur, city)
+        cur.executescript(history_sql)
         conn.commit()
     except:
         print('DB Initialization Error')
@@ -41,81 +92,120 @@ def DbInitialize(city=CITY):
     return conn
 
 
-def RecordInsert(cur, record, city=CITY):
+def SummaryMigrate(cur, city=CITY):
+    '''
+    为旧版本建立的summary表补充增量模式所需的字段，并去除重复的link以便建立唯一索引
+    '''
+    columns = {row[1] for row in cur.execute('PRAGMA table_info(`{city}`)'.format(city=city))}
+    for name, dtype in [('hash', 'CHAR(40)'), ('first_seen', 'DATE'), ('last_seen', 'DATE')]:
+        if name not in columns:
+            cur.execute('ALTER TABLE `{city}` ADD COLUMN `{name}` {dtype}'.format(city=city, name=name, dtype=dtype))
 
-    sql = '''
-          INSERT INTO {city}
-          (title, link, district, neighborhood, area, price, unit)
-          VALUES 
-          (:title, :link, :district, :neighborhood, :area, :price, :unit)
-          '''.format(city=city)
+    cur.execute('''
+                DELETE FROM `{city}` WHERE id NOT IN (
+                SELECT MAX(id) FROM `{city}` GROUP BY link)
+                '''.format(city=city))
 
-    try:
-        cur.execute(sql, record)
-        num_suc = 1
-    except:
-        print('Insertion Error for title {:s}'.format(record['title']))
-        num_suc = 0
-    
-    return num_suc
+    return None
 
-def GetHeader():
 
-    with open('user-agents.txt', 'r') as fhand:
-        agent = random.choice(fhand.read().split('\n'))
-    header = {
-        'User-Agent': agent,
-        'Host': 'gz.lianjia.com'
-    }
-    return header
+def InsertSql(city=CITY):
+    '''
+    以link为键插入或更新：已有房源只更新last_seen，标题、面积或价格变化时重新置为待处理；
+    旧版本表中没有hash的记录视为未变化
+    '''
+    return '''
+           INSERT INTO `{city}`
+           (title, link, district, neighborhood, area, price, unit, hash, first_seen, last_seen)
+           VALUES 
+           (:title, :link, :district, :neighborhood, :area, :price, :unit, :hash, :snapshot, :snapshot)
+           ON CONFLICT(link) DO UPDATE SET
+               title = excluded.title, area = excluded.area, price = excluded.price,
+               unit = excluded.unit, last_seen = excluded.last_seen,
+               status = CASE WHEN `{city}`.hash IS excluded.hash OR `{city}`.hash IS NULL
+                        THEN `{city}`.status ELSE 0 END,
+               hash = excluded.hash
+           '''.format(city=city)
 
 
-def GetMaxPage():
+def RecordHash(record):
 
-    r = requests.get(CATELOG_URL, headers=GetHeader())
-    if r.status_code == 200:
-        doc = pq(r.text)
-        max_page = doc('.content__pg').attr('data-totalpage')
-        
-        try:
-            max_page = int(max_page)
-            print('{} pages found'.format(max_page))
-        except ValueError:
-            print('Invalid max_page number fetched')
-        return max_page
-    else:
-        raise URLError('Connection status: {:s}'.format(r.status_code))
+    content = '\x1f'.join(str(record[key]) for key in ('title', 'area', 'price', 'unit'))
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
 
 
-def GetPage(url):
+def RecordInsert(writer, record, snapshot, city=CITY):
+    '''
+    记录交由BatchWriter缓冲，按批次写入
+    '''
+    record['hash'] = RecordHash(record)
+    record['snapshot'] = snapshot
+    writer.Add(InsertSql(city), record)
+    return None
+
+def RequestPage(url):
+    '''
+    只发出请求、不写失败记录：回放缓存未命中时返回None，连接失败及异常状态抛出
+    '''
+    r = http_client.Get(url, headers=GetHeader(url))
 
-    try:
-        r = requests.get(url, headers=GetHeader(), timeout=10)
-    except requests.exceptions.Timeout:
-        print('Time out for {:s}'.format(url))
-        with open('unsuccessful_summary_page.log', 'a+') as fhand:
-            fhand.write(url)
-        return None
-    
     if r.status_code == 200:
         return r.text
+    elif http_client.IsReplayMiss(r):
+        print('Not in replay cache: {:s}'.format(url))
+        return None
     else:
         raise URLError('Connection status: {:d}'.format(r.status_code))
 
-def ParsePage(html):
+def GetPage(url):
+
+    try:
+        html = RequestPage(url)
+    except (requests.exceptions.Timeout, requests.exceptions.ConnectionError) as err:
+        # 在抓取线程中发生，抛出会中断整个并发抓取，记入失败记录由retry_scheduler重试
+        print('Connection failed for {:s}:'.format(url), err)
+        failures.Record('summary', url, err)
+        return None
+
+    if html is not None:
+        failures.Resolve('summary', url)
+    return html
 
+def SummaryItems(html):
+    '''
+    PyQuery解析路径，产出与lxml_parsing.SummaryItems相同格式的原始字段
+    '''
     doc = pq(html)
     records = doc('#content .content__list--item').items()
 
     for r in records:
+        yield (
+            r.find('.content__list--item--title.twoline a').text(),
+            r.find('.content__list--item--title.twoline a').attr('href'),
+            r.find('.content__list--item--des a:nth-child(1)').text(),
+            r.find('.content__list--item--des a:nth-child(2)').text(),
+            r.find('.content__list--item--des').text(),
+            r.find('.content__list--item-price em').text(),
+            r.find('.content__list--item-price').text()
+            )
+
+
+def ParsePage(html, parser=PARSER, host=HOST):
+
+    if parser == 'lxml':
+        items = lxml_parsing.SummaryItems(html)
+    else:
+        items = SummaryItems(html)
+
+    for title, href, district, neighborhood, des, price, price_text in items:
         record = {
-            'title': r.find('.content__list--item--title.twoline a').text(),
-            'link': HOST + r.find('.content__list--item--title.twoline a').attr('href'),
-            'district': r.find('.content__list--item--des a:nth-child(1)').text(),
-            'neighborhood': r.find('.content__list--item--des a:nth-child(2)').text(),
-            'area': re.search(r'(\d+)\u33a1', r.find('.content__list--item--des').text()).group(1),
-            'price': r.find('.content__list--item-price em').text(),
-            'unit': re.sub(r'[-\d\s]+', '',  r.find('.content__list--item-price').text())
+            'title': title,
+            'link': host + href,
+            'district': district,
+            'neighborhood': neighborhood,
+            'area': re.search(r'(\d+)\u33a1', des).group(1),
+            'price': price,
+            'unit': re.sub(r'[-\d\s]+', '',  price_text)
             }
 
         # 若面积和标价数据录入为一个区间，取区间均值
@@ -127,32 +217,75 @@ def ParsePage(html):
         yield record
 
 
-def Main():
+def FetchPage(url):
+    '''
+    抓取单个列表页，失败时写入失败记录并返回None，由retry_scheduler按退避时间重试
+    '''
+    print('Fetching...', url)
 
-    conn = DbInitialize()
-    cur = conn.cursor()
-    n_suc, n_total = 0, 0
-
-    for i in range(GetMaxPage()):
-        url = '{catelog}pg{pagenum}rco11/'.format(catelog=CATELOG_URL, pagenum=i+1)
-        print('Fetching...', url)
-        
-        try:
-            html = GetPage(url)
-        except URLError as err:
-            with open('unsuccessful_summary_page.log', 'a+') as fhand:
-                fhand.write('\n'.join(err.args[0], url))
-            continue
-        
+    try:
+        return GetPage(url)
+    except URLError as err:
+        print('Failed to fetch {:s}:'.format(url), err.reason)
+        failures.Record('summary', url, err)
+        return None
+
+
+def FetchConcurrently(units, workers=WORKERS):
+    '''
+    并发抓取各分片的列表页，已带有html的首页直接产出，最多保持workers * 2个请求在途
+    '''
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for url, html in units:
+            if html is not None:
+                yield html
+                continue
+            pending.append(executor.submit(FetchPage, url))
+            metrics.Set('queue_depth', len(pending), doc='Requests in flight per stage', stage='summary')
+            if len(pending) >= workers * 2:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+        metrics.Set('queue_depth', 0, stage='summary')
+
+
+def Main(incremental=INCREMENTAL, workers=WORKERS, city=CITY):
+
+    snapshot = time.strftime('%Y-%m-%d')
+    host, catelog = cities.GetCity(city).host, cities.CatelogUrl(city)
+    metrics.Start()
+    cities.UseCity(city)
+    conn = DbInitialize(city, incremental)
+    writer = BatchWriter(conn)
+    n_total = 0
+    seen = set()  # 相邻分片的价格边界可能重叠，按link去重
+
+    planned = shard_planner.PlanShards(FetchPage, workers=workers, catelog=catelog)
+    print('{:d} shards with {:d} pages planned'.format(len(planned), sum(p[1] for p in planned)))
+
+    for html in FetchConcurrently(shard_planner.ShardPages(planned, catelog), workers):
         if html is None:
             continue
 
-        for record in ParsePage(html):
+        with metrics.Timer('parse_seconds', doc='Page parsing time', page='summary'):
+            records = list(ParsePage(html, host=host))
+        metrics.Inc('records_total', len(records), doc='Records parsed from pages', page='summary')
+
+        for record in records:
+            if record['link'] in seen:
+                continue
+            seen.add(record['link'])
             n_total += 1
-            n_suc += RecordInsert(cur, record)
-        conn.commit()
-        time.sleep(random.uniform(1, 3))
+            RecordInsert(writer, record, snapshot, city)
+
+    writer.Close()
+    n_suc = writer.Count(InsertSql(city))
     print('Successfully inserting {:d} records with {:d} in total'.format(n_suc, n_total))
+
+    n_pending = conn.execute('SELECT COUNT(*) FROM `{city}` WHERE status = 0'.format(city=city)).fetchone()[0]
+    print('{:d} new or changed records queued for detail fetching'.format(n_pending))
+    metrics.Report('catelog_fetching')
     
     return None
 
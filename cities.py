@@ -0,0 +1,191 @@
+'''
+城市登记表：各城市的链家域名、房源编号前缀、高德查询使用的城市名及地铁线路数据来源。
+每个城市的数据写入独立的SQLite分片文件，不同城市的写入互不争用同一把数据库锁
+'''
+from collections import namedtuple
+import os
+import sqlite3
+
+DEFAULT_CITY = 'guangzhou'
+DEFAULT_DB = 'lianjia.db'   # 广州沿用原有的数据库文件
+SHARD_DIR = 'shards'        # 其余城市的分片文件目录
+
+# metro为地铁官网线路页面（与广州地铁车站服务页相同的结构），None表示暂无可用的数据来源
+City = namedtuple('City', ['name', 'host', 'code', 'amap_city', 'metro'])
+
+CITIES = {city.name: city for city in [
+    City('guangzhou', 'https://gz.lianjia.com', 'GZ', '广州', 'http://cs.gzmtr.com/ckfw/'),
+    City('beijing', 'https://bj.lianjia.com', 'BJ', '北京', None),
+    City('shanghai', 'https://sh.lianjia.com', 'SH', '上海', None),
+    City('shenzhen', 'https://sz.lianjia.com', 'SZ', '深圳', None),
+    City('hangzhou', 'https://hz.lianjia.com', 'HZ', '杭州', None),
+    City('nanjing', 'https://nj.lianjia.com', 'NJ', '南京', None),
+    City('suzhou', 'https://su.lianjia.com', 'SU', '苏州', None),
+    City('chengdu', 'https://cd.lianjia.com', 'CD', '成都', None),
+    City('chongqing', 'https://cq.lianjia.com', 'CQ', '重庆', None),
+    City('wuhan', 'https://wh.lianjia.com', 'WH', '武汉', None),
+    City('tianjin', 'https://tj.lianjia.com', 'TJ', '天津', None),
+    City('xian', 'https://xa.lianjia.com', 'XA', '西安', None),
+    City('foshan', 'https://fs.lianjia.com', 'FS', '佛山', None)
+    ]}
+
+
+def GetCity(name):
+
+    try:
+        return CITIES[name]
+    except KeyError:
+        raise ValueError('Unknown city: {:s}'.format(name))
+
+
+def CatelogUrl(name):
+
+    return GetCity(name).host + '/zufang/'
+
+
+def ShardPath(name, shard_dir=SHARD_DIR):
+    '''
+    城市对应的分片文件路径
+    '''
+    GetCity(name)
+    if name == DEFAULT_CITY:
+        return DEFAULT_DB
+
+    os.makedirs(shard_dir, exist_ok=True)
+    return os.path.join(shard_dir, '{:s}.db'.format(name))
+
+
+def CityPath(name, filename, shard_dir=SHARD_DIR):
+    '''
+    城市专用的辅助文件（缓存、指标摘要等）：广州沿用原有的文件，其余城市放在分片目录中
+    '''
+    GetCity(name)
+    if name == DEFAULT_CITY:
+        return filename
+
+    os.makedirs(shard_dir, exist_ok=True)
+    return os.path.join(shard_dir, '{:s}-{:s}'.format(name, filename))
+
+
+def UseCity(name):
+    '''
+    将本进程的失败记录、地理编码缓存、HTTP缓存及指标摘要切换到该城市自己的文件，
+    多个城市的进程之间不争用同一个数据库的写锁
+    '''
+    # 在函数内导入：http_client经throttle导入本模块
+    import failures
+    import geo_cache
+    import http_cache
+    import http_client
+    import metrics
+
+    failures.UseDb(ShardPath(name))
+    geo_cache.UseCache(CityPath(name, geo_cache.CACHE_PATH))
+    http_client.UseCacheDir(CityPath(name, http_cache.CACHE_DIR))
+    metrics.UseSummary(CityPath(name, metrics.SUMMARY_PATH))
+
+    return None
+
+
+def CacheQuery(name, query):
+    '''
+    地理编码缓存的键：不同城市可能有同名的行政区、小区或站点，键中加入城市名；
+    广州沿用原有的键，已缓存的结果继续有效
+    '''
+    if name == DEFAULT_CITY:
+        return query
+    return '{:s} {:s}'.format(GetCity(name).amap_city, query)
+
+
+# 跨城市视图：各分片中以城市名为前缀的表合并为一个视图，并加上City列
+VIEWS = {
+    'summary': '`{city}`',
+    'detail': '`{city}-detail`',
+    'community': '`{city}-community`',
+    'metro': '`{city}-metro`'
+    }
+
+
+def AttachShards(conn, names=None):
+    '''
+    将各城市的分片附加到conn，并建立临时视图all_summary、all_detail等供跨城市查询；
+    只附加已经存在的分片。同时附加的数量受SQLite的ATTACH上限（默认10个）限制，
+    超出上限的分片改为复制到临时表中，视图中仍包含全部城市
+    '''
+    names = [name for name in (names or CITIES) if os.path.exists(ShardPath(name))]
+    attached = {row[1] for row in conn.execute('PRAGMA database_list')}
+    free = conn.getlimit(sqlite3.SQLITE_LIMIT_ATTACHED) - len(attached - {'main', 'temp'})
+
+    sources = {}
+    for name in names:
+        if name not in attached and free > 0:
+            conn.execute('ATTACH DATABASE ? AS `{:s}`'.format(name), (ShardPath(name), ))
+            attached.add(name)
+            free -= 1
+        sources[name] = name if name in attached else None
+
+    copied = [name for name in names if sources[name] is None]
+    if copied:
+        print('ATTACH limit reached, copying shards into temp tables:', ', '.join(copied))
+
+    for view, table in VIEWS.items():
+        selects = []
+        for name in names:
+            table_name = table.format(city=name)
+            if sources[name] is None:
+                table_name = CopyShardTable(conn, name, table_name)
+                if table_name is not None:
+                    selects.append('SELECT \'{:s}\' AS City, * FROM temp.{:s}'.format(name, table_name))
+                continue
+            exists = conn.execute('SELECT 1 FROM `{:s}`.sqlite_master WHERE type = \'table\' AND name = ?'.format(name),
+                                  (table_name.strip('`'), )).fetchone()
+            if exists:
+                selects.append('SELECT \'{:s}\' AS City, * FROM `{:s}`.{:s}'.format(name, name, table_name))
+
+        conn.execute('DROP VIEW IF EXISTS temp.`all_{:s}`'.format(view))
+        if selects:
+            conn.execute('CREATE TEMP VIEW `all_{:s}` AS {:s}'.format(view, ' UNION ALL '.join(selects)))
+
+    return names
+
+
+def CopyShardTable(conn, name, table_name):
+    '''
+    将未能附加的分片中的一张表复制为conn中的临时表，返回临时表名，分片中没有该表时返回None
+    '''
+    copy_name = '`shard-{:s}`'.format(table_name.strip('`'))
+    shard = sqlite3.connect(ShardPath(name))
+    try:
+        exists = shard.execute('SELECT 1 FROM sqlite_master WHERE type = \'table\' AND name = ?',
+                               (table_name.strip('`'), )).fetchone()
+        if not exists:
+            return None
+        cursor = shard.execute('SELECT * FROM {:s}'.format(table_name))
+        columns = ', '.join('`{:s}`'.format(col[0]) for col in cursor.description)
+        conn.execute('DROP TABLE IF EXISTS temp.{:s}'.format(copy_name))
+        conn.execute('CREATE TEMP TABLE {:s} ({:s})'.format(copy_name, columns))
+        conn.executemany('INSERT INTO temp.{:s} VALUES ({:s})'.format(copy_name, ', '.join('?' * len(cursor.description))),
+                         cursor)
+    finally:
+        shard.close()
+
+    return copy_name
+
+
+def QueryCities(sql, names=None):
+    '''
+    在各城市分片上依次执行同一查询（表名以{city}表示），产出(城市, 结果行...)，
+    城市数较多时可代替AttachShards，避免复制超出ATTACH上限的分片
+    '''
+    for name in names or CITIES:
+        path = ShardPath(name)
+        if not os.path.exists(path):
+            continue
+        conn = sqlite3.connect(path)
+        try:
+            for row in conn.execute(sql.format(city=name)):
+                yield (name, ) + tuple(row)
+        finally:
+            conn.close()
+
+    return None
@@ -0,0 +1,83 @@
+'''
+多城市调度：每个城市在独立的进程中依次执行列表页、详情页、地理编码、地铁抓取及失败重试，
+多个城市并行。各城市写入自己的分片文件，进程之间不争用数据库写锁
+
+    python city_scheduler.py --cities guangzhou shenzhen beijing --processes 4
+'''
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import argparse
+import time
+import catelog_fetching
+import record_fetching
+import community_geo_fetching
+import metro_stations_fetching
+import retry_scheduler
+import throttle
+import cities
+
+PROCESSES = 4
+STAGES = ('catalog', 'detail', 'geocode', 'metro', 'retry')
+SHARED_HOSTS = ('restapi.amap.com', )  # 各城市共用同一个高德key，速率由各进程平分
+
+
+def ShareRates(processes):
+    '''
+    进程初始化：令牌桶按进程各自计数，共用的主机按进程数平分速率；
+    链家各城市的域名不同，每个城市同一时间只在一个进程中抓取，不需要平分
+    '''
+    for rates in (throttle.RATES, throttle.MAX_RATES):
+        for host in SHARED_HOSTS:
+            if host in rates:
+                rates[host] /= processes
+
+    return None
+
+
+def RunCity(city, stages=STAGES):
+
+    started = time.monotonic()
+    print('Crawling {:s}...'.format(city))
+
+    if 'catalog' in stages:
+        catelog_fetching.Main(city=city)
+    if 'detail' in stages:
+        record_fetching.Main(city=city)
+    if 'geocode' in stages:
+        community_geo_fetching.Main(city=city)
+    if 'metro' in stages:
+        metro_stations_fetching.Main(city=city)
+    if 'retry' in stages:
+        retry_scheduler.Main(city=city)
+
+    return time.monotonic() - started
+
+
+def Main(names=None, processes=PROCESSES, stages=STAGES):
+
+    names = names or list(cities.CITIES)
+    for name in names:
+        cities.GetCity(name)
+    processes = min(processes, len(names))
+
+    failed = []
+    with ProcessPoolExecutor(max_workers=processes, initializer=ShareRates, initargs=(processes, )) as executor:
+        futures = {executor.submit(RunCity, name, stages): name for name in names}
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                print('Finished {:s} in {:.1f}s'.format(name, future.result()))
+            except Exception as err:
+                print('Crawl for {:s} failed:'.format(name), err)
+                failed.append(name)
+
+    print('{:d} cities crawled, {:d} failed {}'.format(len(names) - len(failed), len(failed), failed))
+    return failed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--cities', nargs='+', choices=sorted(cities.CITIES))
+    parser.add_argument('--processes', type=int, default=PROCESSES)
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=STAGES)
+    args = parser.parse_args()
+    Main(args.cities, args.processes, args.stages)
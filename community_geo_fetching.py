@@ -1,13 +1,25 @@
-from urllib.parse import urlencode
-import random
+from urllib.parse import urlencode, urlsplit, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import os
 import sqlite3
-import time
-import requests
+import sys
+import tempfile
+import threading
 from requests.exceptions import Timeout, ConnectionError
 from mapkeys import GAODE_KEY
-
-GAODE_API = 'https://restapi.amap.com/v3/geocode/geo?'
+import http_client
+from user_agents import GetHeader
+import geo_cache
+import failures
+import throttle
+import metrics
+import cities
+
+GAODE_API = 'https://restapi.amap.com/v3/geocode/geo?'  # 可指向本地的模拟服务进行测试
 CITY = 'guangzhou'
+BATCH_SIZE = 10  # 批量地理编码每次最多10个地址
+RATE_LIMIT_CODES = ('10004', '10019', '10020', '10021')  # 访问过于频繁、并发超限等infocode
 
 def CommunityDbInitialize(conn, city=CITY):
 
@@ -33,19 +45,26 @@ def CommunityDbInitialize(conn, city=CITY):
     
     return None
 
+def CommunityInsertSql(city=CITY):
+
+    return '''
+           INSERT INTO `{city}-community`(
+               District, Community, Longitude, Latitude)
+           VALUES(
+               :District, :Community, :Longitude, :Latitude
+           )
+           ON CONFLICT(Community) DO UPDATE SET
+               Longitude = excluded.Longitude, Latitude = excluded.Latitude
+           WHERE excluded.Longitude IS NOT NULL
+           '''.format(city=city)
+
+
 def CommunityGeoInsert(conn, georecord, city=CITY):
 
     cur = conn.cursor()
-    sql = '''
-          INSERT OR IGNORE INTO `{city}-community`(
-              District, Community, Longitude, Latitude)
-          VALUES(
-              :District, :Community, :Longitude, :Latitude
-          )
-          '''.format(city=city)
 
     try:
-        cur.execute(sql, georecord)
+        cur.execute(CommunityInsertSql(city), georecord)
         num_suc = cur.rowcount
     except sqlite3.OperationalError as err:
         print('Insertion Error for Community {:s}:'.format(georecord['Community']), err)
@@ -58,10 +77,10 @@ def CommunityGeoInsert(conn, georecord, city=CITY):
 
 def ParamsPackaging(district, community, city=CITY, key=GAODE_KEY):
     '''
-    打包查询参数
+    打包查询参数，city为登记表中的城市，查询时使用对应的高德城市名
     '''
     query = urlencode([
-        ('city', city), 
+        ('city', cities.GetCity(city).amap_city), 
         ('key', key),
         ('address', ' '.join([district, community]))
         ], doseq=True)
@@ -70,127 +89,298 @@ def ParamsPackaging(district, community, city=CITY, key=GAODE_KEY):
     
     return url
 
-def GetHeader():
+def BatchParamsPackaging(pairs, city=CITY, key=GAODE_KEY):
+    '''
+    将多个(行政区, 小区)打包为一次批量查询，地址之间以|分隔
+    '''
+    addresses = [' '.join([district, community]).replace('|', ' ') for district, community in pairs]
+    query = urlencode([
+        ('city', cities.GetCity(city).amap_city),
+        ('key', key),
+        ('address', '|'.join(addresses)),
+        ('batch', 'true')
+        ])
+
+    return GAODE_API + query
+
+
+def ExtractLocation(result):
+    '''
+    从地理编码结果中取出首个匹配的经纬度
+    '''
+    longitude, latitude = result['geocodes'][0]['location'].split(',')
+    return float(longitude), float(latitude)
 
-    with open('user-agents.txt', 'r') as fhand:
-        agent = random.choice(fhand.read().split('\n'))
-    header = {
-        'User-Agent': agent,
-        'Host': 'restapi.amap.com'
-    }
-    return header
 
 def CommunityGeocoding(url):
     '''
     根据完成编码的URL利用地图API提取小区的经纬度，并作相应的异常处理
     '''
-    # 记录超时并返回None
+    # 超时继续抛出，不作为无结果缓存，由GetGeoRecord写入失败记录
     try:
-        r = requests.get(url, headers=GetHeader(), timeout=10)
+        r = http_client.Get(url, headers=GetHeader(url))
     except Timeout as terr:
         print('Timeout for: {:s}'.format(url), terr.args[0])  
-
-        with open('unsuccessful_geo_fetching.log', 'a+') as fhand:
-            fhand.write('Timeout:\n')
-            fhand.write(url)
-            fhand.write('\n')
-
-        return None
+        raise
     
     # 进行内容解析前先检查response状态
+    if http_client.IsReplayMiss(r):
+        raise http_client.ReplayMiss('Not in replay cache: {:s}'.format(url))
     if r.status_code != 200:
         raise ConnectionError('Connection response:', r.status_code)
         
-    # 记录解码异常并返回None
+    # 解码异常抛出ValueError
     try: 
         result = r.json()
-    except: 
+    except ValueError: 
         print('JSON decoding error for {:s}'.format(url))
-
-        with open('unsuccessful_geo_fetching.log', 'a+') as fhand:
-            fhand.write('JSON decoding error for:\n')
-            fhand.write(url)
-            fhand.write('\n')
-
-        return None
+        raise
         
-    # 进行经纬度提取前先检查结果状态
-    if result['status'] == 0:
+    # 进行经纬度提取前先检查结果状态，被限流时通知限速器减速
+    if str(result['status']) == '0':
+        if result.get('infocode') in RATE_LIMIT_CODES:
+            throttle.Backoff(url)
         raise ConnectionError('Unsuccessful response {:s}'.format(result['info']))
 
     try:
-        longitude, latitude = result['geocodes'][0]['location'].split(',')
-        return float(longitude), float(latitude)
-    except:
+        return ExtractLocation(result)
+    except (KeyError, IndexError, AttributeError, ValueError) as err:
+        # 查不到坐标，重试也不会有结果，直接记为dead
         print('Content error for {:s}'.format(url))
+        failures.Record('geocode', url, err, retry=False)
+        return None
 
-        with open('unsuccessful_geo_fetching.log', 'a+') as fhand:
-            fhand.write('Content error for:\n')
-            fhand.write(url)
-            fhand.write('\n')
 
-        return None
+def ExtractBatchLocations(result, num):
+    '''
+    批量结果与输入地址按顺序一一对应，查不到的地址返回None
+    '''
+    geocodes = result.get('geocodes') or []
+    if len(geocodes) != num:
+        raise ValueError('Expected {:d} geocodes, got {:d}'.format(num, len(geocodes)))
+
+    locations = []
+    for geocode in geocodes:
+        location = geocode.get('location')
+        if isinstance(location, str) and ',' in location:
+            longitude, latitude = location.split(',')
+            locations.append((float(longitude), float(latitude)))
+        else:
+            locations.append(None)
 
+    return locations
 
-def GetGeoRecord(district, community):
+
+def BatchCommunityGeocoding(pairs, city=CITY):
+    '''
+    批量查询多个小区的经纬度，网络或解析异常直接抛出，由调用方逐条重试
+    '''
+    url = BatchParamsPackaging(pairs, city)
+    r = http_client.Get(url, headers=GetHeader(url))
+
+    # 回放缓存中没有这一批时抛出，由调用方逐条查询，单条查询可能已经缓存
+    if http_client.IsReplayMiss(r):
+        raise http_client.ReplayMiss('Not in replay cache: {:s}'.format(url))
+    if r.status_code != 200:
+        raise ConnectionError('Connection response:', r.status_code)
+
+    result = r.json()
+    if str(result['status']) == '0':
+        if result.get('infocode') in RATE_LIMIT_CODES:
+            throttle.Backoff(url)
+        raise ConnectionError('Unsuccessful response {:s}'.format(result['info']))
+
+    return ExtractBatchLocations(result, len(pairs))
+
+
+def GetGeoRecords(pairs, city=CITY):
+    '''
+    批量版本的GetGeoRecord：先查缓存，未命中的小区每10个合并为一次请求，
+    批量结果中查不到的小区及整批失败时逐条重试
+    '''
+    cache = geo_cache.GetCache()
+    records = {}
+    pending = []
+
+    for district, community in pairs:
+        key = geo_cache.Normalize(cities.CacheQuery(city, ' '.join([district, community])))
+        location = cache.Get('geo', key)
+        metrics.Inc('geocode_cache_total', doc='Geocode cache lookups in batch mode',
+                    result='miss' if location is geo_cache.MISS else 'hit')
+        if location is geo_cache.MISS:
+            pending.append((district, community))
+        elif location is not None:
+            records[(district, community)] = {'District': district, 'Community': community,
+            'Longitude': location[0], 'Latitude': location[1]}
+
+    for i in range(0, len(pending), BATCH_SIZE):
+        batch = pending[i:i + BATCH_SIZE]
+        try:
+            locations = BatchCommunityGeocoding(batch, city)
+        except (ConnectionError, Timeout, ValueError, KeyError) as err:
+            print('Batch geocoding failed, retrying one by one:', err)
+            locations = [None] * len(batch)
+
+        for (district, community), location in zip(batch, locations):
+            if location is None:
+                continue
+            cache.Put('geo', geo_cache.Normalize(cities.CacheQuery(city, ' '.join([district, community]))), location)
+            records[(district, community)] = {'District': district, 'Community': community,
+            'Longitude': location[0], 'Latitude': location[1]}
+
+    # 逐条重试的结果（包括无结果）由GetGeoRecord写入缓存
+    return [records.get(pair) or GetGeoRecord(*pair, city=city) for pair in pairs]
+
+
+def GetGeoRecord(district, community, city=CITY):
     '''
     将提取的小区信息转化为数据库数据：(ID, 行政区, 小区, 经度, 纬度, 数据状态)
     '''
-    url = ParamsPackaging(district, community)
+    url = ParamsPackaging(district, community, city)
+    query = cities.CacheQuery(city, ' '.join([district, community]))
 
     try:
-        longitude, latitude = CommunityGeocoding(url)
+        # 同一查询优先读取缓存，查不到坐标的结果同样缓存
+        location = geo_cache.GetCache().Resolve('geo', query, lambda: CommunityGeocoding(url))
+
+    except (ConnectionError, ValueError, Timeout) as err:
+        location = None
 
-    except ConnectionError as cerr:
-        longitude, latitude = None, None
+        print('{:s}:'.format(type(err).__name__), err)
+        if not isinstance(err, http_client.ReplayMiss):
+            failures.Record('geocode', url, err, payload=[district, community, city])
 
-        print('Connection error:', cerr.args[0])
-        with open('unsuccessful_geo_fetching.log', 'a+') as fhand:
-            fhand.write('Connection error:', cerr.args[0], '\n')
-            fhand.write(url)
-            fhand.write('\n')
+    else:
+        failures.Resolve('geocode', url)
 
-    except TypeError:
-        longitude, latitude = None, None
+    longitude, latitude = location if location is not None else (None, None)
         
     return {'District': district, 'Community': community,
     'Longitude': longitude, 'Latitude': latitude}
 
 
-def Main(city=CITY):
+def Main(city=CITY, batch=True):
 
     num_suc, num_total = 0, 0
-    conn = sqlite3.connect('lianjia.db')
-    CommunityDbInitialize(conn)
+    metrics.Start()
+    cities.UseCity(city)
+    conn = sqlite3.connect(cities.ShardPath(city))
+    CommunityDbInitialize(conn, city)
 
     cur = conn.cursor()
-    extract_sql = 'SELECT DISTINCT District, Community FROM `{city}-detail`'.format(city=city)
-    check_sql = '''SELECT Longitude, Latitude FROM `{city}-community`
-                   WHERE (District=?) AND (Community=?)
-                '''.format(city=city)
-
-    for rec in cur.execute(extract_sql):
-        num_total += 1
-        check_result = conn.execute(check_sql, rec).fetchone()
-        
-        if check_result and (None not in check_result):
-            continue
-
-        community_georecord = GetGeoRecord(*rec)
-        num_suc += CommunityGeoInsert(conn, community_georecord)
-        time.sleep(random.uniform(0, 2))
-
-        if num_total % 20 == 0:
-            conn.commit()
-            print('Inserting {:d} geocoding records with {:d} succeeded'.format(num_total, num_suc))
+    # 一次查询取出尚无经纬度的小区，取代逐条检查
+    extract_sql = '''
+                  SELECT DISTINCT d.District, d.Community FROM `{city}-detail` AS d
+                  LEFT JOIN `{city}-community` AS c
+                  ON (c.District = d.District) AND (c.Community = d.Community)
+                  WHERE (c.Longitude IS NULL) OR (c.Latitude IS NULL)
+                  '''.format(city=city)
+
+    # 请求速率由throttle按主机控制，命中缓存的查询不再等待
+    pending = cur.execute(extract_sql).fetchall()
+    chunk = BATCH_SIZE if batch else 1
+
+    for i in range(0, len(pending), chunk):
+        with metrics.Timer('geocode_seconds', doc='Geocoding time per request unit',
+                           mode='batch' if batch else 'single'):
+            if batch:
+                community_georecords = GetGeoRecords(pending[i:i + chunk], city)
+            else:
+                community_georecords = [GetGeoRecord(*pending[i], city=city)]
+
+        for community_georecord in community_georecords:
+            num_total += 1
+            metrics.Inc('geocode_total', doc='Geocoded communities by outcome',
+                        result='no_result' if community_georecord['Longitude'] is None else 'located')
+            num_suc += CommunityGeoInsert(conn, community_georecord, city)
+
+            if num_total % 20 == 0:
+                conn.commit()
+                print('Inserting {:d} geocoding records with {:d} succeeded'.format(num_total, num_suc))
     
     conn.commit()
     print('Inserting {:d} geocoding records with {:d} succeeded'.format(num_total, num_suc))
 
     cur.close()
     conn.close()
+    metrics.Report('community_geo_fetching')
+
+    return None
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    '''
+    本地模拟的地理编码接口：地址中含“无”的查不到坐标，含“限流”的批量请求返回整数status的访问超限错误
+    '''
+    def do_GET(self):
+
+        params = parse_qs(urlsplit(self.path).query)
+        addresses = params['address'][0].split('|')
+
+        if params.get('batch') == ['true']:
+            if any('限流' in address for address in addresses):
+                result = {'status': 0, 'info': 'CUQPS_HAS_EXCEEDED_THE_LIMIT', 'infocode': '10020'}
+            else:
+                result = {'status': '1', 'info': 'OK', 'infocode': '10000',
+                          'geocodes': [{'location': [] if '无' in address else StubLocation(address)}
+                                       for address in addresses]}
+        else:
+            geocodes = [] if '无' in addresses[0] else [{'location': StubLocation(addresses[0])}]
+            result = {'status': '1', 'info': 'OK', 'infocode': '10000', 'count': str(len(geocodes)),
+                      'geocodes': geocodes}
+
+        body = json.dumps(result, ensure_ascii=False).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+
+        return None
+
+
+def StubLocation(address):
+
+    return '113.{:06d},23.100000'.format(len(address))
+
+
+def Check():
+    '''
+    对本地模拟接口检查批量查询、查不到坐标的小区，以及批量请求被限流时逐条查询的回退
+    '''
+    global GAODE_API
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    api = GAODE_API
+    GAODE_API = 'http://127.0.0.1:{:d}/v3/geocode/geo?'.format(server.server_address[1])
+
+    with tempfile.TemporaryDirectory() as tmp:
+        geo_cache.UseCache(os.path.join(tmp, 'geo_cache.db'))
+        failures.UseDb(os.path.join(tmp, 'failures.db'))
+        try:
+            records = GetGeoRecords([('天河', '花园'), ('天河', '无此小区')])
+            assert [record['Longitude'] for record in records] == [113.000005, None]
+
+            # 整数0的status同样视为失败，整批改为逐条查询
+            records = GetGeoRecords([('番禺', '限流小区'), ('番禺', '祈福新村')])
+            assert [record['Longitude'] for record in records] == [113.000007, 113.000007]
+            assert failures.GetLog().Summary() == {'geocode': {'dead': 1}}
+        finally:
+            GAODE_API = api
+            server.shutdown()
+            server.server_close()
+            geo_cache.GetCache().Close()
+            failures.GetLog().Close()
 
     return None
 
+
 if __name__ == '__main__':
-    Main()
+    if sys.argv[1:] == ['--check']:
+        Check()
+        print('Geocoding check passed')
+    else:
+        Main()
@@ -0,0 +1,192 @@
+'''
+GCJ-02与WGS-84坐标互转：标量版本取自两个notebook中的原实现，数组版本以NumPy对整列坐标一次完成转换
+'''
+from math import sin, cos, sqrt, fabs
+from math import pi
+import re
+import time
+import numpy as np
+
+#---------------------------------------------------#
+# 因地图坐标偏差加入辅助的转换函数
+# 作者：元凿坊工作室
+# 链接：https://zhuanlan.zhihu.com/p/107253611
+#--------------------------------------------------#
+
+# define ellipsoid
+a = 6378245
+f = 1 / 298.3
+b = a * (1 - f)
+ee = 1 - (b * b) / (a * a)
+
+TOLERANCE = 1e-6
+MAX_ITER = 100
+
+# check if the point in china
+def outOfChina(lng, lat):
+    return not (72.004 <= lng <= 137.8347 and 0.8293 <= lat <= 55.8271)
+
+
+def geohey_transformLat(x, y):
+    ret = -100.0 + 2.0 * x + 3.0 * y + 0.2 * y * y + 0.1 * x * y + 0.2 * sqrt(fabs(x))
+    ret = ret + (20.0 * sin(6.0 * x * pi) + 20.0 * sin(2.0 * x * pi)) * 2.0 / 3.0
+    ret = ret + (20.0 * sin(y * pi) + 40.0 * sin(y / 3.0 * pi)) * 2.0 / 3.0
+    ret = ret + (160.0 * sin(y / 12.0 * pi) + 320.0 * sin(y * pi / 30.0)) * 2.0 / 3.0
+    return ret
+
+
+def geohey_transformLon(x, y):
+    ret = 300.0 + x + 2.0 * y + 0.1 * x * x +  0.1 * x * y + 0.1 * sqrt(fabs(x))
+    ret = ret + (20.0 * sin(6.0 * x * pi) + 20.0 * sin(2.0 * x * pi)) * 2.0 / 3.0
+    ret = ret + (20.0 * sin(x * pi) + 40.0 * sin(x / 3.0 * pi)) * 2.0 / 3.0
+    ret = ret + (150.0 * sin(x / 12.0 * pi) + 300.0 * sin(x * pi / 30.0)) * 2.0 / 3.0
+    return ret
+
+
+def wgs2gcj(wgsLon, wgsLat):
+    if outOfChina(wgsLon, wgsLat):
+        return wgsLon, wgsLat
+    dLat = geohey_transformLat(wgsLon - 105.0, wgsLat - 35.0)
+    dLon = geohey_transformLon(wgsLon - 105.0, wgsLat - 35.0)
+    radLat = wgsLat / 180.0 * pi
+    magic = sin(radLat)
+    magic = 1 - ee * magic * magic
+    sqrtMagic = sqrt(magic)
+    dLat = (dLat * 180.0) / ((a * (1 - ee)) / (magic * sqrtMagic) * pi)
+    dLon = (dLon * 180.0) / (a / sqrtMagic * cos(radLat) * pi)
+    gcjLat = wgsLat + dLat
+    gcjLon = wgsLon + dLon
+    return (gcjLon, gcjLat)
+
+
+def gcj2wgs(gcjLon, gcjLat):
+    g0 = (gcjLon, gcjLat)
+    w0 = g0
+    g1 = wgs2gcj(w0[0], w0[1])
+    # w1 = w0 - (g1 - g0)
+    w1 = tuple([x[0]-(x[1]-x[2]) for x in zip(w0,g1,g0)])
+    # delta = w1 - w0
+    delta = tuple([x[0] - x[1] for x in zip(w1, w0)])
+    while (abs(delta[0]) >= 1e-6 or abs(delta[1]) >= 1e-6):
+        w0 = w1
+        g1 = wgs2gcj(w0[0], w0[1])
+        # w1 = w0 - (g1 - g0)
+        w1 = tuple([x[0]-(x[1]-x[2]) for x in zip(w0,g1,g0)])
+        # delta = w1 - w0
+        delta = tuple([x[0] - x[1] for x in zip(w1, w0)])
+    return w1
+
+
+def OutOfChinaArray(lng, lat):
+
+    return ~((72.004 <= lng) & (lng <= 137.8347) & (0.8293 <= lat) & (lat <= 55.8271))
+
+
+def TransformLatArray(x, y):
+
+    ret = -100.0 + 2.0 * x + 3.0 * y + 0.2 * y * y + 0.1 * x * y + 0.2 * np.sqrt(np.abs(x))
+    ret += (20.0 * np.sin(6.0 * x * pi) + 20.0 * np.sin(2.0 * x * pi)) * 2.0 / 3.0
+    ret += (20.0 * np.sin(y * pi) + 40.0 * np.sin(y / 3.0 * pi)) * 2.0 / 3.0
+    ret += (160.0 * np.sin(y / 12.0 * pi) + 320.0 * np.sin(y * pi / 30.0)) * 2.0 / 3.0
+    return ret
+
+
+def TransformLonArray(x, y):
+
+    ret = 300.0 + x + 2.0 * y + 0.1 * x * x + 0.1 * x * y + 0.1 * np.sqrt(np.abs(x))
+    ret += (20.0 * np.sin(6.0 * x * pi) + 20.0 * np.sin(2.0 * x * pi)) * 2.0 / 3.0
+    ret += (20.0 * np.sin(x * pi) + 40.0 * np.sin(x / 3.0 * pi)) * 2.0 / 3.0
+    ret += (150.0 * np.sin(x / 12.0 * pi) + 300.0 * np.sin(x * pi / 30.0)) * 2.0 / 3.0
+    return ret
+
+
+def Wgs2GcjArray(lng, lat):
+    '''
+    wgs2gcj的数组版本，返回(经度数组, 纬度数组)
+    '''
+    lng = np.asarray(lng, dtype=float)
+    lat = np.asarray(lat, dtype=float)
+
+    dLat = TransformLatArray(lng - 105.0, lat - 35.0)
+    dLon = TransformLonArray(lng - 105.0, lat - 35.0)
+    radLat = lat / 180.0 * pi
+    magic = 1 - ee * np.sin(radLat) ** 2
+    sqrtMagic = np.sqrt(magic)
+    dLat = (dLat * 180.0) / ((a * (1 - ee)) / (magic * sqrtMagic) * pi)
+    dLon = (dLon * 180.0) / (a / sqrtMagic * np.cos(radLat) * pi)
+
+    # 中国范围以外的坐标保持不变
+    outside = OutOfChinaArray(lng, lat)
+    return np.where(outside, lng, lng + dLon), np.where(outside, lat, lat + dLat)
+
+
+def Gcj2WgsArray(lng, lat, tolerance=TOLERANCE, max_iter=MAX_ITER):
+    '''
+    gcj2wgs的数组版本：对整列坐标做不动点迭代，每个坐标在收敛后即退出迭代，
+    结果与逐点调用gcj2wgs一致；缺失值(NaN)原样返回
+    '''
+    g_lng = np.asarray(lng, dtype=float)
+    g_lat = np.asarray(lat, dtype=float)
+    w_lng, w_lat = g_lng.copy(), g_lat.copy()
+    active = np.flatnonzero(~(np.isnan(g_lng) | np.isnan(g_lat)))
+
+    for _ in range(max_iter):
+        if active.size == 0:
+            break
+
+        w0_lng, w0_lat = w_lng[active], w_lat[active]
+        g1_lng, g1_lat = Wgs2GcjArray(w0_lng, w0_lat)
+        # w1 = w0 - (g1 - g0)
+        w1_lng = w0_lng - (g1_lng - g_lng[active])
+        w1_lat = w0_lat - (g1_lat - g_lat[active])
+        w_lng[active], w_lat[active] = w1_lng, w1_lat
+
+        # delta = w1 - w0，只保留尚未收敛的坐标
+        moving = (np.abs(w1_lng - w0_lng) >= tolerance) | (np.abs(w1_lat - w0_lat) >= tolerance)
+        active = active[moving]
+
+    return w_lng, w_lat
+
+
+def ParseDms(text):
+    '''
+    将notebook导出的DMS字符串（如"23 6m 16.3102s N, 113 15m 26.6968s E"）解析为(经度, 纬度)
+    '''
+    values = []
+    for deg, minute, sec, hemi in re.findall(r'([\d.]+) ([\d.]+)m ([\d.]+)s ([NSEW])', text):
+        value = float(deg) + float(minute) / 60 + float(sec) / 3600
+        values.append(-value if hemi in 'SW' else value)
+    lat, lng = values
+    return lng, lat
+
+
+def Main(path='houses.csv'):
+    '''
+    以houses.csv中的坐标对比逐点与数组版本的耗时，并检查两者误差
+    '''
+    import csv
+
+    with open(path, 'r', encoding='utf-8') as fhand:
+        points = [ParseDms(row['Geometry']) for row in csv.DictReader(fhand)]
+    gcj = [wgs2gcj(lng, lat) for lng, lat in points]
+    gcj_lng = np.array([p[0] for p in gcj])
+    gcj_lat = np.array([p[1] for p in gcj])
+
+    start = time.perf_counter()
+    scalar = [gcj2wgs(lng, lat) for lng, lat in gcj]
+    scalar_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    w_lng, w_lat = Gcj2WgsArray(gcj_lng, gcj_lat)
+    array_time = time.perf_counter() - start
+
+    error = max(np.max(np.abs(w_lng - [p[0] for p in scalar])), np.max(np.abs(w_lat - [p[1] for p in scalar])))
+    print('{:d} points: scalar {:.3f}s, array {:.3f}s ({:.1f}x), max difference {:.2e}'.format(
+        len(points), scalar_time, array_time, scalar_time / array_time, error))
+    assert error < TOLERANCE
+
+    return None
+
+
+if __name__ == '__main__':
+    Main()
@@ -0,0 +1,95 @@
+import sqlite3
+import time
+import metrics
+
+DB_PATH = 'lianjia.db'
+BATCH_SIZE = 200        # 缓冲行数达到该值时写入
+FLUSH_INTERVAL = 10     # 距上次写入超过该秒数时写入
+SYNCHRONOUS = 'NORMAL'  # WAL模式下NORMAL只在checkpoint时fsync
+CACHE_SIZE = -65536     # 负值单位为KiB，即64MB页缓存
+
+
+def ConnectDb(path=DB_PATH, synchronous=SYNCHRONOUS, cache_size=CACHE_SIZE):
+    '''
+    打开数据库并设置WAL日志及写入相关的pragma
+    '''
+    conn = sqlite3.connect(path)
+    conn.execute('PRAGMA journal_mode = WAL')
+    conn.execute('PRAGMA synchronous = {:s}'.format(synchronous))
+    conn.execute('PRAGMA cache_size = {:d}'.format(cache_size))
+
+    return conn
+
+
+class BatchWriter:
+    '''
+    缓冲写入：连续的同一SQL语句合并为一组参数，达到行数或时间阈值后在单个事务中按加入的顺序以executemany写入；
+    不同语句之间保持先后顺序，后加入的UPDATE不会先于同一记录的INSERT执行
+    '''
+
+    def __init__(self, conn, batch_size=BATCH_SIZE, interval=FLUSH_INTERVAL):
+
+        self.conn = conn
+        self.batch_size = batch_size
+        self.interval = interval
+        self.buffer = []    # [(sql, [params])]，相邻的同一语句合并
+        self.pending = 0
+        self.counts = {}    # sql -> 累计影响行数
+        self.stamp = time.monotonic()
+
+    def Add(self, sql, params):
+
+        if self.buffer and self.buffer[-1][0] == sql:
+            self.buffer[-1][1].append(params)
+        else:
+            self.buffer.append((sql, [params]))
+        self.pending += 1
+
+        if self.pending >= self.batch_size or time.monotonic() - self.stamp >= self.interval:
+            self.Flush()
+
+        return None
+
+    def Count(self, sql):
+
+        return self.counts.get(sql, 0)
+
+    def Flush(self):
+
+        if self.pending:
+            counts = {}
+            try:
+                with metrics.Timer('db_commit_seconds', doc='Duration of one batched write transaction'), self.conn:
+                    for sql, rows in self.buffer:
+                        counts[sql] = counts.get(sql, 0) + max(self.conn.executemany(sql, rows).rowcount, 0)
+                metrics.Inc('db_rows_total', self.pending, doc='Rows handed to the batch writer')
+                for sql, num in counts.items():
+                    self.counts[sql] = self.Count(sql) + num
+            except sqlite3.Error as err:
+                # 整批回滚后逐行重试，仅跳过出错的记录
+                print('Batch write error, retrying row by row:', err)
+                self.FlushRowByRow()
+
+        self.buffer = []
+        self.pending = 0
+        self.stamp = time.monotonic()
+
+        return None
+
+    def FlushRowByRow(self):
+
+        with self.conn:
+            for sql, rows in self.buffer:
+                for row in rows:
+                    try:
+                        cur = self.conn.execute(sql, row)
+                        self.counts[sql] = self.Count(sql) + max(cur.rowcount, 0)
+                    except sqlite3.Error as err:
+                        print('Write error for record:', row, err)
+
+        return None
+
+    def Close(self):
+
+        self.Flush()
+        return None
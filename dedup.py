@@ -0,0 +1,193 @@
+'''
+跨经纪人的重复房源识别：同一套房常由不同经纪人以略有不同的标题重复挂出，RecordDetailInsert只能按链家ID去重。
+先按(小区, 租赁方式, 面积取整, 楼层, 总楼层)分块，块内以标题与价格的MinHash签名做LSH分桶，只比较落入同一桶的房源，
+总计算量随房源数近似线性增长；结果以ClusterID写入`{city}-cluster`表，同一套房的各条记录ClusterID相同
+'''
+from itertools import groupby
+import re
+import sqlite3
+import sys
+import zlib
+import numpy as np
+import cities
+
+CITY = 'guangzhou'
+NUM_PERM = 32           # MinHash签名长度
+BANDS = 8               # LSH分段数，每段NUM_PERM // BANDS个值，相似度约0.6以上的记录大概率落入同一桶
+THRESHOLD = 0.6         # 签名估计的Jaccard相似度下限
+PRICE_TOLERANCE = 0.05  # 价格相差比例上限
+PRICE_STEP = 100        # 价格分档，作为额外的特征参与MinHash
+SHINGLE = 2             # 标题按字符2-gram切分
+PRIME = (1 << 31) - 1
+
+_rng = np.random.RandomState(20200501)  # 固定种子，各次运行的签名一致
+PERM_A = _rng.randint(1, PRIME, NUM_PERM).astype(np.int64)
+PERM_B = _rng.randint(0, PRIME, NUM_PERM).astype(np.int64)
+
+# 标题前的租赁方式（如“整租·”）已作为分块键，不再参与标题比较
+RENT_PREFIX = re.compile(r'^[^·]*·')
+PUNCTUATION = re.compile(r'[\W_]+')
+
+
+def ClusterDbInitialize(conn, city=CITY):
+
+    conn.executescript('''
+        CREATE TABLE IF NOT EXISTS `{city}-cluster` (
+        `ID` BIGINT NOT NULL PRIMARY KEY,
+        `ClusterID` BIGINT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS `{city}-cluster-id` ON `{city}-cluster` (`ClusterID`);
+        '''.format(city=city))
+
+    return None
+
+
+def NormalizeTitle(title):
+
+    title = RENT_PREFIX.sub('', title or '')
+    return PUNCTUATION.sub('', title).lower()
+
+
+def Tokens(title, price):
+    '''
+    标题的字符n-gram，加上价格所在及相邻的档位，价格接近的房源共享部分特征
+    '''
+    title = NormalizeTitle(title)
+    tokens = {title[i:i + SHINGLE] for i in range(max(1, len(title) - SHINGLE + 1))}
+    step = int(price // PRICE_STEP)
+    tokens.update('price:{:d}'.format(s) for s in (step - 1, step, step + 1))
+    return tokens
+
+
+def Signature(tokens):
+
+    x = np.array([zlib.crc32(t.encode('utf-8')) % PRIME for t in tokens], dtype=np.int64)
+    return ((PERM_A[:, None] * x[None, :] + PERM_B[:, None]) % PRIME).min(axis=1)
+
+
+def Find(parent, i):
+
+    while parent[i] != i:
+        parent[i] = parent[parent[i]]
+        i = parent[i]
+    return i
+
+
+def Similar(a, b, sigs, prices):
+
+    if np.mean(sigs[a] == sigs[b]) < THRESHOLD:
+        return False
+    return abs(prices[a] - prices[b]) <= PRICE_TOLERANCE * max(prices[a], prices[b])
+
+
+def ClusterBlock(block):
+    '''
+    对一个分块内的房源(ID, 标题, 价格)聚类，返回[(ID, ClusterID)]，ClusterID取簇内最小的ID
+    '''
+    ids = [row[0] for row in block]
+    if len(block) == 1:
+        return [(ids[0], ids[0])]
+
+    prices = [row[2] for row in block]
+    sigs = np.array([Signature(Tokens(row[1], row[2])) for row in block])
+    parent = list(range(len(block)))
+    rows = NUM_PERM // BANDS
+    compared = set()
+
+    for band in range(BANDS):
+        buckets = {}
+        for i, sig in enumerate(sigs[:, band * rows:(band + 1) * rows]):
+            buckets.setdefault(sig.tobytes(), []).append(i)
+
+        for members in buckets.values():
+            for n, a in enumerate(members):
+                for b in members[n + 1:]:
+                    if (a, b) in compared:
+                        continue
+                    compared.add((a, b))
+                    if Similar(a, b, sigs, prices):
+                        parent[Find(parent, b)] = Find(parent, a)
+
+    roots = {}
+    for i in range(len(block)):
+        root = Find(parent, i)
+        roots[root] = min(roots.get(root, ids[i]), ids[i])
+    return [(ids[i], roots[Find(parent, i)]) for i in range(len(block))]
+
+
+def BlockSql(city=CITY):
+    '''
+    详情记录及其在列表中最近一次出现的标题，按分块键排序以便逐块读取
+    '''
+    return '''
+           SELECT d.ID, d.Community, d.RentType, ROUND(d.Area), d.HouseFloor, d.BuldFloor, s.title, d.Price,
+           MAX(s.last_seen)
+           FROM `{city}-detail` AS d
+           JOIN `{city}` AS s ON s.houseid = d.ID
+           WHERE d.Price IS NOT NULL
+           GROUP BY d.ID
+           ORDER BY d.Community, d.RentType, ROUND(d.Area), d.HouseFloor, d.BuldFloor
+           '''.format(city=city)
+
+
+def Cluster(conn, city=CITY):
+    '''
+    逐块聚类，返回全部房源的[(ID, ClusterID)]；整租与合租的房源不在同一块中
+    '''
+    results = []
+    for _, block in groupby(conn.execute(BlockSql(city)), key=lambda row: row[1:6]):
+        results.extend(ClusterBlock([(row[0], row[6], row[7]) for row in block]))
+
+    return results
+
+
+def Check():
+    '''
+    检查标题略有不同的同一套房归为一簇，价格相差较大或租赁方式不同的房源不合并
+    '''
+    assert ClusterBlock([(1, '整租·天河花园 2室1厅 南', 3000)]) == [(1, 1)]
+    assert ClusterBlock([(1, '整租·天河花园 2室1厅 南', 3000), (2, '整租·天河花园 2室1厅 南北', 3050),
+                         (3, '整租·天河花园 2室1厅 南', 4000)]) == [(1, 1), (2, 1), (3, 3)]
+
+    conn = sqlite3.connect(':memory:')
+    conn.executescript('''
+        CREATE TABLE `check` (houseid BIGINT, title TEXT, last_seen TEXT);
+        CREATE TABLE `check-detail` (ID BIGINT, Community TEXT, RentType TEXT, Area NUMERIC,
+        HouseFloor TEXT, BuldFloor INT, Price INT);
+        ''')
+    rows = [(100, '整租', '整租·天河花园 2室1厅 南'), (101, '整租', '整租·天河花园 2室1厅 南'),
+            (102, '合租', '合租·天河花园 2室1厅 南')]
+    conn.executemany('INSERT INTO `check` VALUES (?, ?, \'2020-06-22\')', [(i, title) for i, _, title in rows])
+    conn.executemany('INSERT INTO `check-detail` VALUES (?, \'天河花园\', ?, 80, \'中楼层\', 20, 3000)',
+                     [(i, rent) for i, rent, _ in rows])
+    assert sorted(Cluster(conn, 'check')) == [(100, 100), (101, 100), (102, 102)]
+    conn.close()
+
+    return None
+
+
+def Main(city=CITY):
+
+    conn = sqlite3.connect(cities.ShardPath(city))
+    ClusterDbInitialize(conn, city)
+
+    results = Cluster(conn, city)
+
+    with conn:
+        conn.execute('DELETE FROM `{city}-cluster`'.format(city=city))
+        conn.executemany('INSERT INTO `{city}-cluster` VALUES (?, ?)'.format(city=city), results)
+
+    num_clusters = len({cluster for _, cluster in results})
+    print('{:d} listings in {:d} clusters, {:d} duplicates found'.format(
+        len(results), num_clusters, len(results) - num_clusters))
+    conn.close()
+
+    return None
+
+
+if __name__ == '__main__':
+    if sys.argv[1:] == ['--check']:
+        Check()
+        print('Dedup check passed')
+    else:
+        Main()
@@ -0,0 +1,295 @@
+'''
+协调进程/抓取进程模式：协调进程规划目录分片并将列表页、详情页和地理编码任务放入共享队列，
+抓取进程（可在多台机器上运行）租用任务、抓取并解析后将结果交回队列，
+lianjia.db只由协调进程写入：抓取失败经queue.Fail交回队列重试，解析及地理编码的失败记录随结果交回
+
+    python distributed_crawl.py coordinator --queue redis://host:6379/0 --city shenzhen
+    python distributed_crawl.py worker --processes 4 --queue redis://host:6379/0
+'''
+from multiprocessing import Process
+import argparse
+import os
+import socket
+import time
+from requests.exceptions import ConnectionError
+import catelog_fetching
+import record_fetching
+import community_geo_fetching
+import shard_planner
+import throttle
+import cities
+import failures
+from db_writer import BatchWriter
+from job_queue import OpenQueue, QUEUE_URL
+
+CITY = 'guangzhou'
+KINDS = ('summary', 'detail', 'geocode')
+POLL_INTERVAL = 2   # 队列为空时的轮询间隔
+IDLE_EXIT = 60      # 抓取进程空闲超过该秒数后退出，None表示一直等待
+
+
+def EnqueueCatalog(queue, writer, snapshot, seen, city=CITY):
+    '''
+    在协调进程中规划分片：各分片首页在规划时已经抓取，直接解析写入，其余页面作为任务入队
+    '''
+    num = 0
+    host, catelog = cities.GetCity(city).host, cities.CatelogUrl(city)
+    planned = shard_planner.PlanShards(catelog_fetching.FetchPage, catelog=catelog)
+
+    for url, html in shard_planner.ShardPages(planned, catelog):
+        if html is not None:
+            for record in catelog_fetching.ParsePage(html, host=host):
+                if record['link'] not in seen:
+                    seen.add(record['link'])
+                    catelog_fetching.RecordInsert(writer, record, snapshot, city)
+        elif queue.Put('summary', [url, city], key='summary:{:s}:{:s}'.format(snapshot, url)):
+            num += 1
+
+    print('{:d} shards planned, {:d} summary pages queued'.format(len(planned), num))
+    return num
+
+
+def EnqueueDetails(queue, conn, snapshot, city=CITY):
+    '''
+    将待处理的summary记录作为详情页任务入队，并标记为已认领
+    '''
+    recs = conn.execute('''
+        SELECT id, title, link, district, neighborhood, area, price, unit
+        FROM `{city}` WHERE status = 0
+        '''.format(city=city)).fetchall()
+
+    num = 0
+    for rec in recs:
+        if queue.Put('detail', [rec, city], key='detail:{:s}:{:s}'.format(snapshot, rec[2])):
+            num += 1
+
+    with conn:
+        conn.executemany('UPDATE `{city}` SET status = 2 WHERE id = ?'.format(city=city), [(rec[0], ) for rec in recs])
+
+    return num
+
+
+def EnqueueGeocode(queue, conn, snapshot, city=CITY):
+    '''
+    将尚无经纬度的小区作为地理编码任务入队，同一快照内每个小区只入队一次
+    '''
+    pairs = conn.execute('''
+        SELECT DISTINCT d.District, d.Community FROM `{city}-detail` AS d
+        LEFT JOIN `{city}-community` AS c
+        ON (c.District = d.District) AND (c.Community = d.Community)
+        WHERE (c.Longitude IS NULL) OR (c.Latitude IS NULL)
+        '''.format(city=city)).fetchall()
+
+    num = 0
+    for district, community in pairs:
+        if queue.Put('geocode', [district, community, city],
+                     key='geocode:{:s}:{:s}:{:s}|{:s}'.format(city, snapshot, district, community)):
+            num += 1
+
+    return num
+
+
+def HandleResult(conn, writer, job, result, snapshot, seen, city=CITY):
+    '''
+    协调进程写入抓取进程交回的结果
+    '''
+    if job.kind == 'summary':
+        for record in result:
+            if record['link'] not in seen:
+                seen.add(record['link'])
+                catelog_fetching.RecordInsert(writer, record, snapshot, city)
+
+    elif job.kind == 'detail':
+        if 'invalid' in result:
+            record_fetching.InvalidMark(writer, sid=result['sid'], city=city)
+        else:
+            record_fetching.RecordDetailInsert(writer, result['detail'], city)
+            record_fetching.StatusUpdate(writer, rid=result['detail']['HouseID'], sid=result['sid'], city=city)
+
+    elif job.kind == 'geocode':
+        community_geo_fetching.CommunityGeoInsert(conn, result, city)
+
+    return None
+
+
+def Coordinator(queue, city=CITY, poll=POLL_INTERVAL):
+
+    snapshot = time.strftime('%Y-%m-%d')
+    cities.UseCity(city)
+    conn = catelog_fetching.DbInitialize(city)
+    record_fetching.RecordDbInitialize(conn, city)
+    community_geo_fetching.CommunityDbInitialize(conn, city)
+    writer = BatchWriter(conn)
+    seen = set()
+
+    EnqueueCatalog(queue, writer, snapshot, seen, city)
+
+    while True:
+        num_reclaimed = queue.Reclaim()
+        if num_reclaimed:
+            print('{:d} expired leases reclaimed'.format(num_reclaimed))
+
+        results = queue.Results()
+        for job, result in results:
+            failures.Replay(result['failures'])
+            HandleResult(conn, writer, job, result['result'], snapshot, seen, city)
+        writer.Flush()
+        conn.commit()
+
+        if results:
+            continue
+
+        # 结果处理完毕后再入队下游任务，使详情页和小区都来自已写入的数据
+        num_new = EnqueueDetails(queue, conn, snapshot, city) + EnqueueGeocode(queue, conn, snapshot, city)
+        stats = queue.Stats()
+        print('Queue status:', stats)
+
+        if not num_new and not any(stats.get(state) for state in ('ready', 'leased', 'done')):
+            break
+        time.sleep(poll)
+
+    writer.Close()
+    conn.close()
+    print('All jobs finished:', queue.Stats())
+
+    return None
+
+
+def SummaryJob(payload):
+
+    url, city = payload
+    html = catelog_fetching.RequestPage(url)
+    if html is None:
+        raise ConnectionError('Unable to fetch summary page')
+
+    return list(catelog_fetching.ParsePage(html, host=cities.GetCity(city).host))
+
+
+def DetailJob(payload):
+
+    rec, city = payload
+    html = None
+    if not record_fetching.IsThirdParty(rec[2]):
+        html = record_fetching.RequestPage(rec[2])
+        if html is None:
+            raise ConnectionError('Unable to fetch detail page')
+
+    try:
+        detail = record_fetching.GetOneDetail(rec[1:], html, city)
+    except ValueError as verr:  # 第三方及非本城市的房源，由协调进程标记为无效
+        return {'sid': rec[0], 'invalid': verr.args[0]}
+
+    return {'sid': rec[0], 'detail': detail}
+
+
+def GeocodeJobs(queue, first, name, buffer):
+    '''
+    地理编码任务每次最多合并BATCH_SIZE个小区为一次批量请求，按任务中的城市分组查询；
+    一组的失败记录随该组第一个任务的结果交回
+    '''
+    jobs = [first]
+    while len(jobs) < community_geo_fetching.BATCH_SIZE:
+        job = queue.Lease(['geocode'], name)
+        if job is None:
+            break
+        jobs.append(job)
+
+    groups = {}
+    for job in jobs:
+        groups.setdefault(job.payload[2], []).append(job)
+
+    for city, group in groups.items():
+        try:
+            records = community_geo_fetching.GetGeoRecords([tuple(job.payload[:2]) for job in group], city)
+        except Exception as err:
+            buffer.Drain()
+            for job in group:
+                queue.Fail(job, '{:s}: {}'.format(type(err).__name__, err))
+            continue
+
+        entries = buffer.Drain()
+        for job, record in zip(group, records):
+            queue.Ack(job, {'result': record, 'failures': entries})
+            entries = []
+
+    return None
+
+
+def Worker(queue, name, kinds=KINDS, poll=POLL_INTERVAL, idle_exit=IDLE_EXIT):
+
+    handlers = {'summary': SummaryJob, 'detail': DetailJob}
+    buffer = failures.UseBuffer()
+    idle_since = time.monotonic()
+
+    while True:
+        job = queue.Lease(kinds, name)
+
+        if job is None:
+            if idle_exit is not None and time.monotonic() - idle_since > idle_exit:
+                break
+            time.sleep(poll)
+            continue
+
+        idle_since = time.monotonic()
+        buffer.Drain()  # 丢弃上一个失败任务留下的记录，该任务由队列重试
+        if job.kind == 'geocode':
+            GeocodeJobs(queue, job, name, buffer)
+            continue
+
+        try:
+            result = handlers[job.kind](job.payload)
+            queue.Ack(job, {'result': result, 'failures': buffer.Drain()})
+        except Exception as err:
+            print('Job {:d} ({:s}) failed:'.format(job.id, job.kind), err)
+            queue.Fail(job, '{:s}: {}'.format(type(err).__name__, err))
+
+    print('Worker {:s} idle, exiting'.format(name))
+    return None
+
+
+def RunWorker(queue_url, name, processes=1):
+    '''
+    抓取进程入口：令牌桶按进程各自计数，本机的多个进程平分各主机的请求速率
+    '''
+    for rates in (throttle.RATES, throttle.MAX_RATES):
+        for host in rates:
+            rates[host] /= processes
+
+    queue = OpenQueue(queue_url)
+    try:
+        Worker(queue, name)
+    finally:
+        queue.Close()
+
+    return None
+
+
+def Main(role, queue_url=QUEUE_URL, processes=1, city=CITY):
+
+    if role == 'coordinator':
+        queue = OpenQueue(queue_url)
+        try:
+            Coordinator(queue, city)
+        finally:
+            queue.Close()
+        return None
+
+    prefix = '{:s}-{:d}'.format(socket.gethostname(), os.getpid())
+    workers = [Process(target=RunWorker, args=(queue_url, '{:s}-{:d}'.format(prefix, i), processes))
+               for i in range(processes)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    return None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('role', choices=['coordinator', 'worker'])
+    parser.add_argument('--queue', default=QUEUE_URL)
+    parser.add_argument('--processes', type=int, default=1)
+    parser.add_argument('--city', default=CITY, choices=sorted(cities.CITIES), help='协调进程抓取的城市')
+    args = parser.parse_args()
+    Main(args.role, args.queue, args.processes, args.city)
@@ -0,0 +1,259 @@
+'''
+抓取失败记录：取代原先各阶段追加写入的unsuccessful_*.log。每条失败按(阶段, url)记录错误类型、
+失败次数及下次可重试的时间，重试间隔按指数退避并加入随机抖动，超过次数上限后转入dead状态
+'''
+import json
+import random
+import sqlite3
+import threading
+import time
+import metrics
+
+DB_PATH = 'lianjia.db'
+BASE_DELAY = 60             # 首次失败后的重试间隔（秒）
+MAX_DELAY = 6 * 3600        # 重试间隔上限
+MAX_ATTEMPTS = 5            # 失败达到该次数后不再重试
+# state：pending 等待重试，dead 不再重试，resolved 已重试成功
+
+
+def RetryDelay(attempts, base=BASE_DELAY, cap=MAX_DELAY):
+    '''
+    指数退避，在[delay / 2, delay]之间随机取值，避免同一时间失败的任务同时重试
+    '''
+    delay = min(cap, base * 2 ** (attempts - 1))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+class FailureLog:
+
+    def __init__(self, path=DB_PATH, max_attempts=MAX_ATTEMPTS):
+
+        self.path = path
+        self.max_attempts = max_attempts
+        self.lock = threading.Lock()
+        self.pending = set()    # 待重试的(stage, url)，成功时只需更新其中的记录
+
+        # 各抓取线程共用一个连接，由锁串行化
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.conn.executescript('''
+            CREATE TABLE IF NOT EXISTS `failures` (
+            `id` INTEGER PRIMARY KEY AUTOINCREMENT,
+            `stage` VARCHAR(16) NOT NULL,
+            `url` TEXT NOT NULL,
+            `error` VARCHAR(32) NOT NULL,
+            `message` TEXT,
+            `payload` TEXT,
+            `attempts` INTEGER DEFAULT 1 NOT NULL,
+            `state` VARCHAR(8) DEFAULT 'pending' NOT NULL,
+            `first_failed` REAL NOT NULL,
+            `last_failed` REAL NOT NULL,
+            `next_attempt` REAL,
+            UNIQUE (`stage`, `url`)
+            );
+            CREATE INDEX IF NOT EXISTS `failures-due` ON `failures` (`stage`, `next_attempt`) WHERE `state` = 'pending';
+            ''')
+        self.pending.update(self.conn.execute("SELECT stage, url FROM `failures` WHERE state = 'pending'").fetchall())
+
+    def Record(self, stage, url, err, payload=None, retry=True, message=None):
+        '''
+        记录一次失败；retry为False的错误（如解析错误）直接转入dead状态
+        '''
+        now = time.time()
+        error = type(err).__name__ if isinstance(err, BaseException) else str(err)
+        message = str(err) if message is None else message
+        payload = None if payload is None else json.dumps(payload, ensure_ascii=False)
+
+        with self.lock, self.conn:
+            row = self.conn.execute('SELECT attempts, state FROM `failures` WHERE stage = ? AND url = ?',
+                                    (stage, url)).fetchone()
+            # 已重试成功的记录再次失败时重新计数
+            attempts = 1 if row is None or row[1] == 'resolved' else row[0] + 1
+            dead = not retry or attempts >= self.max_attempts
+            state = 'dead' if dead else 'pending'
+            next_attempt = None if dead else now + RetryDelay(attempts)
+
+            self.conn.execute('''
+                INSERT INTO `failures`
+                (stage, url, error, message, payload, attempts, state, first_failed, last_failed, next_attempt)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(stage, url) DO UPDATE SET
+                    error = excluded.error, message = excluded.message,
+                    payload = COALESCE(excluded.payload, payload), attempts = excluded.attempts,
+                    state = excluded.state, last_failed = excluded.last_failed,
+                    next_attempt = excluded.next_attempt
+                ''', (stage, url, error, message, payload, attempts, state, now, now, next_attempt))
+
+            metrics.Inc('failures_total', doc='Recorded failures by stage', stage=stage, error=error)
+            if dead:
+                self.pending.discard((stage, url))
+            else:
+                self.pending.add((stage, url))
+
+        return state
+
+    def Resolve(self, stage, url):
+        '''
+        重试成功后标记为resolved
+        '''
+        if (stage, url) not in self.pending:
+            return None
+
+        with self.lock, self.conn:
+            self.pending.discard((stage, url))
+            self.conn.execute('''
+                UPDATE `failures` SET state = 'resolved', next_attempt = NULL
+                WHERE stage = ? AND url = ? AND state = 'pending'
+                ''', (stage, url))
+        return None
+
+    def Due(self, stage, limit=None):
+        '''
+        返回已到重试时间的(url, payload)
+        '''
+        with self.lock:
+            rows = self.conn.execute('''
+                SELECT url, payload FROM `failures`
+                WHERE stage = ? AND state = 'pending' AND next_attempt <= ?
+                ORDER BY next_attempt LIMIT ?
+                ''', (stage, time.time(), -1 if limit is None else limit)).fetchall()
+
+        return [(url, None if payload is None else json.loads(payload)) for url, payload in rows]
+
+    def Pending(self, stage):
+        '''
+        返回全部待重试的(url, payload, next_attempt)，包括尚未到期的记录
+        '''
+        with self.lock:
+            rows = self.conn.execute('''
+                SELECT url, payload, next_attempt FROM `failures`
+                WHERE stage = ? AND state = 'pending'
+                ''', (stage, )).fetchall()
+
+        return [(url, None if payload is None else json.loads(payload), due) for url, payload, due in rows]
+
+    def NextDue(self):
+        '''
+        最近一次待重试的时间，没有待重试的记录时返回None
+        '''
+        with self.lock:
+            return self.conn.execute("SELECT MIN(next_attempt) FROM `failures` WHERE state = 'pending'").fetchone()[0]
+
+    def Summary(self):
+
+        with self.lock:
+            rows = self.conn.execute('SELECT stage, state, COUNT(*) FROM `failures` GROUP BY stage, state').fetchall()
+
+        summary = {}
+        for stage, state, num in rows:
+            summary.setdefault(stage, {})[state] = num
+        return summary
+
+    def Close(self):
+
+        with self.lock:
+            self.conn.close()
+        return None
+
+
+class FailureBuffer:
+    '''
+    分布式抓取进程中代替FailureLog：失败记录暂存在内存中，随任务结果交回协调进程写入
+    '''
+    path = None
+
+    def __init__(self):
+
+        self.lock = threading.Lock()
+        self.entries = []
+
+    def Record(self, stage, url, err, payload=None, retry=True):
+
+        error = type(err).__name__ if isinstance(err, BaseException) else str(err)
+        with self.lock:
+            self.entries.append(['record', stage, url, error, str(err), payload, retry])
+        return 'pending' if retry else 'dead'
+
+    def Resolve(self, stage, url):
+
+        with self.lock:
+            self.entries.append(['resolve', stage, url])
+        return None
+
+    def Drain(self):
+        '''
+        取出暂存的记录并清空
+        '''
+        with self.lock:
+            entries, self.entries = self.entries, []
+        return entries
+
+    def Close(self):
+
+        return None
+
+
+_log = None
+_log_lock = threading.Lock()
+
+def GetLog():
+
+    global _log
+
+    with _log_lock:
+        if _log is None:
+            _log = FailureLog()
+        return _log
+
+
+def UseDb(path):
+    '''
+    切换失败记录所在的数据库：各城市的失败记录写入该城市自己的分片，不与其他城市的进程争用写锁
+    '''
+    global _log
+
+    with _log_lock:
+        if _log is not None and _log.path != path:
+            _log.Close()
+            _log = None
+        if _log is None:
+            _log = FailureLog(path)
+        return _log
+
+
+def UseBuffer():
+    '''
+    抓取进程不写本地数据库，失败记录由FailureBuffer暂存
+    '''
+    global _log
+
+    with _log_lock:
+        if not isinstance(_log, FailureBuffer):
+            if _log is not None:
+                _log.Close()
+            _log = FailureBuffer()
+        return _log
+
+
+def Replay(entries):
+    '''
+    在协调进程中写入抓取进程交回的失败记录
+    '''
+    log = GetLog()
+    for entry in entries:
+        if entry[0] == 'resolve':
+            log.Resolve(*entry[1:])
+        else:
+            stage, url, error, message, payload, retry = entry[1:]
+            log.Record(stage, url, error, payload, retry, message=message)
+
+    return None
+
+
+def Record(stage, url, err, payload=None, retry=True):
+
+    return GetLog().Record(stage, url, err, payload, retry)
+
+
+def Resolve(stage, url):
+
+    return GetLog().Resolve(stage, url)
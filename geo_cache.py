@@ -0,0 +1,142 @@
+'''
+地理编码结果的持久化缓存：以规范化后的查询字符串为键，查不到结果的查询同样缓存（有效期较短），
+同一查询的并发请求只发出一次。
+'''
+from concurrent.futures import Future
+import json
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+
+CACHE_PATH = 'geo_cache.db'
+TTL = 90 * 24 * 3600            # 命中结果的有效期
+NEGATIVE_TTL = 3 * 24 * 3600    # 无结果查询的有效期
+
+MISS = object()
+
+
+def Normalize(query):
+    '''
+    全角转半角、去除多余空白并统一大小写
+    '''
+    query = unicodedata.normalize('NFKC', query)
+    return re.sub(r'\s+', ' ', query).strip().lower()
+
+
+class GeoCache:
+
+    def __init__(self, path=CACHE_PATH, ttl=TTL, negative_ttl=NEGATIVE_TTL):
+
+        self.path = path
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.lock = threading.Lock()
+        self.inflight = {}
+
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.conn.executescript('''
+            PRAGMA journal_mode = WAL;
+            CREATE TABLE IF NOT EXISTS `geocode` (
+            `namespace` VARCHAR(16) NOT NULL,
+            `query` TEXT NOT NULL,
+            `result` TEXT,
+            `expires_at` REAL NOT NULL,
+            PRIMARY KEY (`namespace`, `query`)
+            );
+            ''')
+
+    def Get(self, namespace, key):
+
+        # 缓存只是优化，数据库被锁定时按未命中处理，不中断抓取
+        try:
+            with self.lock:
+                row = self.conn.execute(
+                    'SELECT result, expires_at FROM `geocode` WHERE namespace = ? AND query = ?',
+                    (namespace, key)).fetchone()
+        except sqlite3.OperationalError as err:
+            print('Geocode cache unavailable:', err)
+            return MISS
+
+        if row is None or row[1] < time.time():
+            return MISS
+        return None if row[0] is None else json.loads(row[0])
+
+    def Put(self, namespace, key, result):
+
+        ttl = self.negative_ttl if result is None else self.ttl
+        value = None if result is None else json.dumps(result, ensure_ascii=False)
+
+        try:
+            with self.lock, self.conn:
+                self.conn.execute('INSERT OR REPLACE INTO `geocode` VALUES (?, ?, ?, ?)',
+                                  (namespace, key, value, time.time() + ttl))
+        except sqlite3.OperationalError as err:
+            print('Geocode cache not updated:', err)
+        return None
+
+    def Resolve(self, namespace, query, resolve):
+        '''
+        命中缓存直接返回；否则调用resolve()，返回None视为无结果并缓存，抛出的异常不缓存。
+        同一键的并发调用等待第一次调用的结果
+        '''
+        key = Normalize(query)
+        result = self.Get(namespace, key)
+        if result is not MISS:
+            return result
+
+        with self.lock:
+            future = self.inflight.get((namespace, key))
+            owner = future is None
+            if owner:
+                future = self.inflight[(namespace, key)] = Future()
+
+        if not owner:
+            return future.result()
+
+        try:
+            result = resolve()
+            self.Put(namespace, key, result)
+            future.set_result(result)
+            return result
+        except Exception as err:
+            future.set_exception(err)
+            raise
+        finally:
+            with self.lock:
+                del self.inflight[(namespace, key)]
+
+    def Close(self):
+
+        with self.lock:
+            self.conn.close()
+        return None
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+def GetCache():
+
+    global _cache
+
+    with _cache_lock:
+        if _cache is None:
+            _cache = GeoCache()
+        return _cache
+
+
+def UseCache(path):
+    '''
+    切换缓存文件：各城市使用自己的缓存，多城市并行时不争用同一个数据库的写锁
+    '''
+    global _cache
+
+    with _cache_lock:
+        if _cache is not None and _cache.path != path:
+            _cache.Close()
+            _cache = None
+        if _cache is None:
+            _cache = GeoCache(path)
+        return _cache
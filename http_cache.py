@@ -0,0 +1,211 @@
+'''
+抓取请求的本地缓存：响应正文按内容哈希压缩存放，SQLite索引按(URL, 抓取日期)记录。
+支持过期时间、按容量的LRU淘汰、ETag/Last-Modified条件请求，以及不联网的回放模式。
+'''
+from datetime import date
+import hashlib
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import zlib
+
+CACHE_DIR = 'http_cache'
+TTL = 7 * 24 * 3600             # 超过该秒数的缓存需重新验证
+MAX_BYTES = 2 * 1024 ** 3       # 压缩后正文的总容量上限
+
+
+class CachedResponse:
+    '''
+    与requests.Response接口相同的缓存响应
+    '''
+
+    def __init__(self, url, content, encoding='utf-8', status_code=200, headers=None, replay_miss=False):
+
+        self.url = url
+        self.content = content
+        self.encoding = encoding
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.from_cache = True
+        self.replay_miss = replay_miss  # 回放模式下未命中的合成响应，不是真实的抓取失败
+
+    @property
+    def text(self):
+
+        return self.content.decode(self.encoding or 'utf-8', errors='replace')
+
+    def json(self):
+
+        return json.loads(self.text)
+
+
+class HttpCache:
+
+    def __init__(self, cache_dir=CACHE_DIR, ttl=TTL, max_bytes=MAX_BYTES, replay=False):
+
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.replay = replay
+        self.lock = threading.Lock()
+
+        os.makedirs(os.path.join(cache_dir, 'blobs'), exist_ok=True)
+        self.conn = sqlite3.connect(os.path.join(cache_dir, 'index.db'), timeout=30, check_same_thread=False)
+        self.conn.executescript('''
+            PRAGMA journal_mode = WAL;
+            CREATE TABLE IF NOT EXISTS `responses` (
+            `url` TEXT NOT NULL,
+            `fetch_date` CHAR(10) NOT NULL,
+            `digest` CHAR(40) NOT NULL,
+            `encoding` VARCHAR(16),
+            `etag` TEXT,
+            `last_modified` TEXT,
+            `stored_at` REAL NOT NULL,
+            `accessed_at` REAL NOT NULL,
+            PRIMARY KEY (`url`, `fetch_date`)
+            );
+            CREATE TABLE IF NOT EXISTS `blobs` (
+            `digest` CHAR(40) PRIMARY KEY,
+            `size` INTEGER NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS `responses-accessed` ON `responses` (`accessed_at`);
+            CREATE INDEX IF NOT EXISTS `responses-digest` ON `responses` (`digest`);
+            ''')
+
+    def BlobPath(self, digest):
+
+        return os.path.join(self.cache_dir, 'blobs', digest[:2], digest[2:])
+
+    def Lookup(self, url, fetch_date=None):
+        '''
+        返回URL最近一次（或指定日期）的缓存记录
+        '''
+        sql = '''
+              SELECT url, fetch_date, digest, encoding, etag, last_modified, stored_at
+              FROM `responses` WHERE url = ? {:s}
+              ORDER BY fetch_date DESC LIMIT 1
+              '''.format('AND fetch_date = ?' if fetch_date else '')
+        params = (url, fetch_date) if fetch_date else (url, )
+
+        with self.lock:
+            return self.conn.execute(sql, params).fetchone()
+
+    def Load(self, entry):
+
+        url, fetch_date, digest, encoding = entry[:4]
+        try:
+            with open(self.BlobPath(digest), 'rb') as fhand:
+                content = zlib.decompress(fhand.read())
+        except (OSError, zlib.error):
+            return None
+
+        with self.lock, self.conn:
+            self.conn.execute('UPDATE `responses` SET accessed_at = ? WHERE url = ? AND fetch_date = ?',
+                              (time.time(), url, fetch_date))
+
+        return CachedResponse(url, content, encoding)
+
+    def Store(self, url, response):
+
+        content = response.content
+        digest = hashlib.sha1(content).hexdigest()
+        path = self.BlobPath(digest)
+
+        # 相同内容只保存一份；各线程写入各自的临时文件后原子替换，同时保存相同内容时互不影响
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'wb') as fhand:
+                    fhand.write(zlib.compress(content))
+                os.replace(tmp_path, path)
+            except OSError:
+                os.remove(tmp_path)
+                raise
+
+        now = time.time()
+        with self.lock, self.conn:
+            self.conn.execute('INSERT OR IGNORE INTO `blobs` (digest, size) VALUES (?, ?)',
+                              (digest, os.path.getsize(path)))
+            self.conn.execute(
+                'INSERT OR REPLACE INTO `responses` VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (url, date.today().isoformat(), digest, response.encoding,
+                 response.headers.get('ETag'), response.headers.get('Last-Modified'), now, now))
+
+        self.Evict()
+        return None
+
+    def Refresh(self, entry):
+
+        with self.lock, self.conn:
+            self.conn.execute('UPDATE `responses` SET stored_at = ? WHERE url = ? AND fetch_date = ?',
+                              (time.time(), entry[0], entry[1]))
+        return None
+
+    def Evict(self):
+        '''
+        总容量超过上限时按最近访问时间淘汰，并删除不再被引用的正文
+        '''
+        with self.lock, self.conn:
+            total = self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM `blobs`').fetchone()[0]
+            if total <= self.max_bytes:
+                return None
+
+            for url, fetch_date, digest, size in self.conn.execute('''
+                    SELECT r.url, r.fetch_date, r.digest, b.size
+                    FROM `responses` AS r JOIN `blobs` AS b ON r.digest = b.digest
+                    ORDER BY r.accessed_at
+                    ''').fetchall():
+                self.conn.execute('DELETE FROM `responses` WHERE url = ? AND fetch_date = ?', (url, fetch_date))
+                if self.conn.execute('SELECT 1 FROM `responses` WHERE digest = ? LIMIT 1', (digest, )).fetchone():
+                    continue
+
+                self.conn.execute('DELETE FROM `blobs` WHERE digest = ?', (digest, ))
+                try:
+                    os.remove(self.BlobPath(digest))
+                except OSError:
+                    pass
+                total -= size
+                if total <= self.max_bytes:
+                    break
+
+        return None
+
+    def Get(self, url, headers, timeout, fetch, fetch_date=None):
+        '''
+        带缓存的GET：未过期直接返回，过期则发条件请求，回放模式下从不联网
+        '''
+        entry = self.Lookup(url, fetch_date)
+        cached = self.Load(entry) if entry else None
+
+        if self.replay:
+            # 与HTTP缓存的only-if-cached一致，未命中时返回504
+            return cached or CachedResponse(url, b'', status_code=504, replay_miss=True)
+
+        if cached and time.time() - entry[6] < self.ttl:
+            return cached
+
+        headers = dict(headers or {})
+        if cached and entry[4]:
+            headers['If-None-Match'] = entry[4]
+        if cached and entry[5]:
+            headers['If-Modified-Since'] = entry[5]
+
+        r = fetch(url, headers=headers, timeout=timeout)
+
+        if r.status_code == 304 and cached:
+            self.Refresh(entry)
+            return cached
+        if r.status_code == 200:
+            self.Store(url, r)
+
+        return r
+
+    def Close(self):
+
+        with self.lock:
+            self.conn.close()
+        return None
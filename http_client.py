@@ -0,0 +1,154 @@
+from urllib.parse import urlsplit
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from requests.exceptions import Timeout, ConnectionError
+from http_cache import HttpCache, CACHE_DIR
+from throttle import Throttle, Feedback
+import metrics
+
+try:
+    import httpx  # 可选依赖，仅在启用HTTP/2时使用
+except ImportError:
+    httpx = None
+
+POOL_SIZE = 10      # 每个主机保持的长连接数，应不小于并发抓取的线程数
+TIMEOUT = 10
+HTTP2 = False       # 安装httpx[http2]后可开启
+CACHE_MODE = None   # None | 'record' | 'replay'，回放模式下不联网
+REPLAY_DATE = None  # 回放指定日期抓取的快照，如'2020-06-22'，默认取最近一次
+
+_cache = None
+_cache_dir = CACHE_DIR  # 当前缓存目录，多城市并行时由cities.UseCity切换为各城市自己的目录
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def NewSession(pool_size=POOL_SIZE, http2=HTTP2):
+    '''
+    建立一个保持长连接的会话；启用HTTP/2但未安装httpx时退回requests
+    '''
+    if http2 and httpx is not None:
+        limits = httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size)
+        return httpx.Client(http2=True, limits=limits)
+
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def GetSession(url):
+    '''
+    按主机名返回共享会话，使同一主机的请求复用TCP/TLS连接
+    '''
+    host = urlsplit(url).netloc
+
+    with _sessions_lock:
+        if host not in _sessions:
+            _sessions[host] = NewSession()
+        return _sessions[host]
+
+
+def GetCache():
+
+    global _cache
+
+    with _sessions_lock:
+        if _cache is None:
+            _cache = HttpCache(_cache_dir, replay=(CACHE_MODE == 'replay'))
+        return _cache
+
+
+def UseCacheDir(cache_dir):
+    '''
+    切换缓存目录，已打开的缓存在下次使用时按新目录重新打开
+    '''
+    global _cache, _cache_dir
+
+    with _sessions_lock:
+        if _cache is not None and _cache.cache_dir != cache_dir:
+            _cache.Close()
+            _cache = None
+        _cache_dir = cache_dir
+
+    return None
+
+
+def Get(url, headers=None, timeout=TIMEOUT):
+    '''
+    所有抓取模块共用的GET请求入口，启用缓存时先经过本地缓存
+    '''
+    if CACHE_MODE:
+        r = GetCache().Get(url, headers, timeout, Fetch, REPLAY_DATE)
+        metrics.Inc('http_cache_total', doc='Responses served through the local HTTP cache',
+                    result='hit' if getattr(r, 'from_cache', False) else 'miss')
+        return r
+
+    return Fetch(url, headers, timeout)
+
+
+class ReplayMiss(ConnectionError):
+    '''
+    回放模式下未命中缓存，供将响应状态转换为异常的调用方区分真实的抓取失败
+    '''
+
+
+def IsReplayMiss(r):
+    '''
+    回放模式下未命中缓存的504响应，调用方不应作为抓取失败记录
+    '''
+    return getattr(r, 'replay_miss', False)
+
+
+def Fetch(url, headers=None, timeout=TIMEOUT):
+    '''
+    实际发出请求，httpx的异常统一转换为requests的异常类型；只有联网的请求才受限速约束，
+    响应状态与耗时反馈给自适应限速
+    '''
+    host = urlsplit(url).netloc
+    with metrics.Timer('throttle_wait_seconds', doc='Time spent waiting for a rate limit token', host=host):
+        Throttle(url)
+    session = GetSession(url)
+    start = time.monotonic()
+
+    try:
+        if httpx is not None and isinstance(session, httpx.Client):
+            try:
+                r = session.get(url, headers=headers, timeout=timeout)
+            except httpx.TimeoutException as err:
+                raise Timeout(err)
+            except httpx.TransportError as err:
+                raise ConnectionError(err)
+        else:
+            r = session.get(url, headers=headers, timeout=timeout)
+    except (Timeout, ConnectionError) as err:
+        Feedback(url, error=err)
+        metrics.Inc('fetch_errors_total', doc='Requests failed without a response', host=host, error=type(err).__name__)
+        raise
+
+    latency = time.monotonic() - start
+    Feedback(url, r, latency)
+    metrics.Observe('fetch_seconds', latency, doc='Request latency', host=host)
+    metrics.Inc('fetch_responses_total', doc='Responses by status code', host=host, status=r.status_code)
+    metrics.Inc('fetch_bytes_total', len(r.content), doc='Bytes downloaded', host=host)
+    return r
+
+
+def CloseAll():
+
+    global _cache
+
+    with _sessions_lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
+
+        if _cache is not None:
+            _cache.Close()
+            _cache = None
+
+    return None
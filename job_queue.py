@@ -0,0 +1,345 @@
+'''
+协调进程与抓取进程之间的任务队列：任务被租用后在可见性超时内完成确认，
+超时未确认的租约由Reclaim收回重新排队。单机使用SQLite后端，多台机器共享时使用Redis协议后端；
+本地没有Redis服务时可用fakeredis://在进程内模拟Redis后端
+
+    python job_queue.py fakeredis://    # 对指定后端检查租用、确认、失败重排及租约收回
+'''
+from collections import namedtuple
+from urllib.parse import urlsplit
+import json
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+try:
+    import redis  # 可选依赖，仅Redis后端使用
+except ImportError:
+    redis = None
+
+try:
+    import fakeredis  # 可选依赖，仅在本地模拟Redis后端时使用
+except ImportError:
+    fakeredis = None
+
+QUEUE_URL = 'sqlite:///queue.db'    # 或 'redis://localhost:6379/0'
+VISIBILITY_TIMEOUT = 120            # 租约有效秒数，超时后任务重新可见
+MAX_ATTEMPTS = 3                    # 超过该租用次数仍失败的任务不再排队
+KEY_TTL = 3 * 24 * 3600             # Redis后端去重键的保留秒数，键中已包含快照日期，过期后不再需要
+
+Job = namedtuple('Job', ['id', 'kind', 'payload', 'attempts'])
+
+
+class SqliteQueue:
+    '''
+    基于单个SQLite文件的任务队列，供同一台机器上的多个进程共享；
+    每个状态变更都是一条独立语句，依靠SQLite的写锁保证同一任务只被一个进程租用
+    '''
+
+    def __init__(self, path='queue.db', timeout=VISIBILITY_TIMEOUT, max_attempts=MAX_ATTEMPTS):
+
+        self.timeout = timeout
+        self.max_attempts = max_attempts
+        self.conn = sqlite3.connect(path, timeout=30, isolation_level=None)
+        self.conn.executescript('''
+            PRAGMA journal_mode = WAL;
+            CREATE TABLE IF NOT EXISTS `jobs` (
+            `id` INTEGER PRIMARY KEY AUTOINCREMENT,
+            `kind` VARCHAR(16) NOT NULL,
+            `key` TEXT UNIQUE,
+            `payload` TEXT NOT NULL,
+            `state` VARCHAR(8) DEFAULT 'ready' NOT NULL,
+            `attempts` INTEGER DEFAULT 0 NOT NULL,
+            `lease_until` REAL,
+            `worker` TEXT,
+            `result` TEXT,
+            `error` TEXT
+            );
+            CREATE INDEX IF NOT EXISTS `jobs-ready` ON `jobs` (`kind`, `id`) WHERE `state` = 'ready';
+            CREATE INDEX IF NOT EXISTS `jobs-leased` ON `jobs` (`lease_until`) WHERE `state` = 'leased';
+            CREATE INDEX IF NOT EXISTS `jobs-done` ON `jobs` (`id`) WHERE `state` = 'done';
+            ''')
+
+    def Put(self, kind, payload, key=None):
+        '''
+        入队一个任务，key相同的任务只入队一次，返回是否新入队
+        '''
+        cur = self.conn.execute('INSERT OR IGNORE INTO `jobs` (kind, key, payload) VALUES (?, ?, ?)',
+                                (kind, key, json.dumps(payload, ensure_ascii=False)))
+        return cur.rowcount > 0
+
+    def Lease(self, kinds, worker):
+        '''
+        租用一个指定类型的任务，队列为空时返回None
+        '''
+        marks = ', '.join('?' * len(kinds))
+        row = self.conn.execute('''
+            UPDATE `jobs` SET state = 'leased', lease_until = ?, worker = ?, attempts = attempts + 1
+            WHERE id = (
+                SELECT id FROM `jobs` WHERE state = 'ready' AND kind IN ({marks})
+                ORDER BY id LIMIT 1)
+            RETURNING id, kind, payload, attempts
+            '''.format(marks=marks), (time.time() + self.timeout, worker, *kinds)).fetchone()
+
+        if row is None:
+            return None
+        return Job(row[0], row[1], json.loads(row[2]), row[3])
+
+    def Ack(self, job, result):
+        '''
+        提交任务结果，等待协调进程读取；租约已被收回（或已被再次租用）时不作处理，与Redis后端一致
+        '''
+        self.conn.execute('''
+            UPDATE `jobs` SET state = 'done', result = ?, lease_until = NULL
+            WHERE id = ? AND state = 'leased' AND attempts = ?
+            ''', (json.dumps(result, ensure_ascii=False), job.id, job.attempts))
+        return None
+
+    def Fail(self, job, error):
+        '''
+        任务失败后重新排队，租用次数达到上限时标记为failed
+        '''
+        state = 'failed' if job.attempts >= self.max_attempts else 'ready'
+        self.conn.execute('''
+            UPDATE `jobs` SET state = ?, error = ?, lease_until = NULL
+            WHERE id = ? AND state = 'leased' AND attempts = ?
+            ''', (state, error, job.id, job.attempts))
+        return None
+
+    def Reclaim(self):
+        '''
+        收回已超时的租约，返回重新排队的任务数
+        '''
+        cur = self.conn.execute('''
+            UPDATE `jobs` SET state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'ready' END,
+            error = 'lease expired', lease_until = NULL
+            WHERE state = 'leased' AND lease_until < ?
+            ''', (self.max_attempts, time.time()))
+        return cur.rowcount
+
+    def Results(self, limit=100):
+        '''
+        取出已完成任务的结果，取出后即标记为consumed
+        '''
+        rows = self.conn.execute('''
+            UPDATE `jobs` SET state = 'consumed'
+            WHERE id IN (SELECT id FROM `jobs` WHERE state = 'done' ORDER BY id LIMIT ?)
+            RETURNING id, kind, payload, attempts, result
+            ''', (limit, )).fetchall()
+
+        return [(Job(r[0], r[1], json.loads(r[2]), r[3]), json.loads(r[4])) for r in rows]
+
+    def Stats(self):
+
+        return dict(self.conn.execute('SELECT state, COUNT(*) FROM `jobs` GROUP BY state').fetchall())
+
+    def Close(self):
+
+        self.conn.close()
+        return None
+
+
+# 取出任务与登记租约在同一个脚本中完成，进程在两步之间退出也不会丢失任务
+# KEYS: leased, stats, ready列表...；ARGV: 租约到期时间, worker, 任务hash的键前缀
+LEASE_SCRIPT = '''
+for i = 3, #KEYS do
+    local jid = redis.call('LPOP', KEYS[i])
+    if jid then
+        local job = ARGV[3] .. jid
+        redis.call('ZADD', KEYS[1], ARGV[1], jid)
+        local attempts = redis.call('HINCRBY', job, 'attempts', 1)
+        redis.call('HSET', job, 'worker', ARGV[2])
+        redis.call('HINCRBY', KEYS[2], 'ready', -1)
+        redis.call('HINCRBY', KEYS[2], 'leased', 1)
+        return {jid, i - 2, attempts, redis.call('HGET', job, 'payload')}
+    end
+end
+return false
+'''
+
+# 只有仍持有租约的任务才能确认或重新排队，ZREM与后续写入在同一脚本中完成
+# KEYS: leased, stats, job, 目标列表；ARGV: jid, 写入的字段, 字段值, 目标状态
+SETTLE_SCRIPT = '''
+if redis.call('ZREM', KEYS[1], ARGV[1]) == 0 then
+    return 0
+end
+redis.call('HSET', KEYS[3], ARGV[2], ARGV[3])
+redis.call('RPUSH', KEYS[4], ARGV[1])
+redis.call('HINCRBY', KEYS[2], 'leased', -1)
+redis.call('HINCRBY', KEYS[2], ARGV[4], 1)
+return 1
+'''
+
+
+class RedisQueue:
+    '''
+    Redis协议后端，供多台机器共享。各类型的待处理任务存放在list中，
+    租约以到期时间为score存放在zset中；租用、确认及重新排队各由一个Lua脚本原子完成，
+    以ZREM的返回值保证同一任务只被确认或重新排队一次
+    '''
+
+    def __init__(self, url, prefix='lianjia', timeout=VISIBILITY_TIMEOUT, max_attempts=MAX_ATTEMPTS,
+                 key_ttl=KEY_TTL, db=None):
+
+        if db is None:
+            if redis is None:
+                raise ImportError('The redis package is required for the Redis queue backend')
+            db = redis.Redis.from_url(url, decode_responses=True)
+
+        self.db = db
+        self.prefix = prefix
+        self.timeout = timeout
+        self.max_attempts = max_attempts
+        self.key_ttl = key_ttl
+        self.lease_script = self.db.register_script(LEASE_SCRIPT)
+        self.settle_script = self.db.register_script(SETTLE_SCRIPT)
+
+    def Key(self, *parts):
+
+        return ':'.join((self.prefix, ) + tuple(str(part) for part in parts))
+
+    def Put(self, kind, payload, key=None):
+
+        # 每个去重键单独设置过期时间，不会无限累积
+        if key is not None and not self.db.set(self.Key('key', key), 1, nx=True, ex=self.key_ttl):
+            return False
+
+        jid = self.db.incr(self.Key('seq'))
+        pipe = self.db.pipeline()
+        pipe.hset(self.Key('job', jid), mapping={
+            'kind': kind, 'payload': json.dumps(payload, ensure_ascii=False), 'attempts': 0})
+        pipe.rpush(self.Key('ready', kind), jid)
+        pipe.hincrby(self.Key('stats'), 'ready', 1)
+        pipe.execute()
+
+        return True
+
+    def Lease(self, kinds, worker):
+
+        keys = [self.Key('leased'), self.Key('stats')] + [self.Key('ready', kind) for kind in kinds]
+        leased = self.lease_script(keys=keys, args=[time.time() + self.timeout, worker, self.Key('job', '')])
+        if not leased:
+            return None
+
+        jid, index, attempts, payload = leased
+        return Job(int(jid), kinds[int(index) - 1], json.loads(payload), int(attempts))
+
+    def Settle(self, jid, field, value, target, state):
+        '''
+        仍持有租约时写入字段并移入目标列表，返回是否成功
+        '''
+        keys = [self.Key('leased'), self.Key('stats'), self.Key('job', jid), target]
+        return bool(self.settle_script(keys=keys, args=[jid, field, value, state]))
+
+    def Ack(self, job, result):
+
+        # 租约已被收回时任务已重新排队，结果以重新执行的为准
+        self.Settle(job.id, 'result', json.dumps(result, ensure_ascii=False), self.Key('done'), 'done')
+        return None
+
+    def Requeue(self, jid, kind, attempts, error):
+
+        if attempts >= self.max_attempts:
+            return self.Settle(jid, 'error', error, self.Key('failed'), 'failed')
+        return self.Settle(jid, 'error', error, self.Key('ready', kind), 'ready')
+
+    def Fail(self, job, error):
+
+        self.Requeue(job.id, job.kind, job.attempts, error)
+        return None
+
+    def Reclaim(self):
+
+        num = 0
+        for jid in self.db.zrangebyscore(self.Key('leased'), '-inf', time.time()):
+            kind, attempts = self.db.hmget(self.Key('job', jid), 'kind', 'attempts')
+            if self.Requeue(jid, kind, int(attempts), 'lease expired'):
+                num += 1
+
+        return num
+
+    def Results(self, limit=100):
+
+        results = []
+        for _ in range(limit):
+            jid = self.db.lpop(self.Key('done'))
+            if jid is None:
+                break
+
+            fields = self.db.hgetall(self.Key('job', jid))
+            self.db.delete(self.Key('job', jid))
+            self.db.hincrby(self.Key('stats'), 'done', -1)
+            job = Job(int(jid), fields['kind'], json.loads(fields['payload']), int(fields['attempts']))
+            results.append((job, json.loads(fields['result'])))
+
+        return results
+
+    def Stats(self):
+
+        return {state: int(num) for state, num in self.db.hgetall(self.Key('stats')).items() if int(num)}
+
+    def Close(self):
+
+        self.db.close()
+        return None
+
+
+def OpenQueue(url=QUEUE_URL, **kwargs):
+    '''
+    按URL选择后端：sqlite:///path 或 redis://host:port/db
+    '''
+    scheme = urlsplit(url).scheme
+
+    if scheme == 'sqlite':
+        return SqliteQueue(url[len('sqlite:///'):], **kwargs)
+    if scheme in ('redis', 'rediss', 'unix'):
+        return RedisQueue(url, **kwargs)
+    if scheme == 'fakeredis':
+        # 进程内的Redis模拟，只供本地检查，不能在多个进程之间共享
+        if fakeredis is None:
+            raise ImportError('The fakeredis package is required for the fakeredis:// backend')
+        return RedisQueue(url, db=fakeredis.FakeRedis(decode_responses=True), **kwargs)
+
+    raise ValueError('Unsupported queue backend: {:s}'.format(url))
+
+
+def Check(queue):
+    '''
+    依次检查去重入队、租用、确认、失败重排、租约收回及次数上限，供更换后端时快速验证
+    '''
+    assert queue.Put('detail', ['a'], key='detail:a')
+    assert not queue.Put('detail', ['a'], key='detail:a')
+    assert queue.Put('summary', 'b')
+
+    job = queue.Lease(['summary'], 'check')
+    assert (job.kind, job.payload, job.attempts) == ('summary', 'b', 1)
+    queue.Ack(job, {'ok': True})
+    assert [(j.payload, r) for j, r in queue.Results()] == [('b', {'ok': True})]
+
+    job = queue.Lease(['detail'], 'check')
+    queue.Fail(job, 'failed once')
+    job = queue.Lease(['detail'], 'check')
+    assert job.attempts == 2
+    queue.Fail(job, 'failed twice')
+    queue.timeout = -1      # 令下一次租约立即过期
+    job = queue.Lease(['detail'], 'check')
+    assert job.attempts == 3 and queue.Reclaim() == 1
+    queue.Ack(job, {})      # 已被收回的租约不能再确认
+    assert queue.Lease(['detail'], 'check') is None
+    assert queue.Results() == []
+    assert queue.Stats().get('failed') == 1
+
+    return None
+
+
+if __name__ == '__main__':
+    url = sys.argv[1] if len(sys.argv) > 1 else None
+    with tempfile.TemporaryDirectory() as tmp:
+        queue = OpenQueue(url or 'sqlite:///' + os.path.join(tmp, 'queue.db'))
+        try:
+            Check(queue)
+        finally:
+            queue.Close()
+    print('Queue check passed for {:s}'.format(url or 'sqlite'))
@@ -0,0 +1,87 @@
+'''
+基于lxml的解析后端：CSS选择器在导入时一次性编译为XPath，每条房源只遍历一次子树。
+文本提取沿用pyquery的extract_text，保证与PyQuery解析结果完全一致。
+'''
+from cssselect import HTMLTranslator
+from lxml import etree
+import lxml.html
+from pyquery.text import extract_text
+
+_translator = HTMLTranslator()
+
+def Compile(selector, prefix='descendant::'):
+
+    return etree.XPath(_translator.css_to_xpath(selector, prefix=prefix))
+
+
+# 列表页选择器
+ITEMS = Compile('#content .content__list--item', prefix='descendant-or-self::')
+TITLE = Compile('.content__list--item--title.twoline a')
+DES = Compile('.content__list--item--des')
+DES_FIRST = Compile('a:nth-child(1)')
+DES_SECOND = Compile('a:nth-child(2)')
+PRICE = Compile('.content__list--item-price')
+PRICE_EM = Compile('em')
+
+# 详情页选择器
+OFFLINE = Compile('.offline', prefix='descendant-or-self::')
+HOUSE_CODE = Compile('.house_code', prefix='descendant-or-self::')
+SUBTITLE = Compile('.content__subtitle', prefix='descendant-or-self::')
+INFO_LIST = Compile('#info > ul:nth-child(2)', prefix='descendant-or-self::')
+FLOOR = Compile('li:nth-child(8)', prefix='child::')
+ELEVATOR = Compile('li:nth-child(9)', prefix='child::')
+
+
+def Parse(html):
+
+    try:
+        return etree.fromstring(html)
+    except (etree.XMLSyntaxError, ValueError):
+        return lxml.html.fromstring(html)
+
+
+def Text(elements):
+    '''
+    与PyQuery.text()一致：多个元素的文本以空格连接
+    '''
+    return ' '.join(extract_text(e) for e in elements)
+
+
+def SummaryItems(html):
+    '''
+    逐条产出列表页房源的原始字段：
+    (title, href, district, neighborhood, des_text, price, price_text)
+    '''
+    for item in ITEMS(Parse(html)):
+        title = TITLE(item)
+        des = DES(item)
+        price = PRICE(item)
+
+        yield (
+            Text(title),
+            title[0].get('href') if title else None,
+            Text([a for d in des for a in DES_FIRST(d)]),
+            Text([a for d in des for a in DES_SECOND(d)]),
+            Text(des),
+            Text([em for p in price for em in PRICE_EM(p)]),
+            Text(price)
+            )
+
+
+def DetailFields(html):
+    '''
+    返回详情页的原始字段(house_code, subtitle, floor, elevator)，已下架房源返回None
+    '''
+    doc = Parse(html)
+
+    if OFFLINE(doc):
+        return None
+
+    info = INFO_LIST(doc)
+
+    return (
+        Text(HOUSE_CODE(doc)),
+        Text(SUBTITLE(doc)),
+        Text([li for ul in info for li in FLOOR(ul)]),
+        Text([li for ul in info for li in ELEVATOR(ul)])
+        )
@@ -0,0 +1,274 @@
+'''
+运行指标：计数器、仪表及直方图，可通过Prometheus文本格式的HTTP接口实时查看，
+运行结束时输出JSON摘要
+'''
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import threading
+import time
+
+METRICS_PORT = None                 # 设置端口后在该端口提供/metrics及/metrics.json
+SUMMARY_PATH = 'metrics_summary.jsonl'
+_summary_path = SUMMARY_PATH        # 当前使用的摘要文件，由UseSummary切换
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, float('inf'))
+
+
+def LabelKey(labels):
+
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def LabelText(key):
+
+    if not key:
+        return ''
+    return '{' + ','.join('{:s}="{:s}"'.format(k, v.replace('"', '\\"')) for k, v in key) + '}'
+
+
+class Counter:
+
+    kind = 'counter'
+
+    def __init__(self, name, doc):
+
+        self.name = name
+        self.doc = doc
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def Inc(self, value=1, **labels):
+
+        key = LabelKey(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+        return None
+
+    def Lines(self):
+
+        with self.lock:
+            return ['{:s}{:s} {}'.format(self.name, LabelText(key), value) for key, value in self.values.items()]
+
+    def Summary(self):
+
+        with self.lock:
+            return {LabelText(key) or 'total': value for key, value in self.values.items()}
+
+
+class Gauge(Counter):
+
+    kind = 'gauge'
+
+    def Set(self, value, **labels):
+
+        with self.lock:
+            self.values[LabelKey(labels)] = value
+        return None
+
+
+class Histogram:
+
+    kind = 'histogram'
+
+    def __init__(self, name, doc, buckets=BUCKETS):
+
+        self.name = name
+        self.doc = doc
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.values = {}    # labels -> [各桶计数, 总和, 次数]
+
+    def Observe(self, value, **labels):
+
+        key = LabelKey(labels)
+        with self.lock:
+            counts, total, num = self.values.get(key) or ([0] * len(self.buckets), 0, 0)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            self.values[key] = (counts, total + value, num + 1)
+        return None
+
+    def Lines(self):
+
+        lines = []
+        with self.lock:
+            for key, (counts, total, num) in self.values.items():
+                cumulative = 0
+                for bound, count in zip(self.buckets, counts):
+                    cumulative += count
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append('{:s}_bucket{:s} {:d}'.format(self.name, LabelText(key + (('le', le), )), cumulative))
+                lines.append('{:s}_sum{:s} {}'.format(self.name, LabelText(key), total))
+                lines.append('{:s}_count{:s} {:d}'.format(self.name, LabelText(key), num))
+        return lines
+
+    def Quantile(self, counts, num, q):
+        '''
+        以所在桶的上界近似分位数
+        '''
+        cumulative = 0
+        for bound, count in zip(self.buckets, counts):
+            cumulative += count
+            if cumulative >= q * num:
+                return bound
+        return self.buckets[-1]
+
+    def Summary(self):
+
+        summary = {}
+        with self.lock:
+            for key, (counts, total, num) in self.values.items():
+                summary[LabelText(key) or 'total'] = {
+                    'count': num, 'sum': round(total, 6), 'mean': round(total / num, 6),
+                    'p50': self.Quantile(counts, num, 0.5), 'p95': self.Quantile(counts, num, 0.95)
+                    }
+        return summary
+
+
+_metrics = {}
+_metrics_lock = threading.Lock()
+_collectors = []
+_started = time.time()
+
+def GetMetric(cls, name, doc=''):
+
+    with _metrics_lock:
+        if name not in _metrics:
+            _metrics[name] = cls(name, doc)
+        return _metrics[name]
+
+
+def Inc(name, value=1, doc='', **labels):
+
+    GetMetric(Counter, name, doc).Inc(value, **labels)
+    return None
+
+
+def Set(name, value, doc='', **labels):
+
+    GetMetric(Gauge, name, doc).Set(value, **labels)
+    return None
+
+
+def Observe(name, value, doc='', **labels):
+
+    GetMetric(Histogram, name, doc).Observe(value, **labels)
+    return None
+
+
+@contextmanager
+def Timer(name, doc='', **labels):
+    '''
+    记录代码块的耗时（秒）
+    '''
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        Observe(name, time.perf_counter() - start, doc, **labels)
+
+
+def RegisterCollector(collect):
+    '''
+    注册在导出前调用的函数，用于读取限速器速率等实时状态
+    '''
+    _collectors.append(collect)
+    return None
+
+
+def Collect():
+
+    for collect in _collectors:
+        collect()
+    with _metrics_lock:
+        return list(_metrics.values())
+
+
+def Render():
+    '''
+    Prometheus文本格式
+    '''
+    lines = []
+    for metric in Collect():
+        if metric.doc:
+            lines.append('# HELP {:s} {:s}'.format(metric.name, metric.doc))
+        lines.append('# TYPE {:s} {:s}'.format(metric.name, metric.kind))
+        lines.extend(metric.Lines())
+    return '\n'.join(lines) + '\n'
+
+
+def Summary():
+
+    summary = {'elapsed': round(time.time() - _started, 3)}
+    for metric in Collect():
+        summary[metric.name] = metric.Summary()
+    return summary
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+
+        if self.path == '/metrics':
+            body, ctype = Render(), 'text/plain; version=0.0.4'
+        elif self.path == '/metrics.json':
+            body, ctype = json.dumps(Summary(), ensure_ascii=False), 'application/json'
+        else:
+            self.send_error(404)
+            return None
+
+        body = body.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', ctype)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        return None
+
+    def log_message(self, *args):
+
+        return None
+
+
+_server = None
+
+def Start(port=None):
+    '''
+    在后台线程中提供指标接口，未设置端口时不启动
+    '''
+    global _server
+
+    port = port or METRICS_PORT
+    if port is None or _server is not None:
+        return None
+
+    _server = ThreadingHTTPServer(('', port), MetricsHandler)
+    threading.Thread(target=_server.serve_forever, daemon=True).start()
+    print('Serving metrics on port {:d}'.format(port))
+    return None
+
+
+def UseSummary(path):
+    '''
+    切换摘要文件，多城市并行时各城市写入自己的文件
+    '''
+    global _summary_path
+
+    _summary_path = path
+    return None
+
+
+def Report(name, path=None):
+    '''
+    运行结束时输出JSON摘要，并作为一行追加到摘要文件
+    '''
+    path = path or _summary_path
+    summary = dict(Summary(), run=name, time=time.strftime('%Y-%m-%d %H:%M:%S'))
+    with open(path, 'a+', encoding='utf-8') as fhand:
+        fhand.write(json.dumps(summary, ensure_ascii=False))
+        fhand.write('\n')
+
+    print(json.dumps(summary, ensure_ascii=False, indent=1))
+    return summary
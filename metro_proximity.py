@@ -0,0 +1,191 @@
+'''
+小区与地铁站的邻近查询：将经纬度投影为平面坐标（米）后建立网格索引，
+批量计算每个小区最近的地铁站、距离及一定半径内的站点数，并写回小区表
+'''
+from math import radians, cos
+import sqlite3
+import numpy as np
+import cities
+
+CITY = 'guangzhou'
+CELL = 1000         # 网格边长（米）
+RADIUS = 800        # 统计步行范围内站点数的半径（米）
+EARTH_RADIUS = 6371000
+
+
+def Project(lng, lat, lat0):
+    '''
+    以lat0为基准纬度的等距圆柱投影，城市范围内误差可忽略
+    '''
+    lng = np.radians(np.asarray(lng, dtype=float))
+    lat = np.radians(np.asarray(lat, dtype=float))
+    return EARTH_RADIUS * lng * cos(radians(lat0)), EARTH_RADIUS * lat
+
+
+class GridIndex:
+    '''
+    均匀网格空间索引：按网格环逐层向外搜索，查询只触及附近网格中的点
+    '''
+
+    def __init__(self, x, y, cell=CELL):
+
+        self.x = np.asarray(x, dtype=float)
+        self.y = np.asarray(y, dtype=float)
+        self.cell = cell
+        self.cells = {}
+
+        cx = np.floor(self.x / cell).astype(int)
+        cy = np.floor(self.y / cell).astype(int)
+        for i, key in enumerate(zip(cx.tolist(), cy.tolist())):
+            self.cells.setdefault(key, []).append(i)
+        self.cells = {key: np.array(idx) for key, idx in self.cells.items()}
+
+        keys = np.array(list(self.cells))
+        self.bounds = (keys.min(axis=0), keys.max(axis=0))
+
+    def Ring(self, cx, cy, ring):
+        '''
+        返回与(cx, cy)切比雪夫距离恰为ring的网格中的点
+        '''
+        if ring == 0:
+            return self.cells.get((cx, cy), [])
+
+        found = []
+        for dx in range(-ring, ring + 1):
+            for dy in (-ring, ring):
+                found.extend(self.cells.get((cx + dx, cy + dy), []))
+        for dy in range(-ring + 1, ring):
+            for dx in (-ring, ring):
+                found.extend(self.cells.get((cx + dx, cy + dy), []))
+        return found
+
+    def MaxRing(self, cx, cy):
+        '''
+        覆盖全部非空网格所需的环数
+        '''
+        (x0, y0), (x1, y1) = self.bounds
+        return max(abs(cx - x0), abs(cx - x1), abs(cy - y0), abs(cy - y1))
+
+    def Nearest(self, qx, qy, k=1):
+        '''
+        批量k近邻查询，返回(距离数组, 索引数组)，形状均为(查询数, k)
+        '''
+        qx = np.asarray(qx, dtype=float)
+        qy = np.asarray(qy, dtype=float)
+        k = min(k, len(self.x))
+        dists = np.full((len(qx), k), np.inf)
+        idxs = np.full((len(qx), k), -1)
+
+        if k == 0:
+            return dists, idxs
+
+        for n, (px, py) in enumerate(zip(qx, qy)):
+            cx, cy = int(np.floor(px / self.cell)), int(np.floor(py / self.cell))
+            limit = self.MaxRing(cx, cy)
+            candidates = []
+            ring = 0
+            while ring <= limit:
+                candidates.extend(self.Ring(cx, cy, ring))
+                if len(candidates) >= k:
+                    cand = np.array(candidates)
+                    d = np.hypot(self.x[cand] - px, self.y[cand] - py)
+                    order = np.argsort(d)[:k]
+                    # 未搜索网格中的点距离至少为ring * cell
+                    if d[order[-1]] <= ring * self.cell:
+                        break
+                ring += 1
+
+            cand = np.array(candidates)
+            d = np.hypot(self.x[cand] - px, self.y[cand] - py)
+            order = np.argsort(d)[:k]
+            dists[n], idxs[n] = d[order], cand[order]
+
+        return dists, idxs
+
+    def Within(self, qx, qy, radius):
+        '''
+        批量半径查询，返回每个查询点半径内的点索引数组
+        '''
+        rings = int(np.ceil(radius / self.cell))
+        results = []
+
+        for px, py in zip(np.asarray(qx, dtype=float), np.asarray(qy, dtype=float)):
+            cx, cy = int(np.floor(px / self.cell)), int(np.floor(py / self.cell))
+            cand = np.array([i for ring in range(rings + 1) for i in self.Ring(cx, cy, ring)], dtype=int)
+            if cand.size:
+                cand = cand[np.hypot(self.x[cand] - px, self.y[cand] - py) <= radius]
+            results.append(cand)
+
+        return results
+
+
+def ProximityDbInitialize(conn, city=CITY):
+    '''
+    在小区表中补充邻近地铁站的派生字段
+    '''
+    columns = {row[1] for row in conn.execute('PRAGMA table_info(`{city}-community`)'.format(city=city))}
+    new_columns = [
+        ('NearestStation', 'VARCHAR(16)'),
+        ('NearestLines', 'VARCHAR(32)'),
+        ('StationDistance', 'NUMERIC'),
+        ('StationsNearby', 'TINYINT')
+        ]
+
+    with conn:
+        for name, dtype in new_columns:
+            if name not in columns:
+                conn.execute('ALTER TABLE `{city}-community` ADD COLUMN `{name}` {dtype}'.format(
+                    city=city, name=name, dtype=dtype))
+
+    return None
+
+
+def Main(city=CITY, radius=RADIUS):
+
+    conn = sqlite3.connect(cities.ShardPath(city))
+    ProximityDbInitialize(conn, city)
+
+    # 换乘站在各线路中重复出现，按站名合并
+    stations = conn.execute('''
+        SELECT StationName, AVG(Longitude), AVG(Latitude), GROUP_CONCAT(LineCode)
+        FROM `{city}-metro` WHERE (Longitude IS NOT NULL) AND (Latitude IS NOT NULL)
+        GROUP BY StationName
+        '''.format(city=city)).fetchall()
+    communities = conn.execute('''
+        SELECT ID, Longitude, Latitude FROM `{city}-community`
+        WHERE (Longitude IS NOT NULL) AND (Latitude IS NOT NULL)
+        '''.format(city=city)).fetchall()
+
+    if not stations or not communities:
+        print('No geocoded stations or communities found')
+        conn.close()
+        return None
+
+    lat0 = float(np.mean([s[2] for s in stations]))
+    sx, sy = Project([s[1] for s in stations], [s[2] for s in stations], lat0)
+    qx, qy = Project([c[1] for c in communities], [c[2] for c in communities], lat0)
+
+    index = GridIndex(sx, sy)
+    dists, idxs = index.Nearest(qx, qy, k=1)
+    nearby = index.Within(qx, qy, radius)
+
+    updates = [
+        (stations[idx[0]][0], stations[idx[0]][3], round(float(dist[0]), 1), len(within), community[0])
+        for community, dist, idx, within in zip(communities, dists, idxs, nearby)
+        ]
+
+    with conn:
+        conn.executemany('''
+            UPDATE `{city}-community`
+            SET NearestStation = ?, NearestLines = ?, StationDistance = ?, StationsNearby = ?
+            WHERE ID = ?
+            '''.format(city=city), updates)
+
+    print('{:d} communities updated with the nearest metro station.'.format(len(updates)))
+    conn.close()
+
+    return None
+
+
+if __name__ == '__main__':
+    Main()
@@ -1,31 +1,51 @@
+import argparse
+import glob
+import json
+import os
 import re
 import time
 import sqlite3
-import random
-from urllib.parse import urlencode
-import requests
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode, urljoin
 from requests.exceptions import Timeout, ConnectionError
-from selenium import webdriver
-from selenium.webdriver.common.by import By
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.common.exceptions import TimeoutException
-from selenium.webdriver.support import expected_conditions as EC
 from mapkeys import GAODE_KEY
+import http_client
+from user_agents import GetHeader
+import geo_cache
+import lxml_parsing
+import throttle
+import cities
+from community_geo_fetching import RATE_LIMIT_CODES
+
+try:
+    from selenium import webdriver  # 可选依赖，仅在browser模式下使用
+    from selenium.webdriver.common.by import By
+    from selenium.webdriver.support.ui import WebDriverWait
+    from selenium.common.exceptions import TimeoutException
+    from selenium.webdriver.support import expected_conditions as EC
+except ImportError:
+    webdriver = None
 
-OFFICIAL_URL = 'http://cs.gzmtr.com/ckfw/'
+CITY = 'guangzhou'
+OFFICIAL_URL = cities.GetCity(CITY).metro
+LINE_PATH = '?lineCode={code}'  # 线路按钮由脚本切换、没有直接链接时按线路编号请求，该地址尚未在官网上验证
+MODE = 'browser'  # 'browser' 沿用selenium逐个点击线路按钮 | 'http' 直接请求页面并发抓取各线路
+# 浏览器模式下保存的真实页面及页面发出的请求，用于确认各线路站点表的实际来源并验证http模式；
+# fixtures/metro/下的ckfw.html、line-*.html为按官网结构手写的样例，只用于解析基准测试
+RECORD_DIR = os.path.join('fixtures', 'metro', 'recorded')
+WORKERS = 4
 MAX_TRY = 5
 GAODE_API = 'https://restapi.amap.com/v3/place/text?'
-CITY = 'guangzhou'
 
-def DbInitialize(conn):
+def DbInitialize(conn, city=CITY):
     '''
     初始化地铁站点数据库
     '''
     cur = conn.cursor()
 
     init_sql = '''
-                DROP TABLE IF EXISTS `guangzhou-metro`;
-                CREATE TABLE IF NOT EXISTS `guangzhou-metro`(
+                DROP TABLE IF EXISTS `{city}-metro`;
+                CREATE TABLE IF NOT EXISTS `{city}-metro`(
                 `LineCode` TINYINT NOT NULL,
                 `LineName` VARCHAR(8) NOT NULL,
                 `LineColor` VARCHAR(32) NOT NULL,
@@ -35,7 +55,7 @@ def DbInitialize(conn):
                 `Latitude` NUMERIC DEFAULT NULL,
                 PRIMARY KEY (`LineCode`, `StationCode`)
                 )
-                '''
+                '''.format(city=city)
     try:
         cur.executescript(init_sql)
         conn.commit()
@@ -47,7 +67,7 @@ def DbInitialize(conn):
     return None
 
 
-def RecordDetailInsert(conn, station_records):
+def RecordDetailInsert(conn, station_records, city=CITY):
     '''
     将站点数据插入到数据库中，其中站点数据为对应于数据库结构的Iterable：
     单个站点数据应符合(Linecode, LineName, LineColor, StationCode, StationName)的数据格式
@@ -55,12 +75,12 @@ def RecordDetailInsert(conn, station_records):
     cur = conn.cursor()
 
     sql = '''
-          INSERT OR IGNORE INTO `guangzhou-metro` (
+          INSERT OR IGNORE INTO `{city}-metro` (
               Linecode, LineName, LineColor, StationCode, StationName)
           VALUES (
               ?, ?, ?, ?, ?
               )
-          '''
+          '''.format(city=city)
     try:
         cur.executemany(sql, station_records)
         num_suc = cur.rowcount
@@ -80,6 +100,96 @@ def ExtractColor(style_string):
     return pat.search(style_string).group()
 
 
+LINE_BUTTONS = lxml_parsing.Compile('#zoneHeader td a', prefix='descendant-or-self::')
+STATION_ROWS = lxml_parsing.Compile('#zoneService tbody tr', prefix='descendant-or-self::')
+CELLS = lxml_parsing.Compile('td', prefix='child::')
+
+
+def LineUrl(button, base=OFFICIAL_URL):
+    '''
+    优先使用按钮的链接；由脚本切换的按钮从href或onclick中取出线路编号
+    '''
+    href = button.get('href') or ''
+    if href and not href.startswith(('#', 'javascript')):
+        return urljoin(base, href)
+
+    match = re.search(r'\(\s*[\'"]?(\w+)[\'"]?', button.get('onclick') or href)
+    return urljoin(base, LINE_PATH.format(code=match.group(1))) if match else None
+
+
+def ParseLines(html, base=OFFICIAL_URL):
+    '''
+    解析线路按钮，返回[(线路名称, 主题颜色, 线路表URL, 是否为当前线路)]
+    '''
+    lines = []
+    for button in LINE_BUTTONS(lxml_parsing.Parse(html)):
+        lines.append((
+            lxml_parsing.Text([button]).strip(),
+            ExtractColor(button.get('style')),
+            LineUrl(button, base),
+            'current' in (button.get('class') or '').split()
+            ))
+    return lines
+
+
+def ParseStations(html, line_name, line_color):
+    '''
+    与GetStations相同，从线路表中跳过表头三行后逐站产出站点数据
+    '''
+    for i, row in enumerate(STATION_ROWS(lxml_parsing.Parse(html))):
+        if i in range(0, 3):
+            continue
+        cells = CELLS(row)
+        line_code, station_code = [text.strip() for text in cells[0].itertext() if text.strip()]
+        station_name = lxml_parsing.Text([cells[1]]).strip()
+
+        yield (line_code, line_name, line_color, station_code, station_name)
+
+
+def GetPage(url):
+
+    r = http_client.Get(url, headers=GetHeader(url))
+    if r.status_code != 200:
+        raise ConnectionError('Connection response: {:d}'.format(r.status_code))
+    return r.text
+
+
+def FetchLine(line):
+
+    line_name, line_color, url, _ = line
+    if url is None:
+        raise ValueError('No link found for line {:s}'.format(line_name))
+    return list(ParseStations(GetPage(url), line_name, line_color))
+
+
+def HttpStationRecords(workers=WORKERS, url=OFFICIAL_URL):
+    '''
+    首页中已包含当前线路的站点表，直接解析；其余线路并发请求，按线路顺序返回各线路的站点数据。
+    全部线路取得后才返回，任一线路失败或没有站点时抛出异常，不返回不完整的数据
+    '''
+    html = GetPage(url)
+    lines = ParseLines(html, url)
+    print('{:d} metro lines found'.format(len(lines)))
+    if not lines:
+        raise ValueError('No metro lines found on {:s}'.format(url))
+
+    def Fetch(line):
+        if line[3]:
+            records = list(ParseStations(html, line[0], line[1]))
+        else:
+            try:
+                records = FetchLine(line)
+            except (ConnectionError, Timeout, ValueError) as err:
+                print('Failed to fetch line {:s}:'.format(line[0]), err)
+                raise
+        if not records:
+            raise ValueError('No stations found for line {:s}'.format(line[0]))
+        return records
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(Fetch, lines))
+
+
 def GetStations(driver):
     '''
     在每一次获取特定地铁线路的站点清单后，抓取各个站点的编号和名称
@@ -104,25 +214,12 @@ def GetStationsRecord(driver, botton):
         yield (line_code, line_name, line_color, station_code, station_name)
 
 
-def GetHeader():
-    '''
-    随机获取请求头信息
-    '''
-    with open('user-agents.txt', 'r') as fhand:
-        agent = random.choice(fhand.read().split('\n'))
-    header = {
-        'User-Agent': agent,
-        'Host': 'restapi.amap.com'
-    }
-    return header
-
-
 def ParamsPackaging(address, city=CITY, key=GAODE_KEY):
     '''
     根据指定的站点信息返回向高德地图查询的URL
     '''
     query = urlencode([
-        ('city', city), 
+        ('city', cities.GetCity(city).amap_city), 
         ('key', key),
         ('keywords', address),
         ('types', 150500)
@@ -139,7 +236,7 @@ def StationGeocoding(url):
     '''
     # 记录超时并返回None
     try:
-        r = requests.get(url, headers=GetHeader(), timeout=10)
+        r = http_client.Get(url, headers=GetHeader(url))
     except Timeout as terr:
         raise Timeout('Timeout for: {:s}'.format(url), terr.args[0])
     
@@ -153,10 +250,16 @@ def StationGeocoding(url):
     except: 
         raise ValueError('JSON decoding error for {:s}'.format(url))
         
-    # 进行经纬度提取前先检查结果状态
-    if result['status'] == 0:
+    # 进行经纬度提取前先检查结果状态；key无效、配额用尽等错误响应抛出，不作为无结果缓存，被限流时通知限速器减速
+    if str(result['status']) == '0':
+        if result.get('infocode') in RATE_LIMIT_CODES:
+            throttle.Backoff(url)
         raise ConnectionError('unsuccessful response {:s}'.format(result['info']))
 
+    # 没有匹配的站点时返回None，作为无结果缓存
+    if not result.get('pois'):
+        return None
+
     try:
         name = result['pois'][0]['name']
         longitude, latitude = result['pois'][0]['location'].split(',')
@@ -165,52 +268,118 @@ def StationGeocoding(url):
         raise ValueError('Content error for result:', result)
 
 
-def MetroGeoCode(conn):
-
-    num_update = 0
-    query = '''
-            SELECT LineCode, StationCode, StationName FROM `guangzhou-metro`
-            '''
-    update_sql = '''
-                 UPDATE `guangzhou-metro`
-                 SET `Longitude` = ?, `Latitude` = ?
-                 WHERE (`LineCode` = ?) & (`StationCode` = ?)
-                 '''
-    cur = conn.cursor()
+def StationLocation(station, city=CITY):
+    '''
+    查询单个站名的经纬度，查不到或站名不一致时返回(None, None)
+    '''
     name_pattern = r'(\w+)(\(\w+\))?'
+    address = '{:s}(地铁站)'.format(station)
+    url = ParamsPackaging(address, city)
+
+    try:
+        result = geo_cache.GetCache().Resolve('place', cities.CacheQuery(city, address), lambda: StationGeocoding(url))
+        if result is None:
+            raise ValueError('No result for station: {:s}'.format(station))
+        name, longitude, latitude = result
+        if re.match(name_pattern, name).group(1) != station:
+            raise ValueError('Mismatch of station: {:s}'.format(station))
+    except (ConnectionError, ValueError, Timeout) as err:
+        print('Error occurs for station {:s}'.format(station))
+        print(err.args[0])
+        return None, None
+
+    return longitude, latitude
+
+
+def MetroGeoCode(conn, incremental=False, city=CITY):
+    '''
+    换乘站在各条线路中重复出现，按站名去重后每站只查询一次；结果写入临时表，
+    再以一条按站名连接的UPDATE ... FROM写回。增量模式只处理尚无经纬度的站点
+    '''
+    query = 'SELECT DISTINCT StationName FROM `{city}-metro`'.format(city=city)
+    if incremental:
+        query += ' WHERE (Longitude IS NULL) OR (Latitude IS NULL)'
 
-    for lcode, scode, station in cur.execute(query):
+    stations = [row[0] for row in conn.execute(query).fetchall()]
+    locations = []
+    for station in stations:
         print('Geocoding station...', station)
-        url = ParamsPackaging('{:s}(地铁站)'.format(station))
+        locations.append((station, ) + StationLocation(station, city))
 
-        try:
-            name, longitude, latitude = StationGeocoding(url)
-            if re.match(name_pattern, name).group(1) != station:
-                raise ValueError('Mismatch of station: {:s}'.format(station))
-        except (ConnectionError, ValueError, Timeout) as err:
-            print('Error occurs for station {:s}'.format(station))
-            print(err.args[0])
-            longitude, latitude = None, None
-        
-        conn.execute(update_sql, (longitude, latitude, lcode, scode))
-        num_update += cur.rowcount
-        time.sleep(random.uniform(0, 2))
-    
+    cur = conn.cursor()
+    cur.executescript('''
+        CREATE INDEX IF NOT EXISTS `{city}-metro-station` ON `{city}-metro` (`StationName`);
+        DROP TABLE IF EXISTS temp.`station-geo`;
+        CREATE TEMP TABLE `station-geo` (
+        `StationName` VARCHAR(16) NOT NULL PRIMARY KEY,
+        `Longitude` NUMERIC,
+        `Latitude` NUMERIC
+        );
+        '''.format(city=city))
+    cur.executemany('INSERT INTO temp.`station-geo` VALUES (?, ?, ?)', locations)
+
+    # 遍历临时表中的站名，经站名索引找到各线路中的对应站点；查询失败的站点不覆盖已有的经纬度，
+    # 增量模式下已有经纬度的线路站点（如换乘站的其他线路）同样不再改写
+    update_sql = '''
+        UPDATE `{city}-metro`
+        SET `Longitude` = g.Longitude, `Latitude` = g.Latitude
+        FROM temp.`station-geo` AS g
+        WHERE `{city}-metro`.StationName = g.StationName AND g.Longitude IS NOT NULL
+        '''.format(city=city)
+    if incremental:
+        update_sql += ' AND ((`{city}-metro`.Longitude IS NULL) OR (`{city}-metro`.Latitude IS NULL))'.format(city=city)
+    cur.execute(update_sql)
+    num_update = cur.rowcount
+
+    cur.execute('DROP TABLE temp.`station-geo`')
     conn.commit()
-    print('{:d} records updated.'.format(num_update))
+    cur.close()
+    print('{:d} stations geocoded, {:d} records updated.'.format(len(stations), num_update))
 
     return None
 
 
-def Main():
+def SavePage(record_dir, name, html):
 
-    conn = sqlite3.connect('lianjia.db')
-    num_suc = 0
-    DbInitialize(conn)
+    os.makedirs(record_dir, exist_ok=True)
+    with open(os.path.join(record_dir, name), 'w', encoding='utf-8') as fhand:
+        fhand.write(html)
+    return None
+
+
+def RecordRequests(browser, record_dir):
+    '''
+    从Chrome的performance日志中取出页面发出的文档及XHR请求，写入requests.txt，
+    用于确认点击线路按钮时站点表实际请求的地址
+    '''
+    urls = []
+    for entry in browser.get_log('performance'):
+        message = json.loads(entry['message'])['message']
+        if message['method'] != 'Network.requestWillBeSent':
+            continue
+        params = message['params']
+        if params.get('type') in ('Document', 'XHR', 'Fetch'):
+            urls.append('{:s}\t{:s}\t{:s}'.format(params['type'], params['request']['method'], params['request']['url']))
 
-    browser = webdriver.Chrome()
+    SavePage(record_dir, 'requests.txt', '\n'.join(urls) + '\n')
+    return urls
+
+
+def BrowserFetch(conn, url=OFFICIAL_URL, city=CITY, record_dir=None):
+    '''
+    通过浏览器逐个点击线路按钮抓取，返回插入的记录数；
+    给出record_dir时保存首页及每次点击后的页面，并记录页面发出的请求
+    '''
+    if webdriver is None:
+        raise ImportError('selenium is required for the browser mode')
+
+    num_suc = 0
+    options = webdriver.ChromeOptions()
+    if record_dir:
+        options.set_capability('goog:loggingPrefs', {'performance': 'ALL'})
+    browser = webdriver.Chrome(options=options)
     wait = WebDriverWait(browser, 10)
-    browser.get(OFFICIAL_URL)
+    browser.get(url)
 
     for i in range(MAX_TRY):
         try:
@@ -221,25 +390,131 @@ def Main():
                 browser.close() 
 
     lines_botton = browser.find_elements(By.CSS_SELECTOR, '#zoneHeader td a')
+    if record_dir:
+        SavePage(record_dir, 'ckfw.html', browser.page_source)
 
-    for botton in lines_botton:
+    for i, botton in enumerate(lines_botton):
         botton.click()
         assert botton.get_attribute('class') == 'current'
-        num_suc += RecordDetailInsert(conn, GetStationsRecord(browser, botton))
+        num_suc += RecordDetailInsert(conn, GetStationsRecord(browser, botton), city)
+        if record_dir:
+            SavePage(record_dir, 'line-{:02d}.html'.format(i + 1), browser.page_source)
         time.sleep(2)
 
+    if record_dir:
+        RecordRequests(browser, record_dir)
+    browser.close()
+    return num_suc
+
+
+def PageStations(html):
+    '''
+    页面中当前线路的站点数据
+    '''
+    current = [line for line in ParseLines(html) if line[3]]
+    if not current:
+        raise ValueError('No current line in page')
+    return list(ParseStations(html, current[0][0], current[0][1]))
+
+
+def CheckPages(fixture_dir=RECORD_DIR):
+    '''
+    解析保存的线路页面：每页应有当前线路，且站点编号均为数字，返回各线路的站点数据
+    '''
+    pages = sorted(glob.glob(os.path.join(fixture_dir, 'line-*.html')))
+    if not pages:
+        raise ValueError('No line pages found in {:s}'.format(fixture_dir))
+
+    lines = {}
+    for path in pages:
+        with open(path, 'r', encoding='utf-8') as fhand:
+            records = PageStations(fhand.read())
+        assert records, 'No stations parsed from {:s}'.format(path)
+        assert all(str(record[3]).isdigit() for record in records), 'Bad station code in {:s}'.format(path)
+        lines[records[0][1]] = records
+        print('{:s}: {:s} with {:d} stations'.format(os.path.basename(path), records[0][1], len(records)))
+
+    return lines
+
+
+def VerifyHttp(record_dir=RECORD_DIR, url=OFFICIAL_URL, workers=WORKERS):
+    '''
+    以浏览器模式保存的真实页面为准，检查http模式取得的各线路站点是否一致；一致后才可将MODE改为'http'
+    '''
+    expected = CheckPages(record_dir)
+    fetched = {records[0][1]: records for records in HttpStationRecords(workers, url)}
+
+    matched = True
+    for line_name in sorted(set(expected) | set(fetched)):
+        if expected.get(line_name) != fetched.get(line_name):
+            print('Mismatch for line {:s}: {:d} recorded, {:d} fetched over http'.format(
+                line_name, len(expected.get(line_name, [])), len(fetched.get(line_name, []))))
+            matched = False
+
+    print('HTTP mode {:s} the recorded pages'.format('matches' if matched else 'does not match'))
+    return matched
+
+
+def Main(mode=MODE, workers=WORKERS, city=CITY, incremental=False, record_dir=None):
+    '''
+    incremental为True时不重新抓取、不重建站点表，只为尚无经纬度的站点补充地理编码；
+    浏览器模式下给出record_dir时保存抓取的页面供VerifyHttp使用
+    '''
+    url = cities.GetCity(city).metro
+    if url is None:
+        print('No metro source registered for {:s}'.format(city))
+        return None
+
+    cities.UseCity(city)
+    if incremental:
+        conn = sqlite3.connect(cities.ShardPath(city))
+        MetroGeoCode(conn, incremental=True, city=city)
+        conn.close()
+        return None
+
+    # http模式先取得全部线路再重建站点表，抓取失败时保留原有数据
+    if mode == 'http':
+        try:
+            lines = HttpStationRecords(workers, url)
+        except (ConnectionError, Timeout, ValueError) as err:
+            print('Failed to fetch metro lines, existing stations kept:', err)
+            return None
+
+    conn = sqlite3.connect(cities.ShardPath(city))
+    num_suc = 0
+    DbInitialize(conn, city)
+
+    if mode == 'browser':
+        num_suc = BrowserFetch(conn, url, city, record_dir)
+    else:
+        for station_records in lines:
+            num_suc += RecordDetailInsert(conn, station_records, city)
+
     print('{:d} records inserted.'.format(num_suc))
     
     # THZ线路为旅游性质，且需要单独作Geocoding的设计，暂不予以考虑
-    conn.execute('DELETE FROM `guangzhou-metro` WHERE LineCode LIKE "THZ%"')
+    conn.execute('DELETE FROM `{city}-metro` WHERE LineCode LIKE "THZ%"'.format(city=city))
     
-    MetroGeoCode(conn)  #少数站点存在地铁官方和地图API间的用字差异，利用SQL手动调整
+    MetroGeoCode(conn, city=city)  #少数站点存在地铁官方和地图API间的用字差异，利用SQL手动调整
 
-    browser.close()
     conn.close()
 
     return None
 
 
 if __name__ == '__main__':
-    Main()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--mode', choices=['browser', 'http'], default=MODE)
+    parser.add_argument('--city', default=CITY, choices=sorted(cities.CITIES))
+    parser.add_argument('--incremental', action='store_true', help='只补充尚无经纬度的站点')
+    parser.add_argument('--record', metavar='DIR', help='浏览器模式下保存页面及请求地址')
+    parser.add_argument('--verify', metavar='DIR', help='以保存的页面检查http模式，不写入数据库')
+    parser.add_argument('--check', metavar='DIR', help='只解析保存的页面')
+    args = parser.parse_args()
+
+    if args.check:
+        CheckPages(args.check)
+    elif args.verify:
+        VerifyHttp(args.verify, cities.GetCity(args.city).metro)
+    else:
+        Main(args.mode, city=args.city, incremental=args.incremental, record_dir=args.record)
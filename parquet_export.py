@@ -0,0 +1,179 @@
+'''
+将房源数据导出为按快照日期和行政区分区的Parquet文件，取代notebook中经pandas写出的houses.csv：
+经纬度为WGS-84数值列，类别字段字典编码，数据按批次从SQLite读出后直接写入，不在内存中保留整表。
+字段映射由sql_cleaning在数据库中完成，导出前先增量清洗
+'''
+import os
+import shutil
+import sqlite3
+import pyarrow as pa
+import pyarrow.parquet as pq
+from coord_transform import Gcj2WgsArray
+import sql_cleaning
+import cities
+
+CITY = 'guangzhou'
+EXPORT_DIR = 'export'
+CHUNK_SIZE = 5000
+COMPRESSION = 'zstd'
+
+CATEGORY = pa.dictionary(pa.int32(), pa.string())
+
+# 行政区作为分区目录，不再写入文件
+HOUSE_SCHEMA = pa.schema([
+    ('ID', pa.int64()),
+    ('CommunityID', pa.int32()),
+    ('RentType', CATEGORY),
+    ('Area', pa.float64()),
+    ('Price', pa.float64()),
+    ('UnitPrice', pa.float64()),
+    ('HouseFloor', CATEGORY),
+    ('BuldFloor', pa.int16()),
+    ('ElevatorFlag', pa.int8()),
+    ('Longitude', pa.float64()),
+    ('Latitude', pa.float64())
+    ])
+
+# 支线的线路编号为3N、14B等，以字符串保存
+METRO_SCHEMA = pa.schema([
+    ('LineCode', CATEGORY),
+    ('LineName', CATEGORY),
+    ('LineColor', CATEGORY),
+    ('StationCode', pa.int16()),
+    ('StationName', pa.string()),
+    ('Longitude', pa.float64()),
+    ('Latitude', pa.float64())
+    ])
+
+
+def HouseBatch(rows):
+    '''
+    将一批查询结果转换为RecordBatch，坐标整列转换为WGS-84
+    '''
+    columns = list(zip(*rows))
+    lng, lat = Gcj2WgsArray(columns[10], columns[11])
+
+    arrays = [
+        pa.array(columns[0], pa.int64()),
+        pa.array(columns[2], pa.int32()),
+        pa.array(columns[3], pa.string()).dictionary_encode(),
+        pa.array(columns[4], pa.float64()),
+        pa.array(columns[5], pa.float64()),
+        pa.array(columns[6], pa.float64()),
+        pa.array(columns[7], pa.string()).dictionary_encode(),
+        pa.array(columns[8], pa.int16()),
+        pa.array(columns[9], pa.int8()),
+        pa.array(lng, pa.float64()),
+        pa.array(lat, pa.float64())
+        ]
+    return pa.RecordBatch.from_arrays(arrays, schema=HOUSE_SCHEMA)
+
+
+def ExportHouses(conn, snapshot, city=CITY, export_dir=EXPORT_DIR, chunk=CHUNK_SIZE):
+    '''
+    按行政区排序流式读取，每个行政区对应一个分区目录，返回写出的行数
+    '''
+    root = os.path.join(export_dir, 'houses', 'snapshot={:s}'.format(snapshot))
+    # 同一快照重复导出时覆盖旧文件
+    shutil.rmtree(root, ignore_errors=True)
+
+    # 清洗后的房源视图中District已是行政区缩写
+    cur = conn.execute('''
+        SELECT ID, District, CommunityID, RentType, Area, Price, UnitPrice,
+        HouseFloor, BuldFloor, ElevatorFlag, Longitude, Latitude
+        FROM `{city}-houses`
+        ORDER BY District
+        '''.format(city=city))
+
+    writer, district, n_rows = None, None, 0
+    while True:
+        rows = cur.fetchmany(chunk)
+        if not rows:
+            break
+
+        # 一批数据可能跨越多个行政区，按行政区切分后分别写入
+        start = 0
+        for i in range(1, len(rows) + 1):
+            if i < len(rows) and rows[i][1] == rows[start][1]:
+                continue
+
+            if rows[start][1] != district:
+                if writer is not None:
+                    writer.close()
+                district = rows[start][1]
+                path = os.path.join(root, 'district={:s}'.format(district))
+                os.makedirs(path, exist_ok=True)
+                writer = pq.ParquetWriter(os.path.join(path, 'part-0.parquet'), HOUSE_SCHEMA,
+                                          compression=COMPRESSION)
+
+            writer.write_batch(HouseBatch(rows[start:i]))
+            n_rows += i - start
+            start = i
+
+    if writer is not None:
+        writer.close()
+    cur.close()
+
+    return n_rows
+
+
+def ExportMetro(conn, city=CITY, export_dir=EXPORT_DIR):
+
+    rows = conn.execute('''
+        SELECT LineCode, LineName, LineColor, StationCode, StationName, Longitude, Latitude
+        FROM `{city}-metro-clean`
+        ORDER BY CAST(LineCode AS INTEGER), LineCode, StationCode
+        '''.format(city=city)).fetchall()
+
+    if not rows:
+        return 0
+
+    columns = list(zip(*rows))
+    lng, lat = Gcj2WgsArray(columns[5], columns[6])
+    table = pa.Table.from_arrays([
+        pa.array(columns[0], pa.string()).dictionary_encode(),
+        pa.array(columns[1], pa.string()).dictionary_encode(),
+        pa.array(columns[2], pa.string()).dictionary_encode(),
+        pa.array(columns[3], pa.int16()),
+        pa.array(columns[4], pa.string()),
+        pa.array(lng, pa.float64()),
+        pa.array(lat, pa.float64())
+        ], schema=METRO_SCHEMA)
+
+    os.makedirs(export_dir, exist_ok=True)
+    pq.write_table(table, os.path.join(export_dir, 'metro.parquet'), compression=COMPRESSION)
+
+    return len(rows)
+
+
+def DataSnapshot(conn, city=CITY):
+    '''
+    数据所属的快照日期：列表中最近一次出现房源的日期，而非导出当天
+    '''
+    snapshot = conn.execute('SELECT MAX(last_seen) FROM `{city}`'.format(city=city)).fetchone()[0]
+    if snapshot is None:
+        raise ValueError('No catalog records found for {:s}'.format(city))
+
+    return snapshot
+
+
+def Main(snapshot=None, city=CITY):
+    '''
+    导出结果可直接按列读取，如pd.read_parquet('export/houses')，分区字段snapshot和district自动还原为列；
+    未指定snapshot时取数据中最近的抓取日期
+    '''
+    conn = sqlite3.connect(cities.ShardPath(city))
+    snapshot = snapshot or DataSnapshot(conn, city)
+    sql_cleaning.CleanDbInitialize(conn, city)
+    sql_cleaning.CleanIncremental(conn, city)
+
+    n_houses = ExportHouses(conn, snapshot, city)
+    n_stations = ExportMetro(conn, city)
+    print('Exported {:d} houses and {:d} metro stations for snapshot {:s}'.format(n_houses, n_stations, snapshot))
+
+    conn.close()
+    return None
+
+
+if __name__ == '__main__':
+    Main()
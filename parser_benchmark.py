@@ -0,0 +1,242 @@
+'''
+离线解析基准：读取fixtures/下保存的列表页、详情页、高德返回的JSON、地铁线路表及线路样式，
+统计各解析阶段的每秒记录数、各字段耗时及内存分配，结果追加到历史文件中以便发现性能回退
+'''
+from datetime import datetime
+import glob
+import json
+import os
+import re
+import time
+import tracemalloc
+import catelog_fetching
+import record_fetching
+import lxml_parsing
+
+FIXTURE_DIR = 'fixtures'
+HISTORY_FILE = 'benchmark_history.jsonl'
+ROUNDS = 50
+REGRESSION = 0.8  # 速率低于上次记录的80%时提示回退
+DETAIL_LINK = 'https://gz.lianjia.com/zufang/fixture.html'
+
+
+def LoadFixtures(kind, pattern='*.html', fixture_dir=FIXTURE_DIR):
+    '''
+    读取保存在fixtures/<kind>/下的文件内容
+    '''
+    contents = []
+    for path in sorted(glob.glob(os.path.join(fixture_dir, kind, pattern))):
+        with open(path, 'r', encoding='utf-8') as fhand:
+            contents.append(fhand.read())
+    return contents
+
+
+def CountRecords(results):
+
+    return sum(len(r) if isinstance(r, list) else 1 for r in results)
+
+
+def Measure(stage, func, inputs, rounds=ROUNDS):
+    '''
+    对单个解析阶段计时，并在单独一轮中用tracemalloc统计峰值内存和新增的内存块数
+    '''
+    start = time.perf_counter()
+    for _ in range(rounds):
+        results = [func(x) for x in inputs]
+    elapsed = time.perf_counter() - start
+
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    kept = [func(x) for x in inputs]
+    after = tracemalloc.take_snapshot()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    blocks = sum(stat.count_diff for stat in after.compare_to(before, 'filename') if stat.count_diff > 0)
+    num_records = CountRecords(kept)
+
+    return results, {
+        'stage': stage,
+        'records': num_records,
+        'records_per_sec': round(num_records * rounds / elapsed, 1) if elapsed else None,
+        'peak_kib': round(peak / 1024, 1),
+        'alloc_blocks': blocks
+        }
+
+
+def FieldTimes(probes, nodes, rounds=ROUNDS):
+    '''
+    分别对每个字段的提取计时，返回每个节点的平均耗时（微秒）
+    '''
+    times = {}
+    for field, probe in probes.items():
+        start = time.perf_counter()
+        for _ in range(rounds):
+            for node in nodes:
+                probe(node)
+        times[field] = round((time.perf_counter() - start) / (rounds * len(nodes)) * 1e6, 2)
+    return times
+
+
+def SummaryProbes():
+
+    L = lxml_parsing
+    return {
+        'title': lambda item: L.Text(L.TITLE(item)),
+        'link': lambda item: catelog_fetching.HOST + L.TITLE(item)[0].get('href'),
+        'district': lambda item: L.Text([a for d in L.DES(item) for a in L.DES_FIRST(d)]),
+        'neighborhood': lambda item: L.Text([a for d in L.DES(item) for a in L.DES_SECOND(d)]),
+        'area': lambda item: re.search(r'(\d+)㎡', L.Text(L.DES(item))).group(1),
+        'price': lambda item: L.Text([em for p in L.PRICE(item) for em in L.PRICE_EM(p)]),
+        'unit': lambda item: re.sub(r'[-\d\s]+', '', L.Text(L.PRICE(item)))
+        }
+
+
+def DetailProbes():
+
+    L = lxml_parsing
+    return {
+        'house_code': lambda doc: L.Text(L.HOUSE_CODE(doc)),
+        'subtitle': lambda doc: L.Text(L.SUBTITLE(doc)),
+        'floor': lambda doc: L.Text([li for ul in L.INFO_LIST(doc) for li in L.FLOOR(ul)]),
+        'elevator': lambda doc: L.Text([li for ul in L.INFO_LIST(doc) for li in L.ELEVATOR(ul)])
+        }
+
+
+def Compare(kind, outputs):
+    '''
+    各解析后端的结果必须与PyQuery完全一致
+    '''
+    baseline = outputs.pop('pyquery')
+    for name, result in outputs.items():
+        assert result == baseline, '{:s} parser differs from pyquery on {:s} pages'.format(name, kind)
+    return None
+
+
+def ParserStages(fixture_dir=FIXTURE_DIR, rounds=ROUNDS):
+
+    reports = []
+    summary_pages = LoadFixtures('summary', fixture_dir=fixture_dir)
+    detail_pages = LoadFixtures('detail', fixture_dir=fixture_dir)
+
+    outputs = {}
+    for parser in ('pyquery', 'lxml'):
+        outputs[parser], report = Measure('summary.ParsePage[{:s}]'.format(parser),
+            lambda html: list(catelog_fetching.ParsePage(html, parser=parser)), summary_pages, rounds)
+        reports.append(report)
+    Compare('summary', outputs)
+
+    items = [item for html in summary_pages for item in lxml_parsing.ITEMS(lxml_parsing.Parse(html))]
+    if items:
+        reports[-1]['field_us'] = FieldTimes(SummaryProbes(), items, rounds)
+
+    titles = [rec['title'] for page in outputs['lxml'] for rec in page]
+    _, report = Measure('detail.ParseTitle', record_fetching.ParseTitle, titles, rounds)
+    reports.append(report)
+
+    outputs = {}
+    for parser in ('pyquery', 'lxml'):
+        outputs[parser], report = Measure('detail.ParseDetailPage[{:s}]'.format(parser),
+            lambda html: record_fetching.ParseDetailPage(DETAIL_LINK, html, parser=parser), detail_pages, rounds)
+        reports.append(report)
+    Compare('detail', outputs)
+
+    docs = [lxml_parsing.Parse(html) for html in detail_pages]
+    docs = [doc for doc in docs if not lxml_parsing.OFFLINE(doc)]
+    if docs:
+        reports[-1]['field_us'] = FieldTimes(DetailProbes(), docs, rounds)
+
+    return reports
+
+
+def OptionalStages(fixture_dir=FIXTURE_DIR, rounds=ROUNDS):
+    '''
+    地铁与地理编码模块依赖mapkeys，缺失时跳过对应阶段
+    '''
+    reports = []
+
+    try:
+        from metro_stations_fetching import ExtractColor
+        styles = [line for text in LoadFixtures('metro', '*.txt', fixture_dir) for line in text.splitlines() if line]
+        reports.append(Measure('metro.ExtractColor', ExtractColor, styles, rounds)[1])
+    except ImportError as err:
+        print('Skipping metro.ExtractColor:', err)
+
+    try:
+        from metro_stations_fetching import ParseStations
+
+        def ParseLineTable(html):
+            return list(ParseStations(html, '', ''))
+
+        tables = LoadFixtures('metro', '*.html', fixture_dir)
+        reports.append(Measure('metro.ParseStations', ParseLineTable, tables, rounds)[1])
+    except ImportError as err:
+        print('Skipping metro.ParseStations:', err)
+
+    try:
+        from community_geo_fetching import ExtractLocation
+
+        def ParseGeocode(text):
+            try:
+                return ExtractLocation(json.loads(text))
+            except (IndexError, KeyError):
+                return None
+
+        responses = LoadFixtures('geocode', '*.json', fixture_dir)
+        reports.append(Measure('geocode.ExtractLocation', ParseGeocode, responses, rounds)[1])
+    except ImportError as err:
+        print('Skipping geocode.ExtractLocation:', err)
+
+    return reports
+
+
+def LastResults(history_file=HISTORY_FILE):
+
+    last = {}
+    if os.path.exists(history_file):
+        with open(history_file, 'r') as fhand:
+            for line in fhand:
+                if line.strip():
+                    report = json.loads(line)
+                    last[report['stage']] = report
+    return last
+
+
+def Report(reports, last):
+
+    print('{:34s} {:>8s} {:>12s} {:>10s} {:>8s} {:>8s}'.format(
+        'stage', 'records', 'records/sec', 'peak KiB', 'blocks', 'vs last'))
+
+    for report in reports:
+        previous = last.get(report['stage'])
+        ratio = ''
+        if previous and previous.get('records_per_sec') and report['records_per_sec']:
+            ratio = report['records_per_sec'] / previous['records_per_sec']
+            ratio = '{:.2f}x{:s}'.format(ratio, ' !' if ratio < REGRESSION else '')
+
+        print('{:34s} {:8d} {:12.1f} {:10.1f} {:8d} {:>8s}'.format(
+            report['stage'], report['records'], report['records_per_sec'] or 0,
+            report['peak_kib'], report['alloc_blocks'], ratio))
+
+        for field, us in report.get('field_us', {}).items():
+            print('    {:30s} {:10.2f} us'.format(field, us))
+
+    return None
+
+
+def Main(fixture_dir=FIXTURE_DIR, rounds=ROUNDS, history_file=HISTORY_FILE):
+
+    reports = ParserStages(fixture_dir, rounds) + OptionalStages(fixture_dir, rounds)
+    Report(reports, LastResults(history_file))
+
+    stamp = datetime.now().isoformat(timespec='seconds')
+    with open(history_file, 'a+') as fhand:
+        for report in reports:
+            fhand.write(json.dumps(dict(report, time=stamp, rounds=rounds), ensure_ascii=False))
+            fhand.write('\n')
+
+    return None
+
+
+if __name__ == '__main__':
+    Main()
@@ -1,14 +1,24 @@
 from urllib.parse import urlsplit
-import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
 import re
-import random
-import time
-import requests
 from requests.exceptions import Timeout, ConnectionError
 from pyquery import PyQuery as pq
+import http_client
+import failures
+from user_agents import GetHeader
+from db_writer import ConnectDb, BatchWriter
+import lxml_parsing
+import metrics
+import cities
 
-BASE_URL = 'https://gz.lianjia.com/zufang/'
 CITY = 'guangzhou'
+BASE_URL = cities.CatelogUrl(CITY)
+WORKERS = 4  # 同时在途的详情页请求数，总请求速率由throttle中的令牌桶控制
+PARSER = 'lxml'  # 'lxml' | 'pyquery'
+CHUNK_SIZE = 100  # 每次从待处理队列中认领的summary记录数
+PARSE_ERRORS = (AttributeError, IndexError, KeyError, TypeError)  # 页面结构变化时正则无匹配等解析异常
+# summary表中status字段：0 待处理，1 已处理，2 已认领处理中，3 无效（第三方或非本城市房源）
 
 def RecordDbInitialize(conn, city=CITY):
 
@@ -29,11 +39,12 @@ def RecordDbInitialize(conn, city=CITY):
                `HouseFloor` CHAR(4),
                `BuldFloor` TINYINT,
                `ElevatorFlag` CHAR(2)
-               )
+               );
+               CREATE INDEX IF NOT EXISTS `{city}-pending` ON `{city}` (`id`) WHERE `status` = 0;
                '''.format(city=city)
 
     try:
-        cur.execute(init_sql)
+        cur.executescript(init_sql)
         conn.commit()
     except:
         print('DB Initialization Error')
@@ -43,188 +54,273 @@ def RecordDbInitialize(conn, city=CITY):
     return conn
 
 
-def RecordDetailInsert(conn, detail, city=CITY):
+def DetailInsertSql(city=CITY):
 
-    cur = conn.cursor()
+    return '''
+           INSERT OR IGNORE INTO `{city}-detail` (
+               ID, InfoDate, District, Neighborhood, Community, RentType, Condition,
+               Area, Price, Unit, HouseFloor, BuldFloor, ElevatorFlag)
+           VALUES (
+               :HouseID, :InfoDate, :District, :Neighborhood, :Community, :RentType,
+               :Condition, :Area, :Price, :Unit, :HouseFloor, :BuldFloor, :ElevatorFlag)
+           ON CONFLICT(ID) DO UPDATE SET
+               InfoDate = excluded.InfoDate, RentType = excluded.RentType, Condition = excluded.Condition,
+               Area = excluded.Area, Price = excluded.Price, Unit = excluded.Unit,
+               HouseFloor = excluded.HouseFloor, BuldFloor = excluded.BuldFloor,
+               ElevatorFlag = excluded.ElevatorFlag
+           '''.format(city=city)
 
-    sql = '''
-          INSERT OR IGNORE INTO `{city}-detail` (
-              ID, InfoDate, District, Neighborhood, Community, RentType, Condition,
-              Area, Price, Unit, HouseFloor, BuldFloor, ElevatorFlag)
-          VALUES (
-              :HouseID, :InfoDate, :District, :Neighborhood, :Community, :RentType,
-              :Condition, :Area, :Price, :Unit, :HouseFloor, :BuldFloor, :ElevatorFlag)       
-          '''.format(city=city)
 
-    try:
-        cur.execute(sql, detail)
-        num_suc = cur.rowcount
-    except sqlite3.OperationalError as err:
-        print('Insertion Error for ID {:d}:'.format(detail['HouseID']), err)
-        num_suc = 0
-    
-    return num_suc
+def RecordDetailInsert(writer, detail, city=CITY):
 
-def StatusUpdate(conn, rid, sid, city=CITY):
+    writer.Add(DetailInsertSql(city), detail)
+    return None
 
-    cur = conn.cursor()
-    try:
-        cur.execute(
-            'UPDATE `{city}` SET status = 1, houseid = ? WHERE id = ?'.format(city=city), (rid, sid)
-            )
-    except sqlite3.OperationalError as err:
-        print('Update Error for ID {:d}:'.format(sid), err)
 
-    cur.close()
-    return None
+def StatusUpdate(writer, rid, sid, city=CITY):
 
+    writer.Add('UPDATE `{city}` SET status = 1, houseid = ? WHERE id = ?'.format(city=city), (rid, sid))
+    return None
 
-def InvalidDelete(conn, sid, city=CITY):
 
-    cur = conn.cursor()
-    try:
-        cur.execute('DELETE FROM `{city}` WHERE id = ?'.format(city=city), (sid, ))
-    except sqlite3.OperationalError as err:
-        print('Delete Error for ID {:d}:'.format(sid), err)
+def ClaimRelease(writer, sid, city=CITY):
 
-    cur.close()
+    writer.Add('UPDATE `{city}` SET status = 0 WHERE id = ?'.format(city=city), (sid, ))
     return None
 
 
-def GetHeader():
+def ClaimPending(conn, last_id, city=CITY, chunk=CHUNK_SIZE):
+    '''
+    按id游标分页认领一批待处理的summary记录，查询结果一次性取出，不与后续写入共用游标
+    '''
+    select_sql = '''
+                 SELECT id, title, link, district, neighborhood, area, price, unit
+                 FROM `{city}` WHERE status = 0 AND id > ?
+                 ORDER BY id LIMIT ?
+                 '''.format(city=city)
+    claim_sql = 'UPDATE `{city}` SET status = 2 WHERE id = ?'.format(city=city)
 
-    with open('user-agents.txt', 'r') as fhand:
-        agent = random.choice(fhand.read().split('\n'))
-    header = {
-        'User-Agent': agent,
-        'Host': 'gz.lianjia.com'
-    }
-    return header
+    with conn:
+        recs = conn.execute(select_sql, (last_id, chunk)).fetchall()
+        conn.executemany(claim_sql, [(rec[0], ) for rec in recs])
 
+    return recs
 
-def GetPage(url):
-    
-    try:
-        r = requests.get(url, headers=GetHeader(), timeout=10)
-    except Timeout as terr:
-        print('Timeout for {:s}'.format(url), terr)
 
-        with open('unsuccessful_detail_page.log', 'a+') as fhand:
-            fhand.write('Timeout for:\n')
-            fhand.write(url)
-            fhand.write('\n')
+def PendingRecords(conn, city=CITY, chunk=CHUNK_SIZE):
+    '''
+    依次产出待处理的summary记录；上次运行中断遗留的认领先恢复为待处理
+    '''
+    with conn:
+        conn.execute('UPDATE `{city}` SET status = 0 WHERE status = 2'.format(city=city))
 
-        return None
+    last_id = 0
+    while True:
+        recs = ClaimPending(conn, last_id, city, chunk)
+        if not recs:
+            break
+        yield from recs
+        last_id = recs[-1][0]
+
+    return None
+
+
+def InvalidMark(writer, sid, city=CITY):
+    '''
+    无效记录保留在summary表中并标记，增量抓取时不会被当作新房源重新入队
+    '''
+    writer.Add('UPDATE `{city}` SET status = 3 WHERE id = ?'.format(city=city), (sid, ))
+    return None
+
+
+def RequestPage(url):
+    '''
+    只发出请求、不写失败记录：回放缓存未命中时返回None，连接失败及异常状态抛出
+    '''
+    r = http_client.Get(url, headers=GetHeader(url))
 
     if r.status_code == 200:
         return r.text
+    elif http_client.IsReplayMiss(r):
+        print('Not in replay cache: {:s}'.format(url))
+        return None
     else:
-        print('Connection error {:d} for: {:s}'.format(r.status_code, url))
+        raise ConnectionError('Connection error {:d}'.format(r.status_code))
 
-        with open('unsuccessful_detail_page.log', 'a+') as fhand:
-            fhand.write('Connection error {:d}:\n'.format(r.status_code))
-            fhand.write(url)
-            fhand.write('\n')
 
+def GetPage(url):
+    
+    try:
+        html = RequestPage(url)
+    except (Timeout, ConnectionError) as err:  # 在抓取线程中发生，不能抛出到汇总线程中中断整次运行
+        print('Connection failed for {:s}'.format(url), err)
+        failures.Record('detail', url, err)
         return None
 
+    if html is not None:
+        failures.Resolve('detail', url)
+    return html
 
-def GetDetail(conn, city=CITY):
 
-    num_total, num_suc = 0, 0
+def FetchDetailPage(rec):
+    '''
+    抓取阶段：仅负责下载详情页，第三方房源不发出请求
+    '''
+    link = rec[2]
+    if IsThirdParty(link):
+        return rec, None
 
-    cur = conn.cursor()
-    cur.execute('SELECT * FROM `{city}`'.format(city=city))
-    # (id, title, link, district, neighborhood, area, price, unit, status, houseid)
+    return rec, GetPage(link)
 
-    for rec in cur:
-        
-        # 跳过已经处理过的summary数据
-        if rec[-2] == 1:
-            print('Skipping repeated record...{:s}'.format(rec[1]))
-            continue
+
+def FetchConcurrently(recs, workers=WORKERS, fetch=FetchDetailPage):
+    '''
+    以线程池并发抓取详情页，最多保持workers * 2个请求在途，并按输入顺序产出(rec, html)
+    '''
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for rec in recs:
+            pending.append(executor.submit(fetch, rec))
+            metrics.Set('queue_depth', len(pending), doc='Requests in flight per stage', stage='detail')
+            if len(pending) >= workers * 2:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+        metrics.Set('queue_depth', 0, stage='detail')
+
+
+def GetDetail(conn, city=CITY, workers=WORKERS, pending=None):
+
+    num_total = 0
+    writer = BatchWriter(conn)
+
+    # 只读取status = 0的summary数据，已处理的记录不再扫描；重试时由调用方给出待处理记录
+    if pending is None:
+        pending = PendingRecords(conn, city)
+    # (id, title, link, district, neighborhood, area, price, unit)
+
+    # 解析与数据库写入作为下游阶段在主线程中完成，sqlite连接不跨线程共享
+    for rec, html in FetchConcurrently(pending, workers):
         
         print('Retriving record {:d}...{:s}'.format(rec[0], rec[1]))
         num_total += 1
         
         try:
-            detail = GetOneDetail(rec[1:-2])
+            detail = GetOneDetail(rec[1:], html, city)
             print(detail)
-        except ValueError as verr:  # 剔除非广州范围及第三方上传的租房信息
+        except ValueError as verr:  # 剔除非本城市范围及第三方上传的租房信息
             print('Invalid record {:d}...{:s}: {}'.format(rec[0], rec[1], verr.args[0]))
-            InvalidDelete(conn, sid=rec[0])
+            InvalidMark(writer, sid=rec[0], city=city)
+            metrics.Inc('detail_outcomes_total', doc='Detail records by outcome',
+                        reason='third_party' if IsThirdParty(rec[2]) else 'non_gz')
             continue
-        except ConnectionError as cerr:  # 跳过链接无效、超时的租房信息
+        except ConnectionError as cerr:  # 跳过链接无效、超时的租房信息，留待下次运行
             print('Connection failed for {:d}...{:s}：{}'.format(rec[0], rec[1], cerr.args[0]))
+            ClaimRelease(writer, sid=rec[0], city=city)
+            metrics.Inc('detail_outcomes_total', reason='connection')
+            continue
+        except PARSE_ERRORS as perr:  # 单条页面无法解析，重试也不会成功，记为dead后继续处理其余房源
+            print('Parse failed for {:d}...{:s}: {!r}'.format(rec[0], rec[1], perr))
+            failures.Record('parse', rec[2], perr, retry=False)
+            InvalidMark(writer, sid=rec[0], city=city)
+            metrics.Inc('detail_outcomes_total', reason='parse')
             continue
 
         # 对已经下架的summary数据不作插入，但同样更新为已处理
-        num_suc += RecordDetailInsert(conn, detail)
-        StatusUpdate(conn, rid=detail['HouseID'], sid=rec[0])
-
-        if num_total % 20 == 0:  # 每处理完成20条summary记录做一次commit
-            conn.commit()
+        metrics.Inc('detail_outcomes_total', reason='ok' if detail['HouseID'] else 'offline')
+        RecordDetailInsert(writer, detail, city)
+        StatusUpdate(writer, rid=detail['HouseID'], sid=rec[0], city=city)
 
-        time.sleep(max(0, random.gauss(2, 0.5)))
-
-    conn.commit()
+    writer.Close()
+    num_suc = writer.Count(DetailInsertSql(city))
 
     print('Retrive {:d} detail records with {:d} succeeded'.format(num_total, num_suc))
 
     return None
 
 
-def GetOneDetail(rec):
+def ParseTitle(title):
+    '''
+    从标题中拆分出(租赁方式, 小区, 户型朝向)，无法匹配时返回None
+    '''
+    title = re.sub(r'[^\u00b7\w\s]', '', title)
+    match = re.search(r'(.+)?·([\w]+)\s(.*)\s?.*', title)
+
+    return match.groups() if match else None
+
+
+def GetOneDetail(rec, html, city=CITY):
     
     title, link, district, neighborhood, area, price, unit = rec
 
-    title = re.sub(r'[^\u00b7\w\s]', '', title)
-    if re.search(r'(.+)?·([\w]+)\s(.*)\s?.*', title):
-        renttype, community, condition = re.search(r'(.+)?·([\w]+)\s(.*)\s?.*', title).groups()
+    title_info = ParseTitle(title)
+    if title_info:
+        renttype, community, condition = title_info
     else:
-        with open('unsuccessful_detail_page.log', 'a+') as fhand:
-            fhand.write('Regex error:\n')
-            fhand.write(link)
-            fhand.write('\n')
+        # 标题格式无法解析，重试也不会成功，直接记为dead
+        failures.Record('parse', link, ValueError('Regex error for title {:s}'.format(title)), retry=False)
+        metrics.Inc('parse_errors_total', doc='Fields that failed to parse', field='title')
         renttype, community, condition = None, None, None
     
     info = {'District': district, 'Neighborhood': neighborhood, 'Community': community, \
     'RentType': renttype, 'Condition': condition, 'Area': area, 'Price': price, 'Unit': unit}
 
-    add_info = ParseDetailPage(link)
+    with metrics.Timer('parse_seconds', doc='Page parsing time', page='detail'):
+        add_info = ParseDetailPage(link, html, city=city)
     info.update(add_info)
 
     return info
 
 
-def ParseDetailPage(link):
+def IsThirdParty(link):
+
+    return not urlsplit(link)[2].startswith('/zufang/')
+
+
+def DetailFields(html):
+    '''
+    PyQuery解析路径，返回详情页的原始字段(house_code, subtitle, floor, elevator)，已下架房源返回None
+    '''
+    detail = pq(html)
+
+    if detail('.offline'):
+        return None
+
+    return (
+        detail('.house_code').text(),
+        detail('.content__subtitle').text(),
+        detail('#info > ul:nth-child(2) > li:nth-child(8)').text(),
+        detail('#info > ul:nth-child(2) > li:nth-child(9)').text()
+        )
+
+
+def ParseDetailPage(link, html, parser=PARSER, city=CITY):
 
     #with open('temp.html', 'r+') as fhand:
     #    html = fhand.read()
     # 删除信息质量较差的公寓数据
-    if not urlsplit(link)[2].startswith('/zufang/'):
+    if IsThirdParty(link):
         raise ValueError('The house is provided by third-party and to be deleted.')
-    
-    html = GetPage(link)
 
     if html is None:
         raise ConnectionError('Unable to fetch additional detail.')
 
-    detail = pq(html)
+    if parser == 'lxml':
+        fields = lxml_parsing.DetailFields(html)
+    else:
+        fields = DetailFields(html)
     
-    if detail('.offline'): # 对已下架的房源信息返回空值
+    if fields is None: # 对已下架的房源信息返回空值
         return {'HouseID': None, 'InfoDate': None, 'HouseFloor': None, \
     'BuldFloor': None, 'ElevatorFlag': None}
     
-    houseID_raw = detail('.house_code').text()
-    infodate_raw = detail('.content__subtitle').text()
-    floor_raw = detail('#info > ul:nth-child(2) > li:nth-child(8)').text()
-    elevator_flag = re.split(r'[:：]', detail('#info > ul:nth-child(2) > li:nth-child(9)').text())[1]
+    houseID_raw, infodate_raw, floor_raw, elevator_raw = fields
+    elevator_flag = re.split(r'[:：]', elevator_raw)[1]
     
-    city, houseID = re.search(r'(?P<city>[A-Z]+)(?P<id>\d+)', houseID_raw).groups()
+    code, houseID = re.search(r'(?P<city>[A-Z]+)(?P<id>\d+)', houseID_raw).groups()
 
-    if city != 'GZ':
-        raise ValueError('The house is not in Guangzhou.')
+    if code != cities.GetCity(city).code:
+        raise ValueError('The house is not in {:s}.'.format(city))
 
     infodate = re.search(r'\d{4}-\d{2}-\d{2}', infodate_raw).group()
     housefloor, buldfloor = re.search(r'.*：(?P<housefloor>.+)/(?P<buldfloor>\d+).*', floor_raw).groups()
@@ -233,11 +329,14 @@ def ParseDetailPage(link):
     'BuldFloor': buldfloor, 'ElevatorFlag': elevator_flag}
 
 
-def Main():
+def Main(workers=WORKERS, city=CITY):
     
-    with sqlite3.connect('lianjia.db') as conn:
-        RecordDbInitialize(conn)
-        GetDetail(conn)
+    metrics.Start()
+    cities.UseCity(city)
+    with ConnectDb(cities.ShardPath(city)) as conn:
+        RecordDbInitialize(conn, city)
+        GetDetail(conn, city, workers)
+    metrics.Report('record_fetching')
     
     return None
 
@@ -0,0 +1,140 @@
+'''
+按失败记录重试各阶段已到重试时间的任务；重试仍失败时由各阶段再次写入失败记录，
+退避时间随之加倍，达到次数上限后转入dead状态
+'''
+import time
+import catelog_fetching
+import record_fetching
+import community_geo_fetching
+import failures
+import cities
+import shard_planner
+from db_writer import ConnectDb, BatchWriter
+
+CITY = 'guangzhou'
+
+
+def RetrySummary(conn, due, city=CITY):
+
+    snapshot = time.strftime('%Y-%m-%d')
+    writer = BatchWriter(conn)
+
+    for url, _ in due:
+        html = catelog_fetching.FetchPage(url)
+        if html is None:
+            continue
+        for record in catelog_fetching.ParsePage(html, host=cities.GetCity(city).host):
+            catelog_fetching.RecordInsert(writer, record, snapshot, city)
+
+    writer.Close()
+    return None
+
+
+def RetryShard(conn, due, city=CITY):
+    '''
+    首页抓取失败的分片从该分片重新规划，抓取其下的全部页面
+    '''
+    snapshot = time.strftime('%Y-%m-%d')
+    host, catelog = cities.GetCity(city).host, cities.CatelogUrl(city)
+    writer = BatchWriter(conn)
+
+    for _, payload in due:
+        planned = shard_planner.PlanShards(catelog_fetching.FetchPage, root=shard_planner.Shard(*payload), catelog=catelog)
+        for html in catelog_fetching.FetchConcurrently(shard_planner.ShardPages(planned, catelog)):
+            if html is None:
+                continue
+            for record in catelog_fetching.ParsePage(html, host=host):
+                catelog_fetching.RecordInsert(writer, record, snapshot, city)
+
+    writer.Close()
+    return None
+
+
+def RetryDetail(conn, due, city=CITY):
+    '''
+    按链接取回对应的summary记录，交由详情页抓取流程处理；已处理或已标记无效的记录不再重试
+    '''
+    links = [url for url, _ in due]
+    recs = []
+    for i in range(0, len(links), 500):
+        chunk = links[i:i + 500]
+        recs.extend(conn.execute('''
+            SELECT id, title, link, district, neighborhood, area, price, unit
+            FROM `{city}` WHERE status IN (0, 2) AND link IN ({marks})
+            '''.format(city=city, marks=', '.join('?' * len(chunk))), chunk).fetchall())
+
+    resolved = set(links) - {rec[2] for rec in recs}
+    for link in resolved:
+        failures.Resolve('detail', link)
+
+    record_fetching.GetDetail(conn, city, pending=recs)
+    return None
+
+
+def RetryGeocode(conn, due, city=CITY):
+
+    for _, payload in due:
+        district, community = payload[:2]
+        community_geo_fetching.CommunityGeoInsert(conn, community_geo_fetching.GetGeoRecord(district, community, city), city)
+    conn.commit()
+
+    return None
+
+
+# 分片重试会重新抓取分片首页，同一页面的summary失败记录随之解决，不必再单独重试
+HANDLERS = [
+    ('shard', RetryShard),
+    ('summary', RetrySummary),
+    ('detail', RetryDetail),
+    ('geocode', RetryGeocode)
+    ]
+
+
+def CityFailures(stage, due, city=CITY):
+    '''
+    失败记录写入各城市自己的分片，但lianjia.db中可能留有此前各城市共用时的记录，
+    按链接的域名或地理编码记录中的城市取出本城市的部分；旧的地理编码记录没有城市，视为广州
+    '''
+    if stage == 'geocode':
+        return [item for item in due if (item[1][2:] or [cities.DEFAULT_CITY])[0] == city]
+
+    host = cities.GetCity(city).host
+    return [item for item in due if item[0].startswith(host + '/')]
+
+
+def CityNextDue(log, city=CITY):
+    '''
+    本城市最近一次待重试的时间；按全部城市计算时，其他城市到期的记录会让循环不停空转
+    '''
+    due = [item[2] for stage, _ in HANDLERS for item in CityFailures(stage, log.Pending(stage), city)]
+    return min(due) if due else None
+
+
+def Main(loop=False, city=CITY):
+    '''
+    loop为True时持续运行，在最近一条待重试记录到期时醒来，直至没有待重试的记录
+    '''
+    conn = ConnectDb(cities.ShardPath(city))
+    cities.UseCity(city)
+    log = failures.GetLog()
+
+    while True:
+        for stage, handler in HANDLERS:
+            due = CityFailures(stage, log.Due(stage), city)
+            if due:
+                print('Retrying {:d} {:s} failures'.format(len(due), stage))
+                handler(conn, due, city)
+
+        print('Failure summary:', log.Summary())
+
+        next_due = CityNextDue(log, city)
+        if not loop or next_due is None:
+            break
+        time.sleep(max(0, next_due - time.time()))
+
+    conn.close()
+    return None
+
+
+if __name__ == '__main__':
+    Main()
@@ -0,0 +1,134 @@
+'''
+目录抓取的分片规划：链家列表最多只能翻到PAGE_CAP页，整个城市的单一列表会漏掉大量房源。
+按行政区、板块及价格区间（URL中的筛选片段）拆分列表，页数达到上限的分片继续细分，
+最终得到互相独立、可并发抓取的分片
+'''
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import re
+from pyquery import PyQuery as pq
+import failures
+
+CATELOG_URL = 'https://gz.lianjia.com/zufang/'
+PAGE_CAP = 100      # 链家列表可翻页的上限
+PRICE_MAX = 20000   # 价格二分的初始上界，更高的价格作为一个开放区间
+MIN_BAND = 100      # 价格区间不再细分的最小宽度
+WORKERS = 4
+
+# region为URL中的区域片段，level：0 全市，1 行政区，2 板块；low/high为价格区间，None表示不限
+Shard = namedtuple('Shard', ['region', 'level', 'low', 'high'])
+ROOT = Shard('', 0, None, None)
+
+
+def ShardUrl(shard, page=1, catelog=CATELOG_URL):
+    '''
+    如 https://gz.lianjia.com/zufang/tianhe/pg2brp1000erp2000rco11/
+    '''
+    region = shard.region + '/' if shard.region else ''
+    price = ''
+    if shard.low:
+        price += 'brp{:d}'.format(shard.low)
+    if shard.high is not None:
+        price += 'erp{:d}'.format(shard.high)
+
+    return '{catelog}{region}pg{page}{price}rco11/'.format(catelog=catelog, region=region, page=page, price=price)
+
+
+def MaxPage(html):
+
+    try:
+        return int(pq(html)('.content__pg').attr('data-totalpage'))
+    except (TypeError, ValueError):
+        return 0
+
+
+def RegionLinks(html, level):
+    '''
+    从筛选栏中取出下一级区域的URL片段，level 2为行政区，level 3为板块
+    '''
+    doc = pq(html)
+    regions = []
+    for a in doc('ul[data-target=area] li.filter__item--level{:d} a'.format(level)).items():
+        match = re.match(r'^/zufang/([a-z0-9]+)/$', a.attr('href') or '')
+        if match:
+            regions.append(match.group(1))
+
+    return regions
+
+
+def PriceSplit(shard):
+    '''
+    将价格区间一分为二，区间过窄时返回空列表
+    '''
+    low = shard.low or 0
+
+    if shard.high is None:
+        mid = max(low * 2, PRICE_MAX)
+        return [shard._replace(low=low, high=mid), shard._replace(low=mid + 1, high=None)]
+
+    if shard.high - low <= MIN_BAND:
+        return []
+
+    mid = (low + shard.high) // 2
+    return [shard._replace(low=low, high=mid), shard._replace(low=mid + 1)]
+
+
+def SubShards(shard, html):
+    '''
+    先按行政区、板块拆分，已是板块一级或筛选栏中没有下一级区域时按价格二分
+    '''
+    if shard.level < 2 and shard.low is None and shard.high is None:
+        regions = RegionLinks(html, shard.level + 2)
+        if regions:
+            return [Shard(region, shard.level + 1, None, None) for region in regions]
+
+    return PriceSplit(shard)
+
+
+def PlanShards(fetch, root=ROOT, workers=WORKERS, catelog=CATELOG_URL):
+    '''
+    逐层并发请求各分片的首页，页数达到上限的分片继续细分。
+    fetch(url)返回页面html或None，结果为[(shard, pages, first_page_html)]，首页不必再次抓取；
+    首页抓取失败的分片连同其下的子分片无法规划，写入shard阶段的失败记录，由retry_scheduler从该分片重新规划
+    '''
+    planned = []
+    frontier = [root]
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while frontier:
+            pages = list(executor.map(lambda shard: fetch(ShardUrl(shard, catelog=catelog)), frontier))
+            next_frontier = []
+
+            for shard, html in zip(frontier, pages):
+                url = ShardUrl(shard, catelog=catelog)
+                if html is None:
+                    print('Shard {} skipped, first page unavailable'.format(shard))
+                    failures.Record('shard', url, 'FirstPageUnavailable', payload=list(shard))
+                    continue
+                failures.Resolve('shard', url)
+
+                max_page = MaxPage(html)
+                if max_page < PAGE_CAP:
+                    planned.append((shard, max_page, html))
+                    continue
+
+                subs = SubShards(shard, html)
+                if subs:
+                    next_frontier.extend(subs)
+                else:
+                    print('Shard {} still reaches the page cap and cannot be split further'.format(shard))
+                    planned.append((shard, max_page, html))
+
+            frontier = next_frontier
+
+    return planned
+
+
+def ShardPages(planned, catelog=CATELOG_URL):
+    '''
+    将分片展开为(url, html)工作单元，首页带有已抓取的html，其余页为None
+    '''
+    for shard, max_page, html in planned:
+        yield ShardUrl(shard, 1, catelog), html
+        for page in range(2, max_page + 1):
+            yield ShardUrl(shard, page, catelog), None
@@ -0,0 +1,212 @@
+'''
+数据库内的增量清洗，取代notebook中每次整表读入pandas再逐列replace的处理：
+映射关系保存在查找表中，清洗结果持久化在`{city}-house`表里。每次运行只处理ROWID超过上次水位的新记录，
+以及由触发器登记的已更新记录；与小区坐标、地铁线路修正的合并以视图提供，随时可以直接查询
+'''
+import sqlite3
+import cities
+
+CITY = 'guangzhou'
+
+# (字段, 原始值, 清洗后的值)，租赁方式按前两个字符匹配
+LOOKUPS = [
+    ('HouseFloor', '低楼层', 'L'), ('HouseFloor', '中楼层', 'M'),
+    ('HouseFloor', '高楼层', 'H'), ('HouseFloor', '地下室', 'B'),
+    ('RentType', '整租', 'Whole'), ('RentType', '合租', 'Shared'),
+    ('ElevatorFlag', '有', '1'), ('ElevatorFlag', '无', '0')
+    ]
+DISTRICTS = {
+    'guangzhou': {'天河':'TH', '番禺':'PY', '白云':'BY', '海珠':'HZ', '花都':'HD', '南沙':'NS',
+                  '增城':'ZC', '荔湾':'LW', '越秀':'YX', '黄埔':'HP', '从化':'CH'}
+    }
+
+# 地铁线路修正：按线路名称（LIKE模式）改写线路编号，以及需要在支线上重复出现的换乘站
+LINE_FIXUPS = {
+    'guangzhou': [('三北线', '3N'), ('%知识城%', '14B')]
+    }
+INTERCHANGES = {
+    'guangzhou': [('3', '体育西路', '3N', '三北线'), ('14', '新和', '14B', '十四号线(知识城)')]
+    }
+
+
+def CleanDbInitialize(conn, city=CITY):
+    '''
+    建立查找表、清洗结果表、水位表及视图；查找表只补充缺少的映射，手工修改过的映射保留
+    '''
+    conn.executescript('''
+        CREATE TABLE IF NOT EXISTS `{city}-lookup` (
+        `Field` VARCHAR(16) NOT NULL,
+        `Raw` VARCHAR(16) NOT NULL,
+        `Value` VARCHAR(16) NOT NULL,
+        PRIMARY KEY (`Field`, `Raw`)
+        ) WITHOUT ROWID;
+
+        CREATE TABLE IF NOT EXISTS `{city}-line-fixup` (
+        `Pattern` VARCHAR(16) NOT NULL PRIMARY KEY,
+        `LineCode` VARCHAR(4) NOT NULL
+        );
+
+        CREATE TABLE IF NOT EXISTS `{city}-interchange` (
+        `LineCode` VARCHAR(4) NOT NULL,
+        `StationName` VARCHAR(16) NOT NULL,
+        `BranchCode` VARCHAR(4) NOT NULL,
+        `BranchName` VARCHAR(16) NOT NULL,
+        PRIMARY KEY (`LineCode`, `StationName`)
+        );
+
+        CREATE TABLE IF NOT EXISTS `{city}-house` (
+        `ID` BIGINT NOT NULL PRIMARY KEY,
+        `District` VARCHAR(4) NOT NULL,
+        `DistrictCode` VARCHAR(4),
+        `Community` VARCHAR(16),
+        `RentType` VARCHAR(8),
+        `Area` NUMERIC,
+        `Price` INT,
+        `UnitPrice` NUMERIC,
+        `HouseFloor` CHAR(1),
+        `BuldFloor` TINYINT,
+        `ElevatorFlag` TINYINT
+        );
+        CREATE INDEX IF NOT EXISTS `{city}-house-community` ON `{city}-house` (`Community`);
+
+        CREATE TABLE IF NOT EXISTS `cleaning-state` (
+        `Name` VARCHAR(32) NOT NULL PRIMARY KEY,
+        `Watermark` INTEGER DEFAULT 0 NOT NULL
+        );
+        INSERT OR IGNORE INTO `cleaning-state` VALUES ('{city}-house', 0);
+
+        -- 已清洗的记录被更新时登记其ROWID，下次运行重新清洗
+        CREATE TABLE IF NOT EXISTS `{city}-house-dirty` (`RowID` INTEGER PRIMARY KEY);
+        CREATE TRIGGER IF NOT EXISTS `{city}-detail-dirty` AFTER UPDATE ON `{city}-detail`
+        BEGIN
+            INSERT OR IGNORE INTO `{city}-house-dirty` VALUES (new.rowid);
+        END;
+        -- 详情表不是AUTOINCREMENT，删除末尾的记录后ROWID会被重用，新记录可能落在水位以下
+        CREATE TRIGGER IF NOT EXISTS `{city}-detail-reused` AFTER INSERT ON `{city}-detail`
+        WHEN new.rowid <= (SELECT Watermark FROM `cleaning-state` WHERE Name = '{city}-house')
+        BEGIN
+            INSERT OR IGNORE INTO `{city}-house-dirty` VALUES (new.rowid);
+        END;
+        CREATE TRIGGER IF NOT EXISTS `{city}-detail-delete` AFTER DELETE ON `{city}-detail`
+        BEGIN
+            DELETE FROM `{city}-house` WHERE ID = old.ID;
+        END;
+
+        -- 映射变化后水位归零，下次运行全部重新清洗
+        CREATE TRIGGER IF NOT EXISTS `{city}-lookup-insert` AFTER INSERT ON `{city}-lookup`
+        BEGIN
+            UPDATE `cleaning-state` SET Watermark = 0 WHERE Name = '{city}-house';
+        END;
+        CREATE TRIGGER IF NOT EXISTS `{city}-lookup-update` AFTER UPDATE ON `{city}-lookup`
+        BEGIN
+            UPDATE `cleaning-state` SET Watermark = 0 WHERE Name = '{city}-house';
+        END;
+        CREATE TRIGGER IF NOT EXISTS `{city}-lookup-delete` AFTER DELETE ON `{city}-lookup`
+        BEGIN
+            UPDATE `cleaning-state` SET Watermark = 0 WHERE Name = '{city}-house';
+        END;
+
+        -- 带坐标的房源，小区坐标在查询时合并，地理编码晚于清洗完成也能立即反映
+        CREATE VIEW IF NOT EXISTS `{city}-houses` AS
+        SELECT h.ID, h.DistrictCode AS District, c.ID AS CommunityID, h.RentType, h.Area, h.Price,
+        h.UnitPrice, h.HouseFloor, h.BuldFloor, h.ElevatorFlag, c.Longitude, c.Latitude
+        FROM `{city}-house` AS h
+        JOIN `{city}-community` AS c
+        ON (c.Community = h.Community) AND (c.District = h.District)
+        WHERE (c.Longitude IS NOT NULL) AND (c.Latitude IS NOT NULL);
+
+        -- 修正支线的线路编号，并为换乘站补充支线上的记录
+        CREATE VIEW IF NOT EXISTS `{city}-metro-clean` AS
+        SELECT COALESCE(
+            (SELECT f.LineCode FROM `{city}-line-fixup` AS f WHERE m.LineName LIKE f.Pattern),
+            CAST(m.LineCode AS TEXT)) AS LineCode,
+        m.LineName, m.LineColor, m.StationCode, m.StationName, m.Longitude, m.Latitude
+        FROM `{city}-metro` AS m
+        WHERE (m.Longitude IS NOT NULL) AND (m.Latitude IS NOT NULL)
+        UNION ALL
+        SELECT i.BranchCode, i.BranchName, m.LineColor, m.StationCode, m.StationName, m.Longitude, m.Latitude
+        FROM `{city}-metro` AS m
+        JOIN `{city}-interchange` AS i
+        ON (CAST(m.LineCode AS TEXT) = i.LineCode) AND (m.StationName = i.StationName)
+        WHERE (m.Longitude IS NOT NULL) AND (m.Latitude IS NOT NULL)
+        AND NOT EXISTS (SELECT 1 FROM `{city}-line-fixup` AS f WHERE m.LineName LIKE f.Pattern);
+        '''.format(city=city))
+
+    lookups = LOOKUPS + [('District', raw, code) for raw, code in DISTRICTS.get(city, {}).items()]
+    with conn:
+        conn.executemany('INSERT OR IGNORE INTO `{city}-lookup` VALUES (?, ?, ?)'.format(city=city), lookups)
+        conn.executemany('INSERT OR IGNORE INTO `{city}-line-fixup` VALUES (?, ?)'.format(city=city),
+                         LINE_FIXUPS.get(city, []))
+        conn.executemany('INSERT OR IGNORE INTO `{city}-interchange` VALUES (?, ?, ?, ?)'.format(city=city),
+                         INTERCHANGES.get(city, []))
+
+    return None
+
+
+def CleanSql(city=CITY):
+    '''
+    清洗ROWID在(上次水位, 本次水位]之间的记录及登记为已更新的记录；未能映射的值保留原值，
+    电梯字段无法映射时为NULL
+    '''
+    return '''
+           INSERT INTO `{city}-house` (
+               ID, District, DistrictCode, Community, RentType, Area, Price,
+               UnitPrice, HouseFloor, BuldFloor, ElevatorFlag)
+           SELECT d.ID, d.District, COALESCE(ld.Value, d.District), d.Community,
+               COALESCE(lr.Value, d.RentType), d.Area, d.Price,
+               d.Price * 1.0 / NULLIF(d.Area, 0), COALESCE(lf.Value, d.HouseFloor),
+               d.BuldFloor, CAST(le.Value AS INTEGER)
+           FROM `{city}-detail` AS d
+           LEFT JOIN `{city}-lookup` AS ld ON (ld.Field = 'District') AND (ld.Raw = d.District)
+           LEFT JOIN `{city}-lookup` AS lr ON (lr.Field = 'RentType') AND (lr.Raw = substr(d.RentType, 1, 2))
+           LEFT JOIN `{city}-lookup` AS lf ON (lf.Field = 'HouseFloor') AND (lf.Raw = d.HouseFloor)
+           LEFT JOIN `{city}-lookup` AS le ON (le.Field = 'ElevatorFlag') AND (le.Raw = d.ElevatorFlag)
+           WHERE (d.rowid > :low AND d.rowid <= :high)
+           OR d.rowid IN (SELECT RowID FROM `{city}-house-dirty`)
+           ON CONFLICT(ID) DO UPDATE SET
+               District = excluded.District, DistrictCode = excluded.DistrictCode,
+               Community = excluded.Community, RentType = excluded.RentType,
+               Area = excluded.Area, Price = excluded.Price, UnitPrice = excluded.UnitPrice,
+               HouseFloor = excluded.HouseFloor, BuldFloor = excluded.BuldFloor,
+               ElevatorFlag = excluded.ElevatorFlag
+           '''.format(city=city)
+
+
+def CleanIncremental(conn, city=CITY, rebuild=False):
+    '''
+    在单个事务中清洗新增及更新的记录并推进水位，返回清洗的记录数
+    '''
+    name = '{:s}-house'.format(city)
+
+    with conn:
+        if rebuild:
+            conn.execute('UPDATE `cleaning-state` SET Watermark = 0 WHERE Name = ?', (name, ))
+
+        low = conn.execute('SELECT Watermark FROM `cleaning-state` WHERE Name = ?', (name, )).fetchone()[0]
+        high = conn.execute('SELECT COALESCE(MAX(rowid), 0) FROM `{city}-detail`'.format(city=city)).fetchone()[0]
+        if low == 0:
+            # 全量清洗时清除已不存在的记录
+            conn.execute('DELETE FROM `{city}-house`'.format(city=city))
+
+        num = conn.execute(CleanSql(city), {'low': low, 'high': high}).rowcount
+        conn.execute('DELETE FROM `{city}-house-dirty`'.format(city=city))
+        conn.execute('UPDATE `cleaning-state` SET Watermark = ? WHERE Name = ?', (high, name))
+
+    return num
+
+
+def Main(city=CITY, rebuild=False):
+
+    conn = sqlite3.connect(cities.ShardPath(city))
+    CleanDbInitialize(conn, city)
+
+    num = CleanIncremental(conn, city, rebuild)
+    total = conn.execute('SELECT COUNT(*) FROM `{city}-house`'.format(city=city)).fetchone()[0]
+    print('{:d} detail records cleaned, {:d} in total'.format(num, total))
+
+    conn.close()
+    return None
+
+
+if __name__ == '__main__':
+    Main()
@@ -0,0 +1,309 @@
+'''
+流式抓取：列表页解析出的房源直接进入详情页抓取，详情页中新出现的小区随即进入地理编码，
+不再等待上一阶段全部完成。各阶段之间以有界队列连接，下游处理不过来时上游自动等待；
+所有数据库写入由单一写入线程完成
+
+    catalog -> detail -> geocode
+       |         |          |
+       +---------+----------+--> writer (lianjia.db)
+'''
+from queue import Queue, Empty
+import threading
+import time
+from requests.exceptions import ConnectionError
+import failures
+import catelog_fetching
+import record_fetching
+import community_geo_fetching
+import shard_planner
+import metrics
+import cities
+from db_writer import ConnectDb, BatchWriter
+
+CITY = 'guangzhou'
+WORKERS = 4             # 列表页及详情页各自同时在途的请求数
+QUEUE_SIZE = 100        # 相邻阶段之间最多缓冲的记录数
+WRITE_INTERVAL = 1      # 写入队列空闲超过该秒数时提交已缓冲的数据，使结果尽快可见
+GEOCODE_WAIT = 2        # 地理编码阶段凑满一批的最长等待时间
+DONE = object()         # 上游阶段结束的标记
+
+
+class QueueWriter:
+    '''
+    与BatchWriter相同的Add接口，将写入交给写入线程，各抓取模块的写入函数可以直接使用
+    '''
+
+    def __init__(self, outbox):
+
+        self.outbox = outbox
+
+    def Add(self, sql, params):
+
+        self.outbox.put((sql, params))
+        return None
+
+
+def Put(outbox, item, stage):
+
+    outbox.put(item)
+    metrics.Set('queue_depth', outbox.qsize(), doc='Requests in flight per stage', stage=stage)
+    return None
+
+
+def Receive(inbox):
+    '''
+    依次产出上游送来的记录；读到结束标记时放回队列，之后再读取同样会看到结束
+    '''
+    while True:
+        item = inbox.get()
+        if item is DONE:
+            inbox.put(DONE)
+            return None
+        yield item
+
+
+def DetailDoneSql(city=CITY):
+
+    return 'UPDATE `{city}` SET status = 1, houseid = ? WHERE link = ?'.format(city=city)
+
+
+def InvalidSql(city=CITY):
+
+    return 'UPDATE `{city}` SET status = 3 WHERE link = ?'.format(city=city)
+
+
+def NeedsDetail(reader, record, city=CITY):
+    '''
+    与InsertSql的判断一致：新房源、内容变化或仍待处理的房源需要抓取详情页，返回summary中的id
+    '''
+    row = reader.execute('SELECT id, hash, status FROM `{city}` WHERE link = ?'.format(city=city),
+                         (record['link'], )).fetchone()
+    if row is None:
+        return True, None
+
+    sid, old_hash, status = row
+    changed = old_hash is not None and old_hash != record['hash']
+    return changed or status == 0, sid
+
+
+def CatalogStage(detail_box, writer, snapshot, city=CITY, workers=WORKERS):
+    '''
+    规划分片并抓取列表页，记录交给写入线程，需要详情的房源同时送入详情页阶段
+    '''
+    reader = ConnectDb(cities.ShardPath(city))
+    host, catelog = cities.GetCity(city).host, cities.CatelogUrl(city)
+    seen = set()  # 相邻分片的价格边界可能重叠，按link去重
+
+    planned = shard_planner.PlanShards(catelog_fetching.FetchPage, workers=workers, catelog=catelog)
+    print('{:d} shards with {:d} pages planned'.format(len(planned), sum(p[1] for p in planned)))
+
+    for html in catelog_fetching.FetchConcurrently(shard_planner.ShardPages(planned, catelog), workers):
+        if html is None:
+            continue
+
+        for record in catelog_fetching.ParsePage(html, host=host):
+            if record['link'] in seen:
+                continue
+            seen.add(record['link'])
+
+            catelog_fetching.RecordInsert(writer, record, snapshot, city)
+            needed, sid = NeedsDetail(reader, record, city)
+            if needed:
+                # 与summary表查询结果相同的格式：(id, title, link, district, neighborhood, area, price, unit)
+                rec = (sid, record['title'], record['link'], record['district'], record['neighborhood'],
+                       record['area'], record['price'], record['unit'])
+                Put(detail_box, rec, 'detail')
+
+    reader.close()
+    print('{:d} summary records streamed'.format(len(seen)))
+    return None
+
+
+def FetchDetail(rec):
+    '''
+    抓取单个详情页；异常只影响这一条房源，记入失败记录后按未取得页面处理，不中断整个阶段
+    '''
+    try:
+        return record_fetching.FetchDetailPage(rec)
+    except Exception as err:
+        print('Fetch failed for {:s}:'.format(rec[2]), err)
+        failures.Record('detail', rec[2], err)
+        return rec, None
+
+
+def DetailStage(detail_box, geo_box, writer, known, city=CITY, workers=WORKERS, started=None):
+    '''
+    并发抓取详情页；抓取失败的房源保持待处理状态，留给record_fetching下次运行
+    '''
+    num_total = 0
+
+    for rec, html in record_fetching.FetchConcurrently(Receive(detail_box), workers, fetch=FetchDetail):
+        num_total += 1
+
+        try:
+            detail = record_fetching.GetOneDetail(rec[1:], html, city)
+        except ValueError as verr:  # 剔除非本城市范围及第三方上传的租房信息
+            print('Invalid record {:s}: {}'.format(rec[2], verr.args[0]))
+            writer.Add(InvalidSql(city), (rec[2], ))
+            continue
+        except ConnectionError as cerr:
+            print('Connection failed for {:s}: {}'.format(rec[2], cerr.args[0]))
+            continue
+        except record_fetching.PARSE_ERRORS as perr:  # 单条页面无法解析，不中断整个阶段
+            print('Parse failed for {:s}: {!r}'.format(rec[2], perr))
+            failures.Record('parse', rec[2], perr, retry=False)
+            writer.Add(InvalidSql(city), (rec[2], ))
+            continue
+
+        record_fetching.RecordDetailInsert(writer, detail, city)
+        writer.Add(DetailDoneSql(city), (detail['HouseID'], rec[2]))
+
+        if started is not None:
+            print('First detail record after {:.1f}s'.format(time.monotonic() - started))
+            metrics.Set('first_row_seconds', time.monotonic() - started, doc='Time until the first detail record')
+            started = None
+
+        # 已下架的房源没有详情，已有经纬度或本次已送出的小区不再编码
+        pair = (detail['District'], detail['Community'])
+        if detail['HouseID'] is not None and pair[1] is not None and pair not in known:
+            known.add(pair)
+            Put(geo_box, pair, 'geocode')
+
+    print('{:d} detail pages streamed'.format(num_total))
+    return None
+
+
+def NextBatch(geo_box, size=community_geo_fetching.BATCH_SIZE, wait=GEOCODE_WAIT):
+    '''
+    等待第一个小区后最多再等wait秒凑满一批；上游结束时返回None
+    '''
+    first = geo_box.get()
+    if first is DONE:
+        geo_box.put(DONE)
+        return None
+
+    batch = [first]
+    deadline = time.monotonic() + wait
+    while len(batch) < size:
+        try:
+            pair = geo_box.get(timeout=max(0, deadline - time.monotonic()))
+        except Empty:
+            break
+        if pair is DONE:
+            geo_box.put(DONE)
+            break
+        batch.append(pair)
+
+    return batch
+
+
+def GeocodeStage(geo_box, writer, city=CITY):
+
+    num_total = 0
+    while True:
+        batch = NextBatch(geo_box)
+        if batch is None:
+            break
+
+        with metrics.Timer('geocode_seconds', doc='Geocoding time per request unit', mode='batch'):
+            records = community_geo_fetching.GetGeoRecords(batch, city)
+
+        for record in records:
+            num_total += 1
+            metrics.Inc('geocode_total', doc='Geocoded communities by outcome',
+                        result='no_result' if record['Longitude'] is None else 'located')
+            writer.Add(community_geo_fetching.CommunityInsertSql(city), record)
+
+    print('{:d} communities geocoded'.format(num_total))
+    return None
+
+
+def WriterStage(write_box, city=CITY, interval=WRITE_INTERVAL):
+    '''
+    唯一持有写连接的线程；写入队列空闲时立即提交，不等待BatchWriter的时间阈值
+    '''
+    conn = ConnectDb(cities.ShardPath(city))
+    writer = BatchWriter(conn)
+
+    while True:
+        try:
+            item = write_box.get(timeout=interval)
+        except Empty:
+            writer.Flush()
+            continue
+        if item is DONE:
+            break
+        writer.Add(*item)
+
+    writer.Close()
+    conn.close()
+    return None
+
+
+def RunStage(name, target, inbox, outbox, *args):
+    '''
+    阶段异常退出时继续取空上游队列，避免上游阻塞在已满的队列上，并照常通知下游结束；
+    丢弃的房源在summary表中仍为待处理，由record_fetching下次运行补抓
+    '''
+    try:
+        target(*args)
+    except Exception as err:
+        print('Stage {:s} failed:'.format(name), err)
+        num_dropped = 0
+        while inbox is not None and inbox.get() is not DONE:
+            num_dropped += 1
+        if num_dropped:
+            print('{:d} queued items dropped by stage {:s}'.format(num_dropped, name))
+    finally:
+        if outbox is not None:
+            outbox.put(DONE)
+
+    return None
+
+
+def Main(city=CITY, workers=WORKERS, incremental=catelog_fetching.INCREMENTAL, size=QUEUE_SIZE):
+
+    started = time.monotonic()
+    snapshot = time.strftime('%Y-%m-%d')
+    metrics.Start()
+    cities.UseCity(city)
+
+    conn = catelog_fetching.DbInitialize(city, incremental)
+    record_fetching.RecordDbInitialize(conn, city)
+    community_geo_fetching.CommunityDbInitialize(conn, city)
+    known = set(conn.execute('''
+        SELECT District, Community FROM `{city}-community`
+        WHERE Longitude IS NOT NULL AND Latitude IS NOT NULL
+        '''.format(city=city)).fetchall())
+    conn.close()
+
+    detail_box, geo_box, write_box = Queue(size), Queue(size), Queue(size * 4)
+    writer = QueueWriter(write_box)
+
+    stages = [
+        threading.Thread(target=RunStage, args=('catalog', CatalogStage, None, detail_box,
+                                                detail_box, writer, snapshot, city, workers)),
+        threading.Thread(target=RunStage, args=('detail', DetailStage, detail_box, geo_box,
+                                                detail_box, geo_box, writer, known, city, workers, started)),
+        threading.Thread(target=RunStage, args=('geocode', GeocodeStage, geo_box, None,
+                                                geo_box, writer, city))
+        ]
+    writer_thread = threading.Thread(target=WriterStage, args=(write_box, city))
+
+    writer_thread.start()
+    for stage in stages:
+        stage.start()
+    for stage in stages:
+        stage.join()
+
+    write_box.put(DONE)
+    writer_thread.join()
+
+    print('Pipeline finished in {:.1f}s'.format(time.monotonic() - started))
+    metrics.Report('streaming_pipeline')
+
+    return None
+
+
+if __name__ == '__main__':
+    Main()
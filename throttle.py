@@ -0,0 +1,196 @@
+from urllib.parse import urlsplit
+import threading
+import time
+import metrics
+import cities
+
+RATE = 0.5      # 每秒补充的令牌数，对应原先平均2秒一次请求的节奏
+CAPACITY = 2    # 令牌桶容量，允许的瞬时突发请求数
+# 需要限速的主机及其初始速率，未列出的主机不限速
+RATES = {
+    'gz.lianjia.com': RATE,
+    'restapi.amap.com': 1.0     # 对应原先地理编码之间平均1秒的间隔
+}
+
+# 自适应限速（AIMD）：响应正常时速率线性增加，被限流或超时时速率减半
+ADAPTIVE = True
+MAX_RATES = {
+    'gz.lianjia.com': 4.0,
+    'restapi.amap.com': 3.0     # 个人开发者key的并发上限
+}
+# 登记表中其余城市的链家域名与广州使用相同的速率
+for _city in cities.CITIES.values():
+    RATES.setdefault(urlsplit(_city.host).netloc, RATES['gz.lianjia.com'])
+    MAX_RATES.setdefault(urlsplit(_city.host).netloc, MAX_RATES['gz.lianjia.com'])
+MIN_RATE = 0.05             # 速率下限，即最慢20秒一次请求
+INCREASE = 0.05             # 每秒正常请求带来的速率增量
+DECREASE = 0.5              # 受阻时速率乘以该系数
+COOLDOWN = 5                # 两次减速的最小间隔，避免同一批在途请求连续减速
+LATENCY_TARGET = 2.0        # 响应时间超过该秒数时不再提速
+BLOCK_STATUS = (403, 429, 503)
+
+
+class TokenBucket:
+    '''
+    线程安全的令牌桶限速器：并发请求共享同一个桶，总吞吐量不超过rate
+    '''
+
+    def __init__(self, rate=RATE, capacity=CAPACITY):
+
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.stamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    def Refill(self):
+
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def Acquire(self):
+        '''
+        取得一个令牌，令牌不足时阻塞至补充完成
+        '''
+        while True:
+            with self.lock:
+                self.Refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return None
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class AdaptiveBucket(TokenBucket):
+    '''
+    速率随响应反馈调整的令牌桶，同一主机的所有线程共享
+    '''
+
+    def __init__(self, rate=RATE, capacity=CAPACITY, max_rate=None, min_rate=MIN_RATE):
+
+        super().__init__(rate, capacity)
+        self.max_rate = max_rate or rate
+        self.min_rate = min(min_rate, rate)
+        self.last_backoff = 0
+
+    def Success(self, latency):
+        '''
+        加性增：每个正常且及时的响应使速率增加INCREASE / rate，约合每秒增加INCREASE
+        '''
+        if latency > LATENCY_TARGET:
+            return None
+
+        with self.lock:
+            self.Refill()
+            self.rate = min(self.max_rate, self.rate + INCREASE / self.rate)
+        return None
+
+    def Backoff(self, retry_after=None):
+        '''
+        乘性减：冷却期内只减速一次；有Retry-After时在该时间内不再发放令牌
+        '''
+        with self.lock:
+            self.Refill()
+            now = time.monotonic()
+            if now - self.last_backoff >= COOLDOWN:
+                self.rate = max(self.min_rate, self.rate * DECREASE)
+                self.last_backoff = now
+            self.tokens = min(self.tokens, 0)
+            if retry_after:
+                self.tokens -= retry_after * self.rate
+        return None
+
+
+_buckets = {}
+_buckets_lock = threading.Lock()
+
+def GetBucket(url, capacity=CAPACITY):
+    '''
+    按主机名返回共享的令牌桶，同一主机的所有请求共用一个限速器；不限速的主机返回None
+    '''
+    host = urlsplit(url).netloc or url
+
+    with _buckets_lock:
+        if host not in _buckets:
+            if host not in RATES:
+                _buckets[host] = None
+            elif ADAPTIVE:
+                _buckets[host] = AdaptiveBucket(RATES[host], capacity, MAX_RATES.get(host))
+            else:
+                _buckets[host] = TokenBucket(RATES[host], capacity)
+        return _buckets[host]
+
+
+def Throttle(url):
+    '''
+    在实际发出请求前调用，按主机限速
+    '''
+    bucket = GetBucket(url)
+    if bucket is not None:
+        bucket.Acquire()
+    return None
+
+
+def RetryAfter(response):
+
+    try:
+        return float(response.headers.get('Retry-After'))
+    except (TypeError, ValueError):
+        return None
+
+
+def IsBlocked(response):
+    '''
+    被限流、拒绝或重定向至验证码页面均视为受阻
+    '''
+    if response.status_code in BLOCK_STATUS:
+        return True
+    return 'captcha' in str(response.url) or any('captcha' in str(r.headers.get('Location', '')) for r in response.history)
+
+
+def Feedback(url, response=None, latency=0, error=None):
+    '''
+    请求完成后调用：超时或受阻时减速，正常响应时按延迟决定是否提速
+    '''
+    bucket = GetBucket(url)
+    if not isinstance(bucket, AdaptiveBucket):
+        return None
+
+    if error is not None:
+        bucket.Backoff()
+    elif IsBlocked(response):
+        bucket.Backoff(RetryAfter(response))
+    elif response.status_code < 400:
+        bucket.Success(latency)
+
+    return None
+
+
+def Backoff(url):
+    '''
+    供调用方在响应内容中发现限流时（如地图API的访问超限提示）主动减速
+    '''
+    bucket = GetBucket(url)
+    if isinstance(bucket, AdaptiveBucket):
+        bucket.Backoff()
+    return None
+
+
+def CurrentRates():
+    '''
+    导出各主机当前的请求速率（次/秒）
+    '''
+    with _buckets_lock:
+        return {host: bucket.rate for host, bucket in _buckets.items() if bucket is not None}
+
+
+def CollectRates():
+
+    for host, rate in CurrentRates().items():
+        metrics.Set('throttle_rate', rate, doc='Current request rate per host (requests/s)', host=host)
+    return None
+
+
+metrics.RegisterCollector(CollectRates)
@@ -0,0 +1,60 @@
+from urllib.parse import urlsplit
+from itertools import count
+import random
+import threading
+
+AGENT_FILE = 'user-agents.txt'
+POLICY = 'random'   # 'random' | 'round-robin' | 'sticky'
+
+
+class AgentPool:
+    '''
+    User-Agent池：首次使用时读取一次文件，之后以O(1)方式按策略取出
+    '''
+
+    def __init__(self, path=AGENT_FILE):
+
+        self.path = path
+        self.agents = None
+        self.lock = threading.Lock()
+        self.counter = count()
+        self.sticky = {}
+
+    def Load(self):
+
+        if self.agents is None:
+            with self.lock:
+                if self.agents is None:
+                    with open(self.path, 'r') as fhand:
+                        # 去除空行，以tuple保存以节省内存
+                        self.agents = tuple(line.strip() for line in fhand if line.strip())
+        return self.agents
+
+    def Pick(self, policy=POLICY, session=None):
+
+        agents = self.Load()
+
+        if policy == 'random':
+            return random.choice(agents)
+        if policy == 'round-robin':
+            return agents[next(self.counter) % len(agents)]
+        if policy == 'sticky':  # 同一会话始终使用同一个User-Agent
+            with self.lock:
+                if session not in self.sticky:
+                    self.sticky[session] = random.choice(agents)
+                return self.sticky[session]
+
+        raise ValueError('Unknown rotation policy: {:s}'.format(policy))
+
+
+POOL = AgentPool()
+
+def GetHeader(url, policy=POLICY, session=None):
+    '''
+    生成请求头，Host取自请求的URL
+    '''
+    header = {
+        'User-Agent': POOL.Pick(policy, session),
+        'Host': urlsplit(url).netloc
+    }
+    return header